@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+Compare the prefix search on the content field (prefix expansion over all the
+terms of the field) with the prefix search on the optional prefix field
+(DocSearch.PREFIX_FIELD, simple term lookup): index size and search latency.
+
+The documents of the work directory are indexed twice, in temporary
+directories. The index of Paperwork itself is not modified.
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import whoosh.index
+import whoosh.query
+
+from paperwork.backend import config
+from paperwork.backend.docsearch import DocIndexUpdater
+from paperwork.backend.docsearch import DocSearch
+
+
+NB_PREFIXES = 200
+PREFIX_LENS = [3, 4, 5, 6]
+
+
+def get_dir_size(dirpath):
+    size = 0
+    for filename in os.listdir(dirpath):
+        size += os.path.getsize(os.path.join(dirpath, filename))
+    return size
+
+
+def build_index(indexdir, docs, prefix_search):
+    index = whoosh.index.create_in(
+        indexdir, DocSearch.get_whoosh_schema(prefix_search))
+    writer = index.writer()
+    start = time.time()
+    for doc in docs:
+        (fields, _, _) = DocIndexUpdater._get_doc_index_fields(doc)
+        DocIndexUpdater._write_doc_fields(writer, fields)
+    writer.commit(optimize=True)
+    return (index, time.time() - start)
+
+
+def bench_queries(index, queries):
+    with index.searcher() as searcher:
+        nb_results = 0
+        start = time.time()
+        for query in queries:
+            nb_results += len(searcher.search(query, limit=None))
+        return ((time.time() - start) / len(queries), nb_results)
+
+
+def main():
+    pconfig = config.PaperworkConfig()
+    pconfig.read()
+    print("Opening docs (%s)" % pconfig.workdir)
+    print("====================")
+    dsearch = DocSearch(pconfig.workdir,
+                        prefix_search=pconfig.prefix_search)
+    docs = dsearch.docs
+    print("%d documents" % len(docs))
+
+    tmpdir = tempfile.mkdtemp(prefix="paperwork-bench-")
+    try:
+        results = {}
+        for prefix_search in [False, True]:
+            indexdir = os.path.join(tmpdir, str(prefix_search))
+            os.mkdir(indexdir)
+            sys.stdout.write("Indexing (prefix field: %s) ... "
+                             % prefix_search)
+            sys.stdout.flush()
+            (index, duration) = build_index(indexdir, docs, prefix_search)
+            print("%.1fs" % duration)
+            results[prefix_search] = (index, get_dir_size(indexdir))
+
+        with results[False][0].searcher() as searcher:
+            terms = [term for term in searcher.lexicon("content")
+                     if len(term) >= max(PREFIX_LENS)]
+        if len(terms) <= 0:
+            print("Not enough words in the index")
+            return
+        random.seed(0)
+        prefixes = set()
+        for _ in xrange(NB_PREFIXES):
+            term = random.choice(terms)
+            prefixes.add(term[:random.choice(PREFIX_LENS)])
+        prefixes = list(prefixes)
+
+        (latency_content, nb_content) = bench_queries(
+            results[False][0],
+            [whoosh.query.Prefix("content", prefix) for prefix in prefixes])
+        (latency_prefix, nb_prefix) = bench_queries(
+            results[True][0],
+            [whoosh.query.Term(DocSearch.PREFIX_FIELD, prefix)
+             for prefix in prefixes])
+        print("")
+        print("Results (%d prefixes)" % len(prefixes))
+        print("=======")
+        print("Index size without the prefix field: %d KB"
+              % (results[False][1] / 1024))
+        print("Index size with the prefix field: %d KB"
+              % (results[True][1] / 1024))
+        print("Average latency of Prefix('content', ...): %.2f ms"
+              % (latency_content * 1000))
+        print("Average latency of Term('%s', ...): %.2f ms"
+              % (DocSearch.PREFIX_FIELD, latency_prefix * 1000))
+        # may differ a little: the stop words are not removed from the
+        # prefix field
+        print("Number of results: %d / %d" % (nb_content, nb_prefix))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""
+Check that paperwork.util.split_words() gives exactly the same keywords
+than the previous implementation (generators + 2 regex splits per line), and
+compare their speed:
+- on random strings (corner cases: quotes, parenthesis, punctuation, short
+  words, accents, ...)
+- on the text of the pages of the work directory: the previous
+  implementation is called on each line, the new one on the whole text of
+  each page
+"""
+
+import random
+import sys
+import time
+
+from paperwork.backend import config
+from paperwork.backend.docsearch import DocSearch
+from paperwork.util import FORCED_SPLIT_KEYWORDS_REGEX
+from paperwork.util import MIN_KEYWORD_LEN
+from paperwork.util import split_words
+from paperwork.util import strip_accents
+from paperwork.util import WISHED_SPLIT_KEYWORDS_REGEX
+
+
+NB_RANDOM_STRINGS = 200000
+RANDOM_CHARS = list(u"ab AB'()\"!*-_.,:/\t19\xe9e\u0301\xc9\xe7\u0130\xdf")
+NB_RUNS = 5
+
+
+def split_words_generators(sentence):
+    if (sentence == "*"):
+        yield sentence
+        return
+
+    sentence = sentence.lower()
+    sentence = strip_accents(sentence)
+
+    words = FORCED_SPLIT_KEYWORDS_REGEX.split(sentence)
+    for word in words:
+        if len(word) < MIN_KEYWORD_LEN:
+            continue
+        can_split = True
+        can_yield = False
+        subwords = WISHED_SPLIT_KEYWORDS_REGEX.split(word)
+        for subword in subwords:
+            if subword == "":
+                continue
+            can_yield = True
+            if len(subword) < MIN_KEYWORD_LEN:
+                can_split = False
+                break
+        if can_split:
+            for subword in subwords:
+                if subword == "":
+                    continue
+                if subword[0] == '"':
+                    subword = subword[1:]
+                if subword[-1] == '"':
+                    subword = subword[:-1]
+                yield subword
+        elif can_yield:
+            if word[0] == '"':
+                word = word[1:]
+            if word[-1] == '"':
+                word = word[:-1]
+            yield word
+
+
+def split_lines_generators(lines):
+    return [word for line in lines for word in split_words_generators(line)]
+
+
+def random_string(max_len):
+    return u"".join([random.choice(RANDOM_CHARS)
+                     for _ in xrange(0, random.randint(0, max_len))])
+
+
+def check_random_strings():
+    random.seed(0)
+    for _ in xrange(0, NB_RANDOM_STRINGS):
+        sentence = random_string(16)
+        assert(list(split_words_generators(sentence))
+               == split_words(sentence))
+        lines = [random_string(8) for _ in xrange(0, 4)]
+        if random.randint(0, 4) == 0:
+            lines[random.randint(0, 3)] = u"*"
+        assert(split_lines_generators(lines)
+               == split_words(u"\n".join(lines)))
+    print("%d random strings: OK" % NB_RANDOM_STRINGS)
+
+
+def bench(func, args):
+    best = None
+    for _ in xrange(NB_RUNS):
+        start = time.time()
+        for arg in args:
+            func(arg)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def main():
+    check_random_strings()
+
+    pconfig = config.PaperworkConfig()
+    pconfig.read()
+    print("Opening docs (%s)" % pconfig.workdir)
+    print("====================")
+    dsearch = DocSearch(pconfig.workdir,
+                        prefix_search=pconfig.prefix_search,
+                        fuzzy_search=pconfig.fuzzy_search)
+
+    pages = []
+    for doc in dsearch.docs:
+        sys.stdout.write(str(doc) + " ")
+        sys.stdout.flush()
+        for page in doc.pages:
+            pages.append(page.text)
+    sys.stdout.write("\n")
+
+    texts = [u"\n".join(lines) for lines in pages]
+    for (lines, text) in zip(pages, texts):
+        assert(split_lines_generators(lines) == split_words(text))
+    nb_words = sum([len(split_words(text)) for text in texts])
+    print("%d pages, %d keywords: OK" % (len(pages), nb_words))
+    if nb_words <= 0:
+        return
+
+    print("")
+    print("Results (best of %d runs)" % NB_RUNS)
+    print("=======")
+    duration_generators = bench(split_lines_generators, pages)
+    duration = bench(split_words, texts)
+    print("generators, line by line: %.3fs (%.0f keywords/s)"
+          % (duration_generators, nb_words / duration_generators))
+    print("single pass, page by page: %.3fs (%.0f keywords/s)"
+          % (duration, nb_words / duration))
+    print("speedup: %.1fx" % (duration_generators / duration))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+Compare the throughput of paperwork.util.strip_accents() with the previous
+implementation (a Python generator over the decomposed string), on the text
+of the documents of the work directory. Also check that both give exactly
+the same results.
+"""
+
+import sys
+import time
+import unicodedata
+
+from paperwork.backend import config
+from paperwork.backend.docsearch import DocSearch
+from paperwork.util import strip_accents
+
+
+NB_RUNS = 5
+
+
+def strip_accents_generator(string):
+    return u''.join(
+        (character for character in unicodedata.normalize('NFD', string)
+         if unicodedata.category(character) != 'Mn'))
+
+
+def bench(func, texts):
+    best = None
+    for _ in xrange(NB_RUNS):
+        start = time.time()
+        for text in texts:
+            func(text)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def main():
+    pconfig = config.PaperworkConfig()
+    pconfig.read()
+    print("Opening docs (%s)" % pconfig.workdir)
+    print("====================")
+    dsearch = DocSearch(pconfig.workdir,
+                        prefix_search=pconfig.prefix_search,
+                        fuzzy_search=pconfig.fuzzy_search)
+
+    texts = []
+    for doc in dsearch.docs:
+        sys.stdout.write(str(doc) + " ")
+        sys.stdout.flush()
+        for page in doc.pages:
+            texts.append(u"\n".join([unicode(line) for line in page.text]))
+    sys.stdout.write("\n")
+
+    nb_chars = sum([len(text) for text in texts])
+    if nb_chars <= 0:
+        print("No text")
+        return
+    print("%d pages, %d characters" % (len(texts), nb_chars))
+
+    for text in texts:
+        assert(strip_accents(text) == strip_accents_generator(text))
+
+    print("")
+    print("Results (best of %d runs)" % NB_RUNS)
+    print("=======")
+    for (name, func) in [
+                ("generator", strip_accents_generator),
+                ("translation table", strip_accents),
+            ]:
+        duration = bench(func, texts)
+        print("%s: %.3fs (%.1f MChars/s)"
+              % (name, duration, nb_chars / duration / 1000000))
+
+
+if __name__ == "__main__":
+    main()
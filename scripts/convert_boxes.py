@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+Write the binary box files (paper.<n>.boxes, see
+paperwork.backend.common.boxes) and the text files (paper.<n>.txt) of all the
+pages of the image documents of a work directory.
+
+Paperwork writes them by itself when pages are scanned, or the first time
+their boxes or their text are needed. This script does it for a whole work
+directory at once.
+"""
+
+import codecs
+import os
+import sys
+
+import pyocr.builders
+
+from paperwork.backend import config
+from paperwork.backend.common import boxes as boxfiles
+from paperwork.backend.img.doc import is_img_doc
+from paperwork.backend.img.page import ImgPage
+
+
+def convert_page(docpath, box_filename):
+    basename = box_filename[:-len(ImgPage.EXT_BOX)]
+    boxfile = os.path.join(docpath, box_filename)
+    binfile = os.path.join(docpath, basename + ImgPage.EXT_BOX_BIN)
+    txtfile = os.path.join(docpath, basename + ImgPage.EXT_TXT)
+
+    with codecs.open(boxfile, 'r', encoding='utf-8') as file_desc:
+        boxes = pyocr.builders.LineBoxBuilder().read_file(file_desc)
+    if len(boxes) <= 0:
+        # empty page, or old format (word boxes only)
+        return False
+
+    boxfiles.write_box_file(binfile, boxes)
+    # make sure we get exactly what Paperwork will get
+    assert(boxfiles.read_box_file(binfile) == boxes)
+
+    with codecs.open(txtfile, 'w', encoding='utf-8') as file_desc:
+        file_desc.write(u"\n".join([line.content for line in boxes]))
+    return True
+
+
+def main(workdir):
+    nb_pages = 0
+    nb_skipped = 0
+    for docid in sorted(os.listdir(workdir)):
+        docpath = os.path.join(workdir, docid)
+        if not is_img_doc(docpath):
+            continue
+        sys.stdout.write("%s: " % docid)
+        sys.stdout.flush()
+        for filename in sorted(os.listdir(docpath)):
+            if (not filename.startswith(ImgPage.FILE_PREFIX)
+                    or not filename.endswith("." + ImgPage.EXT_BOX)):
+                continue
+            if convert_page(docpath, filename):
+                sys.stdout.write(".")
+                nb_pages += 1
+            else:
+                sys.stdout.write("-")
+                nb_skipped += 1
+            sys.stdout.flush()
+        sys.stdout.write("\n")
+    print("")
+    print("%d pages converted, %d skipped" % (nb_pages, nb_skipped))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        print("Usage:")
+        print("  %s [<work_dir>]" % sys.argv[0])
+        print("")
+        print("  work_dir : default to the one in the Paperwork configuration")
+        sys.exit(1)
+    if len(sys.argv) == 2:
+        workdir = sys.argv[1]
+    else:
+        pconfig = config.PaperworkConfig()
+        pconfig.read()
+        workdir = pconfig.workdir
+    main(workdir)
+    sys.exit(0)
@@ -11,7 +11,8 @@ def main():
     pconfig.read()
     print("Opening docs (%s)" % pconfig.workdir)
     print("====================")
-    dsearch = docsearch.DocSearch(pconfig.workdir)
+    dsearch = docsearch.DocSearch(pconfig.workdir,
+                                  prefix_search=pconfig.prefix_search)
 
     nb_words = 0
     nb_docs = (len(dsearch.docs))
@@ -43,22 +44,21 @@ def main():
             sys.stdout.flush()
             nb_pages += 1
 
-            for line in page.text:
-                for word in util.split_words(line):
-                    # ignore words too short to be useful
-                    if (len(word) < 4):
-                        continue
-                    if not word in words:
-                        words.add(word)
-                        total_nb_unique_words += 1
-                    if not word in doc_words:
-                        doc_words.add(word)
-                        total_nb_unique_words_per_doc += 1
-
-                    nb_words += 1
-                    total_word_len += len(word)
-                    if max_word_len < len(word):
-                        max_word_len = len(word)
+            for word in util.split_words(u"\n".join(page.text)):
+                # ignore words too short to be useful
+                if (len(word) < 4):
+                    continue
+                if not word in words:
+                    words.add(word)
+                    total_nb_unique_words += 1
+                if not word in doc_words:
+                    doc_words.add(word)
+                    total_nb_unique_words_per_doc += 1
+
+                nb_words += 1
+                total_word_len += len(word)
+                if max_word_len < len(word):
+                    max_word_len = len(word)
 
         sys.stdout.write("\n")
 
@@ -0,0 +1,282 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2012  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compact binary storage of the line and word boxes of a page.
+
+The box files written by pyocr (hOCR-like) are slow to parse. The same boxes
+can also be stored in a binary file, which is read in one go when loaded:
+the box objects are only instantiated when they are actually accessed.
+
+File layout (little-endian):
+    header: magic, version, number of lines, number of words
+    lines: one entry per line: position (x1, y1, x2, y2), index of its
+        first word, number of words
+    words: one entry per word: position (x1, y1, x2, y2), offset and
+        length of its content in the string table
+    string table: content of all the words, UTF-8 encoded
+"""
+
+import bisect
+import logging
+import os
+import struct
+
+import pyocr.builders
+
+logger = logging.getLogger(__name__)
+
+MAGIC = "PWBOXES\0"
+VERSION = 1
+
+_HEADER = struct.Struct("<8sIII")
+_LINE = struct.Struct("<iiiiII")
+_WORD = struct.Struct("<iiiiII")
+
+
+class BoxFileError(Exception):
+    pass
+
+
+class BoxList(object):
+    """
+    Read-only list of line boxes (pyocr.builders.LineBox) backed by a binary
+    box file. Behaves like the list returned by
+    pyocr.builders.LineBoxBuilder.read_file(), but each line box is only
+    instantiated the first time it is accessed (and then kept, so the same
+    line will always be the same object).
+    """
+
+    def __init__(self, buf):
+        """
+        Arguments:
+            buf --- content of the binary box file
+        """
+        if len(buf) < _HEADER.size:
+            raise BoxFileError("File too short")
+        (magic, version, nb_lines, nb_words) = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise BoxFileError("Not a box file")
+        if version != VERSION:
+            raise BoxFileError("Unsupported version: %d" % version)
+        self.__buf = buf
+        self.__nb_lines = nb_lines
+        self.__nb_words = nb_words
+        self.__lines_offset = _HEADER.size
+        self.__words_offset = self.__lines_offset + (nb_lines * _LINE.size)
+        self.__strings_offset = self.__words_offset + (nb_words * _WORD.size)
+        if len(buf) < self.__strings_offset:
+            raise BoxFileError("File truncated")
+        self.__lines = [None] * nb_lines
+
+    def __len__(self):
+        return self.__nb_lines
+
+    def __get_word(self, word_idx):
+        (x1, y1, x2, y2, str_offset, str_len) = _WORD.unpack_from(
+            self.__buf, self.__words_offset + (word_idx * _WORD.size))
+        str_offset += self.__strings_offset
+        content = self.__buf[str_offset:str_offset + str_len].decode('utf-8')
+        return pyocr.builders.Box(content, ((x1, y1), (x2, y2)))
+
+    def __unpack_line(self, line_idx):
+        return _LINE.unpack_from(
+            self.__buf, self.__lines_offset + (line_idx * _LINE.size))
+
+    def __getitem__(self, line_idx):
+        if isinstance(line_idx, slice):
+            return [self[idx]
+                    for idx in xrange(*line_idx.indices(self.__nb_lines))]
+        if line_idx < 0:
+            line_idx += self.__nb_lines
+        line = self.__lines[line_idx]
+        if line is not None:
+            return line
+        (x1, y1, x2, y2, first_word, nb_words) = self.__unpack_line(line_idx)
+        word_boxes = [self.__get_word(word_idx)
+                      for word_idx in xrange(first_word,
+                                             first_word + nb_words)]
+        line = pyocr.builders.LineBox(word_boxes, ((x1, y1), (x2, y2)))
+        self.__lines[line_idx] = line
+        return line
+
+    def __iter__(self):
+        for line_idx in xrange(0, self.__nb_lines):
+            yield self[line_idx]
+
+    def __eq__(self, other):
+        if isinstance(other, BoxList):
+            other = list(other)
+        return list(self) == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def get_line_position(self, line_idx):
+        """
+        Returns the position of a line ((x1, y1), (x2, y2)), without
+        instantiating it
+        """
+        (x1, y1, x2, y2, _, _) = self.__unpack_line(line_idx)
+        return ((x1, y1), (x2, y2))
+
+    def get_line_content(self, line_idx):
+        """
+        Returns the text of a line (same as LineBox.content), without
+        instantiating it
+        """
+        (_, _, _, _, first_word, nb_words) = self.__unpack_line(line_idx)
+        words = []
+        for word_idx in xrange(first_word, first_word + nb_words):
+            (_, _, _, _, str_offset, str_len) = _WORD.unpack_from(
+                self.__buf, self.__words_offset + (word_idx * _WORD.size))
+            str_offset += self.__strings_offset
+            words.append(self.__buf[str_offset:str_offset + str_len])
+        return " ".join(words).decode('utf-8').strip()
+
+
+class _LineEntry(object):
+    """
+    Line box + its word boxes, sorted by left coordinate
+    """
+
+    def __init__(self, line):
+        self.line = line
+        words = sorted(line.word_boxes,
+                       key=lambda word: word.position[0][0])
+        self.words = words
+        self.lefts = [word.position[0][0] for word in words]
+        # max_rights[i] = max(right of words[0] ... words[i]): words may
+        # overlap, so a word starting before another may end after it
+        self.max_rights = []
+        max_right = None
+        for word in words:
+            max_right = max(max_right, word.position[1][0])
+            self.max_rights.append(max_right)
+
+    def get_words_at(self, x, y):
+        words = []
+        idx = bisect.bisect_right(self.lefts, x) - 1
+        while idx >= 0 and self.max_rights[idx] >= x:
+            ((a, b), (c, d)) = self.words[idx].position
+            if x <= c and b <= y <= d:
+                words.append(self.words[idx])
+            idx -= 1
+        return words
+
+
+class BoxIndex(object):
+    """
+    Spatial index of the line boxes of a page, and of the word boxes they
+    contain. Used to find quickly the boxes under the mouse.
+
+    The page is cut in horizontal stripes (ROW_HEIGHT high). Each stripe
+    knows the lines that cross it. In each line, words are looked up with a
+    binary search on their left coordinate.
+    All the coordinates are the ones of the page (see Box.position).
+    """
+
+    ROW_HEIGHT = 32
+
+    def __init__(self, line_boxes):
+        self.boxes = line_boxes
+        self.__rows = {}  # row index --> [_LineEntry]
+        for line in line_boxes:
+            ((_, top), (_, bottom)) = line.position
+            if len(getattr(line, 'word_boxes', [])) <= 0 or bottom < top:
+                continue
+            entry = _LineEntry(line)
+            for row in xrange(top // self.ROW_HEIGHT,
+                              (bottom // self.ROW_HEIGHT) + 1):
+                self.__rows.setdefault(row, []).append(entry)
+
+    def get_lines_at(self, x, y):
+        """
+        Returns:
+            The line boxes containing the point (x, y)
+        """
+        return [entry.line for entry in self.__get_entries_at(x, y)]
+
+    def __get_entries_at(self, x, y):
+        entries = self.__rows.get(int(y) // self.ROW_HEIGHT, [])
+        return [entry for entry in entries
+                if (entry.line.position[0][0] <= x <= entry.line.position[1][0]
+                    and entry.line.position[0][1] <= y
+                    <= entry.line.position[1][1])]
+
+    def get_words_at(self, x, y):
+        """
+        Returns:
+            The word boxes containing the point (x, y)
+        """
+        words = []
+        for entry in self.__get_entries_at(x, y):
+            words += entry.get_words_at(x, y)
+        return words
+
+
+def write_box_file(filepath, line_boxes):
+    """
+    Write line boxes in a binary box file. The file is written under a
+    temporary name first and then renamed over the old one: the readers
+    that still hold the old file open keep reading the old file, and the
+    new readers get the complete new one.
+
+    Arguments:
+        line_boxes --- list of pyocr.builders.LineBox
+    """
+    lines = []
+    words = []
+    strings = []
+    str_offset = 0
+    for line in line_boxes:
+        lines.append(_LINE.pack(line.position[0][0], line.position[0][1],
+                                line.position[1][0], line.position[1][1],
+                                len(words), len(line.word_boxes)))
+        for word in line.word_boxes:
+            content = word.content.encode('utf-8')
+            words.append(_WORD.pack(word.position[0][0], word.position[0][1],
+                                    word.position[1][0], word.position[1][1],
+                                    str_offset, len(content)))
+            strings.append(content)
+            str_offset += len(content)
+
+    tmp_filepath = filepath + ".tmp"
+    with open(tmp_filepath, 'wb') as file_desc:
+        file_desc.write(_HEADER.pack(MAGIC, VERSION, len(lines), len(words)))
+        file_desc.write("".join(lines))
+        file_desc.write("".join(words))
+        file_desc.write("".join(strings))
+    os.rename(tmp_filepath, filepath)
+
+
+def read_box_file(filepath):
+    """
+    Load a binary box file
+
+    Returns:
+        A BoxList
+
+    Raises:
+        IOError, OSError, BoxFileError
+    """
+    # Box files are small: reading them is as fast as mapping them, and the
+    # BoxList doesn't keep a file descriptor open as long as it is cached
+    with open(filepath, 'rb') as file_desc:
+        buf = file_desc.read()
+    if len(buf) <= 0:
+        raise BoxFileError("Empty file")
+    return BoxList(buf)
@@ -22,6 +22,7 @@ import os
 import os.path
 import time
 
+from paperwork.backend import ocr
 from paperwork.backend.common.page import BasicPage
 from paperwork.backend.labels import Label
 from paperwork.util import dummy_progress_cb
@@ -70,6 +71,20 @@ class BasicDoc(object):
     def drop_cache(self):
         self.__cache = {}
 
+    def preload_cache(self, labels=None, nb_pages=None):
+        """
+        Fill the cache with values already known elsewhere (see
+        docsnapshot.DocSnapshot), so they don't have to be read from the disk.
+
+        Arguments:
+            labels --- list of labels.Label (None = unknown)
+            nb_pages --- number of pages (None = unknown)
+        """
+        if labels is not None:
+            self.__cache['labels'] = labels
+        if nb_pages is not None:
+            self.__cache['nb_pages'] = nb_pages
+
     def __str__(self):
         return self.__docid
 
@@ -87,15 +102,16 @@ class BasicDoc(object):
 
     def redo_ocr(self, langs, callback=dummy_progress_cb):
         """
-        Run the OCR again on all the pages of the document
+        Run the OCR again on all the pages of the document. The pages are
+        processed in parallel by the OCR engine.
 
         Arguments
         """
         nb_pages = self.nb_pages
-        for i in range(0, nb_pages):
-            callback(i, nb_pages, BasicPage.SCAN_STEP_OCR, self)
-            page = self.pages[i]
-            page.redo_ocr(langs)
+        callback(0, nb_pages, BasicPage.SCAN_STEP_OCR, self)
+        batch = ocr.OcrBatch(self.pages[:], langs)
+        batch.run(lambda page: callback(batch.nb_done, nb_pages,
+                                        BasicPage.SCAN_STEP_OCR, self))
 
     def print_page_cb(self, print_op, print_context, page_nb):
         raise NotImplementedError()
@@ -143,12 +159,7 @@ class BasicDoc(object):
             return
         labels = self.labels
         labels.remove(to_remove)
-        with codecs.open(os.path.join(self.path, self.LABEL_FILE), 'w',
-                         encoding='utf-8') as file_desc:
-            for label in labels:
-                file_desc.write("%s,%s\n" % (label.name,
-                                             label.get_color_str()))
-        self.drop_cache()
+        self.labels = labels
 
     def __get_labels(self):
         """
@@ -172,7 +183,18 @@ class BasicDoc(object):
             self.__cache['labels'] = labels
         return self.__cache['labels']
 
-    labels = property(__get_labels)
+    def __set_labels(self, labels):
+        """
+        Replace all the labels of the document (-> rewrite the label file)
+        """
+        with codecs.open(os.path.join(self.path, self.LABEL_FILE), 'w',
+                         encoding='utf-8') as file_desc:
+            for label in labels:
+                file_desc.write("%s,%s\n" % (label.name,
+                                             label.get_color_str()))
+        self.drop_cache()
+
+    labels = property(__get_labels, __set_labels)
 
     def update_label(self, old_label, new_label):
         """
@@ -189,12 +211,7 @@ class BasicDoc(object):
             # this document doesn't have this label
             return
         labels.append(new_label)
-        with codecs.open(os.path.join(self.path, self.LABEL_FILE), 'w',
-                         encoding='utf-8') as file_desc:
-            for label in labels:
-                file_desc.write("%s,%s\n" % (label.name,
-                                             label.get_color_str()))
-        self.drop_cache()
+        self.labels = labels
 
     @staticmethod
     def get_export_formats():
@@ -106,6 +106,8 @@ class BasicPage(object):
 
         self.__thumbnail_cache = (None, 0)
         self.__text_cache = None
+        # (boxes, keyword index, words of the keyword index)
+        self.__keyword_index_cache = (None, None, [])
 
         assert(self.page_nb >= 0)
         self.__prototype_exporters = {
@@ -131,6 +133,7 @@ class BasicPage(object):
     def drop_cache(self):
         self.__thumbnail_cache = (None, 0)
         self.__text_cache = None
+        self.__keyword_index_cache = (None, None, [])
 
     def __get_text(self):
         if self.__text_cache is not None:
@@ -143,12 +146,62 @@ class BasicPage(object):
     def print_page_cb(self, print_op, print_context):
         raise NotImplementedError()
 
-    def redo_ocr(self, langs):
+    def submit_ocr(self, langs):
+        """
+        Submit the OCR of this page to the OCR engine (see backend.ocr)
+
+        Arguments:
+            langs --- languages to use with the OCR tool and the spell checker
+
+        Returns:
+            An OcrTask. Its result must be given to set_ocr_result()
+        """
+        raise NotImplementedError()
+
+    def set_ocr_result(self, ocr_result):
+        """
+        Replace the text and the boxes of this page by the result of the
+        OCR (see submit_ocr())
+        """
         raise NotImplementedError()
 
+    def redo_ocr(self, langs):
+        self.set_ocr_result(self.submit_ocr(langs).result())
+
     def destroy(self):
         raise NotImplementedError()
 
+    def __get_keyword_index(self):
+        """
+        Index of the word boxes of the page by keyword. Rebuilt only when the
+        boxes change.
+
+        Returns:
+            ({ keyword (see util.split_words()) : [word boxes] },
+             [keywords])
+        """
+        boxes = self.boxes
+        (cached_boxes, keyword_index, words) = self.__keyword_index_cache
+        if keyword_index is not None and cached_boxes is boxes:
+            return (keyword_index, words)
+        keyword_index = {}
+        for line in boxes:
+            for box in line.word_boxes:
+                for word in set(split_words(box.content)):
+                    keyword_index.setdefault(word, []).append(box)
+        words = keyword_index.keys()
+        self.__keyword_index_cache = (boxes, keyword_index, words)
+        return (keyword_index, words)
+
+    def __find_keywords(self, keyword):
+        """
+        Returns:
+            the words of the page containing the keyword (the keyword itself
+            included, if it is a word of the page)
+        """
+        (keyword_index, words) = self.__get_keyword_index()
+        return [word for word in words if keyword in word]
+
     def get_boxes(self, sentence):
         """
         Get all the boxes corresponding the given sentence
@@ -165,18 +218,16 @@ class BasicPage(object):
             assert(isinstance(sentence, list))
             keywords = sentence
 
+        (keyword_index, words) = self.__get_keyword_index()
         output = []
+        found = set()
         for keyword in keywords:
-            for line in self.boxes:
-                for box in line.word_boxes:
-                    if keyword in box.content:
-                        output.append(box)
-                        continue
-                    # unfold generator output
-                    words = [x for x in split_words(box.content)]
-                    if keyword in words:
-                        output.append(box)
+            for word in self.__find_keywords(keyword):
+                for box in keyword_index[word]:
+                    if box in found:
                         continue
+                    found.add(box)
+                    output.append(box)
         return output
 
     def get_export_formats(self):
@@ -197,13 +248,12 @@ class BasicPage(object):
         return self.doc == other.doc and self.page_nb == other.page_nb
 
     def __contains__(self, sentence):
-        words = split_words(sentence)
-        words = [word.lower() for word in words]
-        txt = self.text
-        for line in txt:
-            line = line.lower()
+        (keyword_index, words) = self.__get_keyword_index()
+        for keyword in split_words(sentence):
+            if keyword in keyword_index:
+                return True
             for word in words:
-                if word in line:
+                if keyword in word:
                     return True
         return False
 
@@ -215,9 +265,8 @@ class BasicPage(object):
             An array of strings
         """
         txt = self.text
-        for line in txt:
-            for word in split_words(line):
-                yield(word)
+        for word in split_words(u"\n".join(txt)):
+            yield(word)
 
     keywords = property(__get_keywords)
 
@@ -233,6 +233,25 @@ class PaperworkConfig(object):
 
     langs = property(__get_langs)
 
+    def __get_ocr_max_processes(self):
+        """
+        Maximum number of OCR processes running at the same time, whatever
+        is being done (scan, import, redo OCR, ...). See ocr.OcrEngine.
+
+        Integer. 0 = number of CPUs.
+        """
+        try:
+            return max(0, int(self._configparser.get("OCR", "MaxProcesses")))
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError,
+                ValueError):
+            return 0
+
+    def __set_ocr_max_processes(self, max_processes):
+        self._configparser.set("OCR", "MaxProcesses", str(int(max_processes)))
+
+    ocr_max_processes = property(__get_ocr_max_processes,
+                                 __set_ocr_max_processes)
+
     def __get_scanner_devid(self):
         """
         This is the id of the device selected by the user.
@@ -396,6 +415,83 @@ class PaperworkConfig(object):
 
     toolbar_visible = property(__get_toolbar_visible, __set_toolbar_visible)
 
+    def __get_watch_workdir(self):
+        """
+        Must the work directory be watched, so the index is updated as soon as
+        documents are added, modified or removed by other programs ?
+        (Linux only, see watcher.DocDirWatcher)
+
+        Boolean.
+        """
+        try:
+            val = int(self._configparser.get("Global", "WatchWorkDirectory"))
+            if val == 0:
+                return False
+            return True
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            return True
+
+    def __set_watch_workdir(self, watch):
+        """
+        Enable or disable the work directory watching
+        """
+        self._configparser.set("Global", "WatchWorkDirectory",
+                               str(int(watch)))
+
+    watch_workdir = property(__get_watch_workdir, __set_watch_workdir)
+
+    def __get_prefix_search(self):
+        """
+        Must the last word of the searches be considered as the beginning of
+        a word ("invo" --> "invoice") ? It requires an extra field in the
+        index (see DocSearch.PREFIX_FIELD): the index is rebuilt when this
+        setting changes.
+
+        Boolean.
+        """
+        try:
+            val = int(self._configparser.get("Global", "PrefixSearch"))
+            if val == 0:
+                return False
+            return True
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            return False
+
+    def __set_prefix_search(self, prefix_search):
+        """
+        Enable or disable the prefix search
+        """
+        self._configparser.set("Global", "PrefixSearch",
+                               str(int(prefix_search)))
+
+    prefix_search = property(__get_prefix_search, __set_prefix_search)
+
+    def __get_fuzzy_search(self):
+        """
+        Must the searched words also match the words close to them (OCR
+        errors: "lnvoice", "inv0ice", ...) ? It requires a trigram index of
+        the words of the index (see trigrams.TermTrigramIndex), built the
+        first time the setting is enabled.
+
+        Boolean.
+        """
+        try:
+            val = int(self._configparser.get("Global", "FuzzySearch"))
+            if val == 0:
+                return False
+            return True
+        except (ConfigParser.NoOptionError, ConfigParser.NoSectionError):
+            return False
+
+    def __set_fuzzy_search(self, fuzzy_search):
+        """
+        Enable or disable the fuzzy search
+        """
+        self._configparser.set("Global", "FuzzySearch",
+                               str(int(fuzzy_search)))
+
+    fuzzy_search = property(__get_fuzzy_search, __set_fuzzy_search)
+
     def write(self):
         """
         Rewrite the configuration file. It rewrites the same file than
@@ -0,0 +1,242 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2012  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Journal of the state of the work directory, as it was when the index was
+last known to be up-to-date. Used by the DocDirExaminer to skip the documents
+that haven't changed.
+"""
+
+import cPickle
+import hashlib
+import logging
+import os
+import time
+
+from paperwork.backend.common.doc import BasicDoc
+from paperwork.backend.img.page import ImgPage
+from paperwork.backend.pdf.doc import PDF_FILENAME
+
+logger = logging.getLogger(__name__)
+
+
+class DocDirJournal(object):
+    """
+    Remember, for each document directory:
+        - its mtime
+        - the mtimes of the files of the document that may be rewritten in
+          place (labels, extra text, PDF file): rewriting them doesn't change
+          the directory mtime
+        - a fingerprint of the set of files it contains (names, sizes,
+          mtimes), ignoring the files that can be regenerated (thumbnails,
+          cached text and boxes of the pages)
+
+    Also remember the list of entries of the work directory and its mtime, so
+    the work directory doesn't have to be listed if nothing was added or
+    removed.
+
+    The files of the pages are not looked at: Paperwork updates the journal
+    itself when it rewrites them (see watcher.DocWriteGuard).
+
+    Mtimes too close to the current time are not remembered: on some file
+    systems, they are only precise to the second (or worse), and another
+    change could still be made with the same mtime.
+    """
+
+    VERSION = 3
+    FILENAME = "workdir.journal"
+    IGNORED_FILE_SUFFIXES = (
+        "." + ImgPage.EXT_THUMB,
+        "." + ImgPage.EXT_BOX_BIN,
+    )
+    # only ignored for the page files (extra.txt must not be ignored)
+    IGNORED_PAGE_FILE_SUFFIXES = (
+        "." + ImgPage.EXT_TXT,
+    )
+    IN_PLACE_FILES = (
+        BasicDoc.LABEL_FILE,
+        BasicDoc.EXTRA_TEXT_FILE,
+        PDF_FILENAME,
+    )
+    MTIME_MARGIN = 2.0  # secs (precision of the mtimes on FAT)
+
+    def __init__(self, indexdir, rootdir):
+        self.filepath = os.path.join(indexdir, self.FILENAME)
+        self.rootdir = rootdir
+        self.rootdir_mtime = None
+        self.docdirs = []
+        self.__entries = {}  # docid --> (dir mtime, in-place files mtimes,
+                             #            fingerprint)
+
+    def load(self):
+        """
+        Load the journal from the disk
+
+        Returns:
+            True if a valid journal has been loaded
+        """
+        try:
+            with open(self.filepath, 'rb') as file_desc:
+                content = cPickle.load(file_desc)
+            if content['version'] != self.VERSION:
+                logger.info("Journal '%s' has an old version (%d). Ignored"
+                            % (self.filepath, content['version']))
+                return False
+            if content['rootdir'] != self.rootdir:
+                logger.info("Journal '%s' is about another work directory."
+                            " Ignored" % self.filepath)
+                return False
+            self.rootdir_mtime = content['rootdir_mtime']
+            self.docdirs = content['docdirs']
+            self.__entries = content['entries']
+        except IOError, exc:
+            logger.info("No work directory journal available: %s" % str(exc))
+            return False
+        except Exception, exc:
+            logger.warning("Failed to read work directory journal '%s': %s"
+                           % (self.filepath, str(exc)))
+            return False
+        return True
+
+    def save(self):
+        content = {
+            'version': self.VERSION,
+            'rootdir': self.rootdir,
+            'rootdir_mtime': self.rootdir_mtime,
+            'docdirs': self.docdirs,
+            'entries': self.__entries,
+        }
+        tmp_filepath = self.filepath + ".tmp"
+        try:
+            with open(tmp_filepath, 'wb') as file_desc:
+                cPickle.dump(content, file_desc, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filepath, self.filepath)
+        except (IOError, OSError), exc:
+            logger.warning("Failed to write work directory journal '%s': %s"
+                           % (self.filepath, str(exc)))
+
+    def set_docdirs(self, docdirs, rootdir_mtime):
+        """
+        Update the content of the work directory. Forget about the documents
+        that are not there anymore.
+        """
+        self.docdirs = docdirs
+        if self.__is_recent((rootdir_mtime,)):
+            # something else may still be added without changing the mtime
+            rootdir_mtime = None
+        self.rootdir_mtime = rootdir_mtime
+        entries = {}
+        for docdir in docdirs:
+            if docdir in self.__entries:
+                entries[docdir] = self.__entries[docdir]
+        self.__entries = entries
+
+    @staticmethod
+    def __is_page_file(filename):
+        return filename.startswith(ImgPage.FILE_PREFIX)
+
+    def __is_ignored(self, filename):
+        if filename.endswith(self.IGNORED_FILE_SUFFIXES):
+            return True
+        return (self.__is_page_file(filename)
+                and filename.endswith(self.IGNORED_PAGE_FILE_SUFFIXES))
+
+    def __quick_stat(self, docpath):
+        """
+        Returns:
+            (directory mtime, in-place files mtimes)
+        """
+        dir_mtime = os.stat(docpath).st_mtime
+        in_place_mtimes = []
+        for filename in self.IN_PLACE_FILES:
+            try:
+                in_place_mtimes.append(
+                    os.stat(os.path.join(docpath, filename)).st_mtime)
+            except OSError:
+                in_place_mtimes.append(None)
+        return (dir_mtime, tuple(in_place_mtimes))
+
+    def __is_recent(self, mtimes):
+        limit = time.time() - self.MTIME_MARGIN
+        for mtime in mtimes:
+            if mtime is not None and mtime >= limit:
+                return True
+        return False
+
+    def __get_fingerprint(self, docpath):
+        if not os.path.isdir(docpath):
+            return None
+        fingerprint = hashlib.sha1()
+        for filename in sorted(os.listdir(docpath)):
+            if self.__is_ignored(filename):
+                continue
+            stat = os.stat(os.path.join(docpath, filename))
+            line = "%s|%d|%f\n" % (filename, stat.st_size, stat.st_mtime)
+            if isinstance(line, unicode):
+                line = line.encode('utf-8')
+            fingerprint.update(line)
+        return fingerprint.digest()
+
+    def is_unchanged(self, docid):
+        """
+        Check if a document is still the same than when update() was called
+        for it
+
+        Only the directory and the files rewritten in place are looked at,
+        unless one of them has changed.
+        """
+        entry = self.__entries.get(docid)
+        if entry is None:
+            return False
+        docpath = os.path.join(self.rootdir, docid)
+        try:
+            quick_stat = self.__quick_stat(docpath)
+            if quick_stat == entry[:2]:
+                return True
+            fingerprint = self.__get_fingerprint(docpath)
+        except OSError:
+            return False
+        if fingerprint != entry[2]:
+            return False
+        # only files we don't care about have been modified
+        if not self.__is_recent((quick_stat[0],) + quick_stat[1]):
+            self.__entries[docid] = quick_stat + (fingerprint,)
+        return True
+
+    def update(self, docid):
+        """
+        Remember the current state of the document
+        """
+        docpath = os.path.join(self.rootdir, docid)
+        self.__entries.pop(docid, None)
+        if not os.path.isdir(docpath):
+            # deleted
+            return
+        try:
+            quick_stat = self.__quick_stat(docpath)
+            if self.__is_recent((quick_stat[0],) + quick_stat[1]):
+                # it will have to be examined again next time
+                return
+            self.__entries[docid] = (quick_stat
+                                     + (self.__get_fingerprint(docpath),))
+        except OSError, exc:
+            logger.warning("Failed to stat '%s': %s" % (docpath, str(exc)))
+
+    def remove(self, docid):
+        """
+        Forget the state of the document: it will be examined again next time
+        """
+        self.__entries.pop(docid, None)
@@ -20,6 +20,7 @@ Also everything related to indexation and searching in the documents (+
 suggestions)
 """
 
+import collections
 import logging
 import copy
 import datetime
@@ -30,16 +31,26 @@ import time
 import threading
 
 from gi.repository import GObject
+import whoosh.collectors
 import whoosh.fields
 import whoosh.index
 import whoosh.qparser
 import whoosh.query
+import whoosh.scoring
+import whoosh.searching
+import whoosh.sorting
 
 from paperwork.backend import img
+from paperwork.backend.docjournal import DocDirJournal
+from paperwork.backend.docsnapshot import DocSnapshot
 from paperwork.backend.img.doc import ImgDoc
 from paperwork.backend.img.doc import is_img_doc
+from paperwork.backend.labels import Label
+from paperwork.backend.ocrqueue import get_ocr_redoer
 from paperwork.backend.pdf.doc import PdfDoc
 from paperwork.backend.pdf.doc import is_pdf_doc
+from paperwork.backend.trigrams import TermTrigramIndex
+from paperwork.backend.watcher import DocWriteGuard
 from paperwork.util import dummy_progress_cb
 from paperwork.util import MIN_KEYWORD_LEN
 from paperwork.util import mkdir_p
@@ -54,6 +65,10 @@ DOC_TYPE_LIST = [
 ]
 
 
+def _datetime_to_timestamp(date):
+    return time.mktime(date.timetuple()) + (date.microsecond / 1000000.0)
+
+
 class DummyDocSearch(object):
     """
     Dummy doc search object.
@@ -89,12 +104,40 @@ class DummyDocSearch(object):
         sentence = sentence  # to make pylint happy
         return []
 
+    @staticmethod
+    def find_documents_page(sentence, page_nb, page_len, sort_by=None):
+        """ Do nothing """
+        # to make pylint happy
+        sentence = sentence
+        page_nb = page_nb
+        page_len = page_len
+        sort_by = sort_by
+        return ([], 0)
+
+    @staticmethod
+    def find_page_hits(doc, sentence):
+        """ Do nothing """
+        # to make pylint happy
+        doc = doc
+        sentence = sentence
+        return None
+
     @staticmethod
     def add_label(label):
         """ Do nothing """
         label = label  # to make pylint happy
         assert()
 
+    @staticmethod
+    def get_ocr_redoer():
+        """ Do nothing """
+        assert()
+
+    @staticmethod
+    def writing_docs(docids):
+        """ Do nothing """
+        return DocWriteGuard(None, docids)
+
     @staticmethod
     def redo_ocr(langs, progress_callback):
         """ Do nothing """
@@ -130,6 +173,9 @@ class DocDirExaminer(GObject.GObject):
     """
     Examine a directory containing documents. It looks for new documents,
     modified documents, or deleted documents.
+
+    The documents that haven't changed since they were last indexed (see
+    docjournal.DocDirJournal) are skipped.
     """
     def __init__(self, docsearch):
         GObject.GObject.__init__(self)
@@ -138,6 +184,30 @@ class DocDirExaminer(GObject.GObject):
         # searcher
         self.__searcher = docsearch.index.searcher()
 
+    def __get_indexed_docs(self):
+        """
+        Returns:
+            { docid: (doctype, last modification date when indexed) }
+            The last modification date is None if it is unknown.
+        """
+        indexed_docs = {}
+        snapshot = self.docsearch.snapshot
+        if snapshot.generation == self.docsearch.index.latest_generation():
+            for docid in snapshot.docids:
+                (doctype, labels, nb_pages, last_mod) = snapshot.get(docid)
+                if last_mod is not None:
+                    last_mod = datetime.datetime.fromtimestamp(last_mod)
+                indexed_docs[docid] = (doctype, last_mod)
+            return indexed_docs
+
+        # getting the doc list from the index
+        query = whoosh.query.Every()
+        results = self.__searcher.search(query, limit=None)
+        for result in results:
+            indexed_docs[result['docid']] = (result['doctype'],
+                                             result['last_read'])
+        return indexed_docs
+
     def examine_rootdir(self,
                         on_new_doc,
                         on_doc_modified,
@@ -148,90 +218,334 @@ class DocDirExaminer(GObject.GObject):
         Calls on_new_doc(doc), on_doc_modified(doc), on_doc_deleted(docid)
         every time a new, modified, or deleted document is found
         """
-        # getting the doc list from the index
-        query = whoosh.query.Every()
-        results = self.__searcher.search(query, limit=None)
-        old_doc_list = [result['docid'] for result in results]
-        old_doc_infos = {}
-        for result in results:
-            old_doc_infos[result['docid']] = (result['doctype'],
-                                              result['last_read'])
-        old_doc_list = set(old_doc_list)
+        old_doc_infos = self.__get_indexed_docs()
+        journal = self.docsearch.journal
 
         # and compare it to the current directory content
-        docdirs = os.listdir(self.docsearch.rootdir)
+        # (no need to list it again if nothing has been added or removed)
+        rootdir_mtime = os.stat(self.docsearch.rootdir).st_mtime
+        if journal.rootdir_mtime == rootdir_mtime:
+            docdirs = journal.docdirs
+        else:
+            docdirs = os.listdir(self.docsearch.rootdir)
+            journal.set_docdirs(docdirs, rootdir_mtime)
+
         progress = 0
         for docdir in docdirs:
-            old_infos = old_doc_infos.get(docdir)
-            doctype = None
-            if old_infos is not None:
-                doctype = old_infos[0]
-            doc = self.docsearch.get_doc_from_docid(docdir, doctype)
-            if doc is None:
-                continue
-            if docdir in old_doc_list:
-                old_doc_list.remove(docdir)
-                assert(old_infos is not None)
-                last_mod = datetime.datetime.fromtimestamp(doc.last_mod)
-                if old_infos[1] != last_mod:
-                    on_doc_modified(doc)
-            else:
-                on_new_doc(doc)
+            old_infos = old_doc_infos.pop(docdir, None)
+            doc = self.__examine_doc(docdir, old_infos,
+                                     on_new_doc, on_doc_modified)
             progress_cb(progress, len(docdirs),
                         DocSearch.INDEX_STEP_CHECKING, doc)
             progress += 1
 
         # remove all documents from the index that don't exist anymore
-        for old_doc in old_doc_list:
+        for old_doc in old_doc_infos.keys():
             on_doc_deleted(old_doc)
 
+        journal.save()
+        progress_cb(1, 1, DocSearch.INDEX_STEP_CHECKING)
+
+    def examine_docs(self,
+                     docids,
+                     on_new_doc,
+                     on_doc_modified,
+                     on_doc_deleted,
+                     progress_cb=dummy_progress_cb):
+        """
+        Examine only some specific entries of the rootdir (for instance,
+        because we have been told they have changed, see watcher.DocDirWatcher)
+        Calls on_new_doc(doc), on_doc_modified(doc), on_doc_deleted(docid)
+        every time a new, modified, or deleted document is found
+        """
+        old_doc_infos = self.__get_indexed_docs()
+        journal = self.docsearch.journal
+
+        progress = 0
+        for docid in docids:
+            old_infos = old_doc_infos.get(docid)
+            doc = None
+            if os.path.exists(os.path.join(self.docsearch.rootdir, docid)):
+                doc = self.__examine_doc(docid, old_infos,
+                                         on_new_doc, on_doc_modified)
+            else:
+                journal.remove(docid)
+                if old_infos is not None:
+                    on_doc_deleted(docid)
+            progress_cb(progress, len(docids),
+                        DocSearch.INDEX_STEP_CHECKING, doc)
+            progress += 1
+
+        journal.save()
         progress_cb(1, 1, DocSearch.INDEX_STEP_CHECKING)
 
+    def __examine_doc(self, docid, old_infos, on_new_doc, on_doc_modified):
+        """
+        Compare a document with what the index knows about it
+
+        Arguments:
+            old_infos --- (doctype, last modification date when indexed), or
+                None if the document is not in the index
+
+        Returns:
+            The document, or None if it has been skipped
+        """
+        journal = self.docsearch.journal
+        if old_infos is not None and journal.is_unchanged(docid):
+            return None
+        doctype = None
+        if old_infos is not None:
+            doctype = old_infos[0]
+        doc = self.docsearch.get_doc_from_docid(docid, doctype)
+        if doc is None:
+            return None
+        if old_infos is not None:
+            last_mod = datetime.datetime.fromtimestamp(doc.last_mod)
+            if old_infos[1] != last_mod:
+                # what we know about this document is now outdated
+                self.docsearch.snapshot.invalidate(docid)
+                journal.remove(docid)
+                doc.drop_cache()
+                on_doc_modified(doc)
+            else:
+                journal.update(docid)
+        else:
+            on_new_doc(doc)
+        return doc
+
+
+# digests of the texts whose terms are already known (see
+# DocIndexUpdater._get_content_terms()). None if the terms are not needed.
+# Set in the worker processes of a parallel DocIndexUpdater
+_KNOWN_TEXTS = None
+
+
+def _init_extract_worker(known_texts):
+    global _KNOWN_TEXTS
+    _KNOWN_TEXTS = known_texts
+
+
+def _extract_doc_index_fields(doc_infos):
+    """
+    Reinstantiate a document and extract the fields that must be indexed.
+    Run in the worker processes of a parallel DocIndexUpdater: documents can't
+    be pickled, so only their path, id and type are sent to the workers.
+
+    Arguments:
+        doc_infos --- (docpath, docid, doctype)
+
+    Returns:
+        (docid, fields, page_fields, metadata, terms) --- fields,
+            page_fields and metadata are None if the document couldn't be
+            read. terms: see DocIndexUpdater._get_content_terms(). Computed
+            here so the main process doesn't have to split the text itself.
+            None if the terms are not needed
+    """
+    (docpath, docid, doctype) = doc_infos
+    try:
+        for (is_doc_type, doc_type_name, doc_type) in DOC_TYPE_LIST:
+            if doc_type_name == doctype:
+                doc = doc_type(docpath, docid)
+                (fields, page_fields, metadata) = \
+                    DocIndexUpdater._get_doc_index_fields(doc)
+                terms = None
+                if _KNOWN_TEXTS is not None:
+                    terms = DocIndexUpdater._get_content_terms(
+                        DocSearch.WHOOSH_SCHEMA, doc, fields, page_fields,
+                        _KNOWN_TEXTS)
+                return (docid, fields, page_fields, metadata, terms)
+        logger.warn("Warning: unknown doc type for doc %s: %s"
+                    % (docid, doctype))
+    except Exception, exc:
+        logger.error("Failed to extract the text of document %s: %s"
+                     % (docid, str(exc)))
+    return (docid, None, None, None, None)
+
 
 class DocIndexUpdater(GObject.GObject):
     """
     Update the index content.
     Don't forget to call commit() to apply the changes
+
+    In parallel mode, the text of the added and updated documents is only
+    extracted when commit() is called, by a pool of worker processes, and
+    the index is written by a multi-segment writer.
     """
-    def __init__(self, docsearch, optimize, progress_cb=dummy_progress_cb):
+    def __init__(self, docsearch, optimize, progress_cb=dummy_progress_cb,
+                 parallel=False):
         self.docsearch = docsearch
         self.optimize = optimize
-        self.writer = docsearch.index.writer()
+        self.parallel = parallel
+        # generation of the index on which we are working
+        self.__generation = docsearch.index.latest_generation()
+        # The worker processes extracting the text and the ones of the
+        # index writer run at the same time: they share the CPUs
+        nb_procs = 1
+        if parallel:
+            nb_procs = multiprocessing.cpu_count()
+        if nb_procs <= 1:
+            self.parallel = False
+        self.__nb_extract_procs = max(1, nb_procs / 2)
+        nb_writer_procs = max(1, nb_procs - self.__nb_extract_procs)
+        if nb_writer_procs > 1:
+            self.writer = docsearch.index.writer(procs=nb_writer_procs,
+                                                 multisegment=True)
+        else:
+            self.writer = docsearch.index.writer()
+        self.page_writer = docsearch.page_index.writer()
         self.progress_cb = progress_cb
         self.__need_reload = False
+        self.__pending_docs = {}  # docid --> see _extract_doc_index_fields()
+        self.__snapshot_updates = {}  # docid --> metadata (see DocSnapshot)
+        # terms of the added and updated documents, and digests of their
+        # texts (only if the trigram index of the terms must be updated)
+        self.__terms = None
+        self.__text_digests = []
+        if docsearch.term_index is not None:
+            self.__terms = set()
 
     @staticmethod
-    def _update_doc_in_index(index_writer, doc):
+    def _get_doc_index_fields(doc, labels=None):
         """
-        Add/Update a document in the index
+        Extract from a document the fields that must be indexed, and the
+        metadata that must be kept in the document snapshot
+
+        Arguments:
+            labels --- if not None, labels to index instead of the ones of
+                the document (not written yet)
+
+        Returns:
+            (fields, page_fields, metadata) --- page_fields are the fields of
+                each page to put in the page index (pages without text are
+                not in it). See DocSnapshot.set() for the metadata
         """
-        last_mod = datetime.datetime.fromtimestamp(doc.last_mod)
+        doc_last_mod = doc.last_mod
+        last_mod = datetime.datetime.fromtimestamp(doc_last_mod)
         docid = unicode(doc.docid)
-        txt = u""
+        if labels is None:
+            labels = doc.labels
+        txt = []
+        page_fields = []
         for page in doc.pages:
-            txt += u"\n".join([unicode(line) for line in page.text])
+            page_txt = [unicode(line) for line in page.text]
+            txt += page_txt
+            page_txt = strip_accents(u"\n".join(page_txt).strip())
+            if page_txt == u"":
+                continue
+            page_fields.append({
+                'pageid': u"%s/%d" % (docid, page.page_nb),
+                'docid': docid,
+                'page_nb': page.page_nb,
+                'content': page_txt,
+            })
         extra_txt = doc.extra_text
         if extra_txt != u"":
-            txt += extra_txt + u"\n"
-        for label in doc.labels:
-            txt += u" " + unicode(label.name)
-        txt = txt.strip()
+            txt.append(extra_txt)
+        txt.append(u" ".join([unicode(label.name) for label in labels]))
+        txt = u"\n".join(txt).strip()
         txt = strip_accents(txt)
         if txt == u"":
             # make sure the text field is not empty. Whoosh doesn't like that
             txt = u"empty"
-        labels = u",".join([strip_accents(unicode(label.name))
-                            for label in doc.labels])
-
-        index_writer.update_document(
-            docid=docid,
-            doctype=doc.doctype,
-            content=txt,
-            label=labels,
-            date=doc.date,
-            last_read=last_mod
+        label_names = u",".join([strip_accents(unicode(label.name))
+                                 for label in labels])
+
+        fields = {
+            'docid': docid,
+            'doctype': doc.doctype,
+            'content': txt,
+            'label': label_names,
+            'date': doc.date,
+            'last_read': last_mod,
+        }
+        metadata = (
+            doc.doctype,
+            [(label.name, label.get_color_str()) for label in labels],
+            doc.nb_pages,
+            doc_last_mod,
         )
-        return True
+        return (fields, page_fields, metadata)
+
+    @staticmethod
+    def _update_doc_in_index(index_writer, page_writer, doc, labels=None,
+                             known_texts=None):
+        """
+        Add/Update a document in the index and its pages in the page index
+
+        Arguments:
+            labels --- see _get_doc_index_fields()
+            known_texts --- see _get_content_terms(). If None, the terms of
+                the document are not computed
+
+        Returns:
+            (metadata, terms) --- the metadata of the document (see
+                DocSnapshot.set()), and its terms (see _get_content_terms(),
+                None if known_texts is None)
+        """
+        (fields, page_fields, metadata) = \
+            DocIndexUpdater._get_doc_index_fields(doc, labels)
+        DocIndexUpdater._write_doc_fields(index_writer, fields)
+        DocIndexUpdater._write_page_fields(page_writer, fields['docid'],
+                                           page_fields)
+        terms = None
+        if known_texts is not None:
+            terms = DocIndexUpdater._get_content_terms(
+                index_writer.schema, doc, fields, page_fields, known_texts)
+        return (metadata, terms)
+
+    @staticmethod
+    def _write_page_fields(page_writer, docid, page_fields):
+        """
+        Replace the pages of a document in the page index
+        """
+        page_writer.delete_by_term('docid', docid)
+        for fields in page_fields:
+            if DocSearch.PREFIX_FIELD in page_writer.schema:
+                fields = dict(fields)
+                fields[DocSearch.PREFIX_FIELD] = fields['content']
+            page_writer.add_document(**fields)
+
+    @staticmethod
+    def _get_content_terms(schema, doc, fields, page_fields, known_texts):
+        """
+        Split the content of a document in terms, as put in the index (see
+        _get_doc_index_fields() for the fields). The text of each page is
+        split separately, and only if its digest (see
+        TermTrigramIndex.get_text_digest()) is not in known_texts: when a
+        document is indexed again, usually only a few pages (if any) have
+        changed.
+
+        Returns:
+            (set of terms, digests of the texts of the pages)
+        """
+        field = schema['content']
+        terms = set()
+        text_digests = []
+        for page in page_fields:
+            text_digest = TermTrigramIndex.get_text_digest(page['content'])
+            text_digests.append(text_digest)
+            if text_digest in known_texts:
+                continue
+            terms.update(field.process_text(page['content'], mode='index'))
+        # what remains is short: the extra text and the labels
+        texts = [strip_accents(doc.extra_text),
+                 fields['label'].replace(u",", u" ")]
+        if fields['content'] == u"empty":
+            texts.append(fields['content'])
+        terms.update(field.process_text(u"\n".join(texts), mode='index'))
+        return (terms, text_digests)
+
+    @staticmethod
+    def _write_doc_fields(index_writer, fields):
+        """
+        Add/Update a document in the index, given its fields (see
+        _get_doc_index_fields()). Fills in the fields derived from them that
+        the index may have.
+        """
+        if DocSearch.PREFIX_FIELD in index_writer.schema:
+            fields = dict(fields)
+            fields[DocSearch.PREFIX_FIELD] = fields['content']
+        index_writer.update_document(**fields)
 
     @staticmethod
     def _delete_doc_from_index(index_writer, docid):
@@ -246,45 +560,324 @@ class DocIndexUpdater(GObject.GObject):
         Add a document to the index
         """
         logger.info("Indexing new doc: %s" % doc)
-        self._update_doc_in_index(self.writer, doc)
+        self.__update_doc(doc)
         self.__need_reload = True
 
-    def upd_doc(self, doc):
+    def upd_doc(self, doc, labels=None):
         """
         Update a document in the index
+
+        Arguments:
+            labels --- if not None, labels to index instead of the ones of
+                the document: they can be written once the index has been
+                committed
         """
         logger.info("Updating modified doc: %s" % doc)
-        self._update_doc_in_index(self.writer, doc)
+        self.__update_doc(doc, labels)
+
+    def __update_doc(self, doc, labels=None):
+        if self.parallel and labels is None:
+            # the worker processes reinstantiate the documents: they would
+            # get the labels written on the disk
+            self.__pending_docs[doc.docid] = (doc.path, doc.docid,
+                                              doc.doctype)
+        else:
+            self.__pending_docs.pop(doc.docid, None)
+            (metadata, terms) = self._update_doc_in_index(
+                self.writer, self.page_writer, doc, labels,
+                self.__get_known_texts())
+            self.__snapshot_updates[doc.docid] = metadata
+            self.__add_terms(terms)
+
+    def __get_known_texts(self):
+        if self.__terms is None:
+            return None
+        return self.docsearch.term_index.text_digests
+
+    def __add_terms(self, terms):
+        """
+        Arguments:
+            terms --- see _get_content_terms(). May be None
+        """
+        if terms is None:
+            return
+        self.__terms.update(terms[0])
+        self.__text_digests += terms[1]
 
     def del_doc(self, docid):
         """
         Delete a document
         """
         logger.info("Removing doc from the index: %s" % docid)
+        if docid in self.__pending_docs:
+            self.__pending_docs.pop(docid)
         self._delete_doc_from_index(self.writer, docid)
+        self.page_writer.delete_by_term('docid', docid)
+        self.__snapshot_updates[docid] = None
         self.__need_reload = True
 
+    def __index_pending_docs(self):
+        """
+        Extract the text of the pending documents using a pool of worker
+        processes, and give the results to the index writer
+        """
+        pending_docs = self.__pending_docs.values()
+        self.__pending_docs = {}
+        if len(pending_docs) <= 0:
+            return
+        logger.info("Index: Extracting text of %d documents using %d processes"
+                    % (len(pending_docs), self.__nb_extract_procs))
+        # the workers are forked: the digests are not copied through a pipe
+        pool = multiprocessing.Pool(processes=self.__nb_extract_procs,
+                                    initializer=_init_extract_worker,
+                                    initargs=(self.__get_known_texts(),))
+        try:
+            progress = 0
+            for (docid, fields, page_fields, metadata, terms) in \
+                    pool.imap_unordered(_extract_doc_index_fields,
+                                        pending_docs):
+                self.progress_cb(progress, len(pending_docs),
+                                 DocSearch.INDEX_STEP_COMMIT)
+                progress += 1
+                if fields is None:
+                    continue
+                self._write_doc_fields(self.writer, fields)
+                self.__add_terms(terms)
+                self._write_page_fields(self.page_writer, docid, page_fields)
+                self.__snapshot_updates[docid] = metadata
+        finally:
+            pool.terminate()
+            pool.join()
+        self.progress_cb(1, 1, DocSearch.INDEX_STEP_COMMIT)
+
+    def __update_snapshot(self, snapshot_updates):
+        """
+        Apply the changes to the document snapshot, and write it
+        """
+        snapshot = self.docsearch.snapshot
+        if snapshot.generation != self.__generation:
+            # the index has been modified by someone else in the meantime
+            logger.warning("Document snapshot out of sync with the index."
+                           " Dropped")
+            snapshot.clear()
+            return
+        for (docid, metadata) in snapshot_updates.iteritems():
+            snapshot.set(docid, metadata)
+        snapshot.save(self.docsearch.index.latest_generation())
+
+    def __update_journal(self, snapshot_updates):
+        """
+        Remember the state of the documents that have just been indexed, so
+        the DocDirExaminer can skip them later if they don't change
+        """
+        journal = self.docsearch.journal
+        for (docid, metadata) in snapshot_updates.iteritems():
+            if metadata is None:
+                journal.remove(docid)
+            else:
+                journal.update(docid)
+        journal.save()
+
     def commit(self):
         """
         Apply the changes to the index
         """
         logger.info("Index: Commiting changes")
+        self.__index_pending_docs()
+        new_terms = self.__get_new_terms()
+        self.page_writer.commit(optimize=self.optimize)
+        del self.page_writer
         self.writer.commit(optimize=self.optimize)
         del self.writer
+        snapshot_updates = self.__snapshot_updates
+        self.__snapshot_updates = {}
+        self.__update_snapshot(snapshot_updates)
+        self.__update_journal(snapshot_updates)
+        if new_terms is not None:
+            self.__update_term_index(new_terms)
         self.docsearch.reload_searcher()
         if self.__need_reload:
             logger.info("Index: Reloading ...")
             self.docsearch.reload_index(progress_cb=self.progress_cb)
 
+    def __get_new_terms(self):
+        """
+        Returns:
+            (terms, text digests) --- the terms of the added and updated
+                documents that are not in the index yet, and the digests of
+                their texts. None if the trigram index of the terms is not
+                used.
+        """
+        terms = self.__terms
+        if terms is None:
+            return None
+        text_digests = self.__text_digests
+        self.__terms = set()
+        self.__text_digests = []
+        if len(terms) <= 0:
+            return ([], text_digests)
+        with self.docsearch.index.reader() as reader:
+            terms = [term for term in terms
+                     if not ("content", term) in reader]
+        return (terms, text_digests)
+
+    def __update_term_index(self, new_terms):
+        """
+        Add the new terms to the trigram index of the terms, and write them
+        """
+        term_index = self.docsearch.term_index
+        if term_index.generation != self.__generation:
+            # the trigram index doesn't match the index we started from
+            # (another updater committed in the meantime ?) --> we don't
+            # know what it lacks
+            logger.warning("Trigram index of the terms is not up-to-date."
+                           " Rebuilding it")
+            self.docsearch.rebuild_term_index()
+            return
+        (terms, text_digests) = new_terms
+        term_index.add_terms(terms, text_digests)
+        # usually cheap: only the changes are appended to the disk
+        term_index.save(self.docsearch.index.latest_generation())
+
     def cancel(self):
         """
         Forget about the changes
         """
         logger.info("Index: Index update cancelled")
+        self.__pending_docs = {}
+        self.__snapshot_updates = {}
+        self.page_writer.cancel()
+        del self.page_writer
         self.writer.cancel()
         del self.writer
 
 
+class LabelBatch(object):
+    """
+    Accumulate label changes on many documents, and apply them all at once:
+    each label file is written once, and the index is committed only once
+    every 'flush_size' documents (and when the batch ends).
+
+    Use it as a context manager (see DocSearch.label_batch()):
+
+        with docsearch.label_batch() as batch:
+            for doc in docs:
+                batch.add_label(doc, label)
+
+    If an exception is raised in the 'with' block, the changes not flushed
+    yet are dropped.
+    """
+
+    DEFAULT_FLUSH_SIZE = 200
+
+    def __init__(self, docsearch, progress_cb=dummy_progress_cb,
+                 flush_size=DEFAULT_FLUSH_SIZE, step=None):
+        self.docsearch = docsearch
+        self.progress_cb = progress_cb
+        self.flush_size = flush_size
+        if step is None:
+            step = DocSearch.LABEL_STEP_UPDATING
+        self.step = step
+        self.__pending = {}  # docid --> (doc, new list of labels)
+        self.__order = []  # docids, in the order they were first modified
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.cancel()
+        return False
+
+    def __get_labels(self, doc):
+        if doc.docid in self.__pending:
+            return self.__pending[doc.docid][1]
+        return list(doc.labels)
+
+    def __set_labels(self, doc, labels):
+        if not doc.docid in self.__pending:
+            self.__order.append(doc.docid)
+        self.__pending[doc.docid] = (doc, labels)
+        if len(self.__pending) >= self.flush_size:
+            self.flush()
+
+    def add_label(self, doc, label):
+        """
+        Add a label on a document
+        """
+        label = copy.copy(label)
+        if not label in self.docsearch.label_list:
+            self.docsearch.label_list.append(label)
+            self.docsearch.label_list.sort()
+        labels = self.__get_labels(doc)
+        if label in labels:
+            return
+        labels.append(label)
+        self.__set_labels(doc, labels)
+
+    def remove_label(self, doc, label):
+        """
+        Remove a label from a document
+        """
+        labels = self.__get_labels(doc)
+        if not label in labels:
+            return
+        labels.remove(label)
+        self.__set_labels(doc, labels)
+
+    def update_label(self, doc, old_label, new_label):
+        """
+        Replace 'old_label' by 'new_label' on a document
+        """
+        labels = self.__get_labels(doc)
+        if not old_label in labels:
+            return
+        labels.remove(old_label)
+        if not new_label in labels:
+            labels.append(copy.copy(new_label))
+        self.__set_labels(doc, labels)
+
+    def flush(self):
+        """
+        Write the pending changes in the index, and then in the label files:
+        if the index can't be updated, the label files are left untouched
+        """
+        if len(self.__pending) <= 0:
+            return
+        pending = [self.__pending[docid] for docid in self.__order]
+        self.__pending = {}
+        self.__order = []
+        logger.info("Labels: Writing the changes on %d documents"
+                    % len(pending))
+        docids = [doc.docid for (doc, labels) in pending]
+        with self.docsearch.writing_docs(docids):
+            updater = self.docsearch.get_index_updater(optimize=False)
+            try:
+                progress = 0
+                for (doc, labels) in pending:
+                    self.progress_cb(progress, len(pending), self.step, doc)
+                    updater.upd_doc(doc, labels)
+                    progress += 1
+            except:
+                updater.cancel()
+                raise
+            updater.commit()
+            # the journal is updated when leaving the guard: the documents
+            # won't be examined again because their label file has changed
+            for (doc, labels) in pending:
+                doc.labels = labels
+        self.progress_cb(1, 1, self.step)
+
+    def cancel(self):
+        """
+        Forget about the changes not flushed yet
+        """
+        self.__pending = {}
+        self.__order = []
+
+
 def is_dir_empty(dirpath):
     """
     Check if the specified directory is empty or not
@@ -294,6 +887,83 @@ def is_dir_empty(dirpath):
     return (len(os.listdir(dirpath)) <= 0)
 
 
+class _DocnumsCollector(whoosh.collectors.WrappingCollector):
+    """
+    Give to another collector only the matching documents among some given
+    ones: the matcher of the query skips directly from one of these documents
+    to the next one, the others are never looked at. Also remember the
+    document numbers of all the matching documents (see docnums).
+
+    Arguments:
+        child --- the collector actually collecting the results
+        docnums --- the document numbers to look at. If None, all the
+            matching documents are collected
+    """
+
+    def __init__(self, child, docnums=None):
+        whoosh.collectors.WrappingCollector.__init__(self, child)
+        self.__allowed = None
+        if docnums is not None:
+            self.__allowed = sorted(docnums)
+        self.docnums = set()
+
+    def prepare(self, top_searcher, q, context):
+        # the child collector may use the matcher (score, etc): we keep it
+        # on the current document
+        context = context.set(needs_current=True)
+        whoosh.collectors.WrappingCollector.prepare(self, top_searcher, q,
+                                                    context)
+        self.docnums = set()
+
+    def __get_allowed(self):
+        """
+        Yields the document numbers to look at in the current sub-searcher
+        (relative to it)
+        """
+        start = self.offset
+        end = self.offset + self.subsearcher.doc_count_all()
+        for docnum in self.__allowed:
+            if docnum >= end:
+                return
+            if docnum >= start:
+                yield docnum - start
+
+    def matches(self):
+        matcher = self.child.matcher
+        if self.__allowed is None:
+            while matcher.is_active():
+                yield matcher.id()
+                matcher.next()
+            return
+        for sub_docnum in self.__get_allowed():
+            if not matcher.is_active():
+                return
+            if matcher.id() < sub_docnum:
+                matcher.skip_to(sub_docnum)
+                if not matcher.is_active():
+                    return
+            if matcher.id() == sub_docnum:
+                yield sub_docnum
+
+    def collect(self, sub_docnum):
+        self.docnums.add(self.offset + sub_docnum)
+        return self.child.collect(sub_docnum)
+
+    def all_ids(self):
+        return self.docnums
+
+    def count(self):
+        return len(self.docnums)
+
+    def results(self):
+        results = self.child.results()
+        # the number of results is ours, not the one of the child (it may
+        # think it has to run the whole query again to count them)
+        results.collector = self
+        results.docset = self.docnums
+        return results
+
+
 class DocSearch(object):
     """
     Index a set of documents. Can provide:
@@ -309,7 +979,18 @@ class DocSearch(object):
     INDEX_STEP_COMMIT = "commit"
     LABEL_STEP_UPDATING = "label updating"
     LABEL_STEP_DESTROYING = "label deletion"
-    OCR_THREADS_POLLING_TIME = 0.5
+
+    SORT_BY_RELEVANCE = "relevance"
+    SORT_BY_DATE = "date"
+    # most recent first (with reverse=True). Documents of the same day are
+    # sorted by id (the id includes the time)
+    __DATE_FACET = whoosh.sorting.MultiFacet(["date", "docid"])
+
+    # maximum number of search results kept in cache
+    QUERY_CACHE_SIZE = 64
+    # the documents matching the last search are remembered only if there
+    # aren't more than that (see __search())
+    LAST_SEARCH_MAX_DOCS = 50000
     WHOOSH_SCHEMA = whoosh.fields.Schema(
         docid=whoosh.fields.ID(stored=True, unique=True),
         doctype=whoosh.fields.ID(stored=True, unique=False),
@@ -319,8 +1000,24 @@ class DocSearch(object):
         date=whoosh.fields.DATETIME(stored=True),  # document date
         last_read=whoosh.fields.DATETIME(stored=True),
     )
-
-    def __init__(self, rootdir, callback=dummy_progress_cb):
+    # Page index: one entry per page. Used to know which pages of a document
+    # match a search, without reading them
+    PAGE_INDEX_DIR = "pages"
+    WHOOSH_PAGE_SCHEMA = whoosh.fields.Schema(
+        pageid=whoosh.fields.ID(stored=True, unique=True),
+        docid=whoosh.fields.ID(stored=True),
+        page_nb=whoosh.fields.NUMERIC(stored=True),
+        content=whoosh.fields.TEXT(),
+    )
+    # Optional field: beginnings of the words of the content field, so
+    # partial words can be looked for with a simple term lookup instead of a
+    # prefix expansion over all the terms of the content field
+    PREFIX_FIELD = "content_prefix"
+    PREFIX_MIN_LEN = 2
+    PREFIX_MAX_LEN = 15
+
+    def __init__(self, rootdir, callback=dummy_progress_cb,
+                 prefix_search=False, fuzzy_search=False):
         """
         Index files in rootdir (see constructor)
 
@@ -332,8 +1029,15 @@ class DocSearch(object):
                 total : number of elements to do
                 document (only if step == DocSearch.INDEX_STEP_READING): file
                     being read
+            prefix_search --- if True, the last word of the searches is
+                considered as the beginning of a word. Changing this setting
+                requires rebuilding the index (done automatically)
+            fuzzy_search --- if True, the words of the searches also match
+                the words close to them (OCR errors). Requires a trigram
+                index of the terms (see TermTrigramIndex)
         """
         self.rootdir = rootdir
+        self.prefix_search = prefix_search
         base_indexdir = os.getenv("XDG_DATA_HOME",
                                   os.path.expanduser("~/.local/share"))
         self.indexdir = os.path.join(base_indexdir, "paperwork", "index")
@@ -341,33 +1045,125 @@ class DocSearch(object):
 
         self.__docs_by_id = {}  # docid --> doc
         self.label_list = []
-
-        need_index_rewrite = True
-        try:
-            logger.info("Opening index dir '%s' ..." % self.indexdir)
-            self.index = whoosh.index.open_dir(self.indexdir)
-            # check that the schema is up-to-date
-            # We use the string representation of the schemas, because previous
-            # versions of whoosh don't always implement __eq__
-            if str(self.index.schema) == str(self.WHOOSH_SCHEMA):
-                need_index_rewrite = False
-        except whoosh.index.EmptyIndexError, exc:
-            logger.warning("Failed to open index '%s'" % self.indexdir)
-            logger.warning("Exception was: %s" % str(exc))
+        # incremented each time the content of the index changes
+        self.generation = 0
+        # normalized query --> (generation, [(docid, doctype)])
+        self.__query_cache = collections.OrderedDict()
+        self.__query_cache_lock = threading.Lock()
+        self.__corrector = None  # (generation, corrector)
+        # all the documents, most recent first
+        self.__date_order = None  # (generation, [(docid, doctype)])
+        # last search run on the index: (searcher, query, set of docnums)
+        self.__last_search = None
+        # watcher of the work directory (see watcher.DocDirWatcher), set by
+        # whoever runs it
+        self.watcher = None
+
+        self.page_indexdir = os.path.join(self.indexdir, self.PAGE_INDEX_DIR)
+        mkdir_p(self.page_indexdir)
+
+        schema = self.get_whoosh_schema(prefix_search)
+        page_schema = self.get_whoosh_schema(prefix_search,
+                                             self.WHOOSH_PAGE_SCHEMA)
+        self.index = self.__open_index(self.indexdir, schema)
+        self.page_index = self.__open_index(self.page_indexdir, page_schema)
+        # both indexes must contain the same documents
+        need_index_rewrite = (self.index is None or self.page_index is None)
 
         if need_index_rewrite:
             logger.info("Creating a new index")
-            self.index = whoosh.index.create_in(self.indexdir,
-                                                self.WHOOSH_SCHEMA)
+            self.index = whoosh.index.create_in(self.indexdir, schema)
+            self.page_index = whoosh.index.create_in(self.page_indexdir,
+                                                     page_schema)
             logger.info("Index '%s' created" % self.indexdir)
 
+        self.snapshot = DocSnapshot(self.indexdir)
+        self.journal = DocDirJournal(self.indexdir, self.rootdir)
+        if not need_index_rewrite:
+            self.snapshot.load()
+            self.journal.load()
+
+        self.term_index = None
+        if fuzzy_search:
+            self.__load_term_index(need_index_rewrite)
+
         self.__qparser = whoosh.qparser.QueryParser("content",
                                                     self.index.schema)
         self.__searcher = self.index.searcher()
+        self.__page_searcher = self.__get_page_searcher()
         self.check_workdir()
         self.cleanup_rootdir(callback)
         self.reload_index(callback)
 
+    @staticmethod
+    def __open_index(indexdir, schema):
+        """
+        Returns:
+            The index in indexdir. None if there is none or if its schema is
+            not the expected one
+        """
+        try:
+            logger.info("Opening index dir '%s' ..." % indexdir)
+            index = whoosh.index.open_dir(indexdir)
+        except whoosh.index.EmptyIndexError, exc:
+            logger.warning("Failed to open index '%s'" % indexdir)
+            logger.warning("Exception was: %s" % str(exc))
+            return None
+        # check that the schema is up-to-date
+        # We use the string representation of the schemas, because previous
+        # versions of whoosh don't always implement __eq__
+        if str(index.schema) != str(schema):
+            logger.info("Index '%s' has an old schema" % indexdir)
+            return None
+        return index
+
+    def __get_page_searcher(self):
+        # scores = number of occurences of the searched terms in the pages
+        return self.page_index.searcher(weighting=whoosh.scoring.Frequency())
+
+    @classmethod
+    def get_whoosh_schema(cls, prefix_search=False, base_schema=None):
+        """
+        Arguments:
+            base_schema --- WHOOSH_SCHEMA (default) or WHOOSH_PAGE_SCHEMA
+
+        Returns:
+            The schema of the index (base schema + the optional fields)
+        """
+        if base_schema is None:
+            base_schema = cls.WHOOSH_SCHEMA
+        schema = base_schema.copy()
+        if prefix_search:
+            schema.add(cls.PREFIX_FIELD, whoosh.fields.NGRAMWORDS(
+                minsize=cls.PREFIX_MIN_LEN, maxsize=cls.PREFIX_MAX_LEN,
+                at='start'))
+        return schema
+
+    def __load_term_index(self, need_index_rewrite):
+        """
+        Load the trigram index of the terms. Rebuild it from the terms of the
+        index if it's missing or not up-to-date.
+        """
+        self.term_index = TermTrigramIndex(self.indexdir)
+        generation = self.index.latest_generation()
+        if (not need_index_rewrite and self.term_index.load()
+                and self.term_index.generation == generation):
+            return
+        self.rebuild_term_index()
+
+    def rebuild_term_index(self):
+        """
+        Rebuild the trigram index of the terms from the terms of the index,
+        and write it
+        """
+        logger.info("Building the trigram index of the terms ...")
+        generation = self.index.latest_generation()
+        with self.index.reader() as reader:
+            self.term_index.rebuild([term.decode('utf-8')
+                                     for term in reader.lexicon("content")])
+        self.term_index.save(generation)
+        logger.info("%d terms in the trigram index" % len(self.term_index))
+
     def __must_clean(self, filepath):
         must_clean_cbs = [
             is_dir_empty,
@@ -410,7 +1206,7 @@ class DocSearch(object):
         """
         return DocDirExaminer(self)
 
-    def get_index_updater(self, optimize=True):
+    def get_index_updater(self, optimize=True, parallel=False):
         """
         Return an object useful to update the content of the index
 
@@ -418,8 +1214,13 @@ class DocSearch(object):
         made to modify the documents themselves.
         Some helper methods, with more specific goals, may be available for
         what you want to do.
+
+        Arguments:
+            parallel --- if True, the text of the documents will be extracted
+                by a pool of processes when committing. Only worth it when
+                (re)indexing a lot of documents.
         """
-        return DocIndexUpdater(self, optimize)
+        return DocIndexUpdater(self, optimize, parallel=parallel)
 
     def __inst_doc_from_id(self, docid, doc_type_name=None):
         """
@@ -442,6 +1243,24 @@ class DocSearch(object):
         logger.warn("Warning: unknown doc type for doc %s" % docid)
         return None
 
+    def __inst_doc_from_snapshot(self, docid):
+        """
+        Instantiate a document based on what the document snapshot knows
+        about it. Doesn't touch the disk.
+        """
+        metadata = self.snapshot.get(docid)
+        if metadata is None:
+            return None
+        (doctype, labels, nb_pages, last_mod) = metadata
+        for (is_doc_type, doc_type_name, doc_type) in DOC_TYPE_LIST:
+            if doc_type_name == doctype:
+                doc = doc_type(os.path.join(self.rootdir, docid), docid)
+                if labels is not None:
+                    labels = [Label(name, color) for (name, color) in labels]
+                doc.preload_cache(labels=labels, nb_pages=nb_pages)
+                return doc
+        return None
+
     def get_doc_from_docid(self, docid, doc_type_name=None):
         """
         Try to find a document based on its document id. If it hasn't been
@@ -449,28 +1268,28 @@ class DocSearch(object):
         """
         if docid in self.__docs_by_id:
             return self.__docs_by_id[docid]
-        doc = self.__inst_doc_from_id(docid, doc_type_name)
+        doc = self.__inst_doc_from_snapshot(docid)
+        if doc is None:
+            doc = self.__inst_doc_from_id(docid, doc_type_name)
         if doc is None:
             return None
         self.__docs_by_id[docid] = doc
         return doc
 
-    def reload_index(self, progress_cb=dummy_progress_cb):
+    def __rebuild_snapshot(self, progress_cb=dummy_progress_cb):
         """
-        Read the index, and load the document list from it
+        Rebuild the document snapshot by reading the index and looking at
+        each document
         """
-        docs_by_id = self.__docs_by_id
-        self.__docs_by_id = {}
-        for doc in docs_by_id.values():
-            doc.drop_cache()
-        del docs_by_id
+        logger.info("Rebuilding the document snapshot ...")
+        self.snapshot.clear()
+        generation = self.index.latest_generation()
 
         query = whoosh.query.Every()
         results = self.__searcher.search(query, limit=None)
 
         nb_results = len(results)
         progress = 0
-        labels = set()
 
         for result in results:
             docid = result['docid']
@@ -480,12 +1299,49 @@ class DocSearch(object):
                 continue
             progress_cb(progress, nb_results, self.INDEX_STEP_LOADING, doc)
             self.__docs_by_id[docid] = doc
-            for label in doc.labels:
+            labels = [(label.name, label.get_color_str())
+                      for label in doc.labels]
+            last_mod = _datetime_to_timestamp(result['last_read'])
+            self.snapshot.set(docid, (doctype, labels, None, last_mod))
+            progress += 1
+
+        self.snapshot.save(generation)
+
+    def reload_index(self, progress_cb=dummy_progress_cb):
+        """
+        Read the document snapshot (or the index if the snapshot is outdated),
+        and load the document list from it. Documents are only instantiated
+        when requested.
+        """
+        docs_by_id = self.__docs_by_id
+        self.__docs_by_id = {}
+        for doc in docs_by_id.values():
+            doc.drop_cache()
+        del docs_by_id
+
+        if self.snapshot.generation != self.index.latest_generation():
+            self.__rebuild_snapshot(progress_cb)
+
+        docids = self.snapshot.docids
+        progress = 0
+        labels = set()  # (name, color)
+
+        for docid in docids:
+            progress_cb(progress, len(docids), self.INDEX_STEP_LOADING)
+            (doctype, doc_labels) = self.snapshot.get(docid)[:2]
+            if doc_labels is None:
+                # outdated metadata --> we have to look at the document
+                doc = self.get_doc_from_docid(docid, doctype)
+                if doc is None:
+                    continue
+                doc_labels = [(label.name, label.get_color_str())
+                              for label in doc.labels]
+            for label in doc_labels:
                 labels.add(label)
             progress += 1
         progress_cb(1, 1, self.INDEX_STEP_LOADING)
 
-        self.label_list = [label for label in labels]
+        self.label_list = [Label(name, color) for (name, color) in labels]
         self.label_list.sort()
 
     def index_page(self, page):
@@ -505,26 +1361,203 @@ class DocSearch(object):
             assert(page.doc is not None)
             self.__docs_by_id[page.doc.docid] = page.doc
 
+    def __get_cached_results(self, key):
+        """
+        Arguments:
+            key --- normalized sentence, or (normalized sentence, sort_by,
+                page_nb, page_len) for a page of results
+
+        Returns:
+            The results of the search if they are in cache and still valid.
+            None otherwise.
+        """
+        with self.__query_cache_lock:
+            cached = self.__query_cache.pop(key, None)
+            if cached is None or cached[0] != self.generation:
+                return None
+            # most recently used --> end of the list
+            self.__query_cache[key] = cached
+            return cached[1]
+
+    def __cache_results(self, key, generation, results):
+        with self.__query_cache_lock:
+            if generation != self.generation:
+                # the index has changed during the search
+                return
+            self.__query_cache.pop(key, None)
+            self.__query_cache[key] = (generation, results)
+            while len(self.__query_cache) > self.QUERY_CACHE_SIZE:
+                self.__query_cache.popitem(last=False)
+
+    @staticmethod
+    def __get_subqueries(query):
+        """
+        Returns:
+            The terms and prefixes that a document must all match to match
+            the query. None if the query is not that simple (OR, NOT,
+            phrases, ...).
+        """
+        if isinstance(query, whoosh.query.And):
+            subqueries = query.subqueries
+        else:
+            subqueries = [query]
+        for subquery in subqueries:
+            if not isinstance(subquery, (whoosh.query.Term,
+                                         whoosh.query.Prefix)):
+                return None
+        return subqueries
+
+    def __rewrite_subquery(self, subquery, is_last):
+        """
+        See __parse()
+        """
+        if subquery.fieldname != "content":
+            return subquery
+        if (self.prefix_search
+                and (is_last or isinstance(subquery, whoosh.query.Prefix))):
+            if (self.PREFIX_MIN_LEN <= len(subquery.text)
+                    <= self.PREFIX_MAX_LEN):
+                return whoosh.query.Term(self.PREFIX_FIELD, subquery.text)
+            if len(subquery.text) > self.PREFIX_MAX_LEN:
+                # longer than what is in the prefix field. Few terms can
+                # start like that anyway
+                return whoosh.query.Prefix("content", subquery.text)
+            return subquery
+        if (self.term_index is not None
+                and not isinstance(subquery, whoosh.query.Prefix)):
+            terms = self.term_index.get_similar_terms(subquery.text)
+            if len(terms) > 0:
+                return whoosh.query.Or(
+                    [subquery] + [whoosh.query.Term("content", term)
+                                  for term in terms])
+        return subquery
+
+    def __parse(self, sentence):
+        """
+        Parse a search sentence. If the prefix search is enabled, the last
+        word is looked for as the beginning of a word, and the explicit
+        prefixes ("invo*") are looked up in the prefix field. If the fuzzy
+        search is enabled, the other words also match the terms of the
+        index that are close to them (see TermTrigramIndex).
+        """
+        query = self.__qparser.parse(sentence)
+        if not self.prefix_search and self.term_index is None:
+            return query
+        subqueries = self.__get_subqueries(query)
+        if subqueries is None:
+            return query
+        subqueries = [self.__rewrite_subquery(subquery,
+                                              idx == len(subqueries) - 1)
+                      for (idx, subquery) in enumerate(subqueries)]
+        if isinstance(query, whoosh.query.And):
+            return whoosh.query.And(subqueries)
+        return subqueries[0]
+
+    def __get_search_conditions(self, query):
+        """
+        Returns:
+            The conditions that a document must all match to match the
+            query: [(fieldname, text, is_prefix)]. None if the query is not
+            that simple (OR, NOT, phrases, fuzzy search, ...).
+        """
+        subqueries = self.__get_subqueries(query)
+        if subqueries is None:
+            return None
+        conditions = []
+        for subquery in subqueries:
+            if isinstance(subquery, whoosh.query.Prefix):
+                conditions.append((subquery.fieldname, subquery.text, True))
+            elif subquery.fieldname == self.PREFIX_FIELD:
+                # see __rewrite_subquery()
+                conditions.append(("content", subquery.text, True))
+            else:
+                conditions.append((subquery.fieldname, subquery.text, False))
+        return conditions
+
+    @staticmethod
+    def __is_implied(condition, previous_condition):
+        """
+        Returns True if all the documents matching 'condition' match
+        'previous_condition' too
+        """
+        (fieldname, text, is_prefix) = condition
+        (previous_fieldname, previous_text, previous_is_prefix) = \
+            previous_condition
+        if fieldname != previous_fieldname:
+            return False
+        if previous_is_prefix:
+            # 'invo' --> 'invoi', 'invoice' or 'invoice shop'
+            return text.startswith(previous_text)
+        return not is_prefix and text == previous_text
+
+    def __get_refined_docnums(self, searcher, query):
+        """
+        When the user types, each new search usually narrows the previous one
+        (added words, or longer last word). In this case, only the documents
+        that matched the previous search can match.
+
+        Returns:
+            The document numbers of the documents that can match. None if
+            the query doesn't narrow the last one.
+        """
+        last_search = self.__last_search
+        if last_search is None or last_search[0] is not searcher:
+            return None
+        (_, previous_query, docnums) = last_search
+        conditions = self.__get_search_conditions(query)
+        previous_conditions = self.__get_search_conditions(previous_query)
+        if conditions is None or previous_conditions is None:
+            return None
+        for previous_condition in previous_conditions:
+            for condition in conditions:
+                if self.__is_implied(condition, previous_condition):
+                    break
+            else:
+                return None
+        return docnums
+
+    def __search(self, query, **kwargs):
+        """
+        Run a search on the index. If it narrows the previous one, only the
+        documents that matched the previous one are looked at (see
+        _DocnumsCollector). Otherwise, the whole index is searched.
+
+        Arguments:
+            kwargs --- see whoosh.searching.Searcher.collector()
+
+        Returns:
+            whoosh.searching.Results. len() gives the exact number of
+            matching documents.
+        """
+        searcher = self.__searcher
+        docnums = self.__get_refined_docnums(searcher, query)
+        if docnums is not None:
+            logger.debug("Search '%s' only looks at the %d documents of the"
+                         " previous one" % (query, len(docnums)))
+        collector = _DocnumsCollector(searcher.collector(**kwargs), docnums)
+        searcher.search_with_collector(query, collector)
+        if len(collector.docnums) <= self.LAST_SEARCH_MAX_DOCS:
+            self.__last_search = (searcher, query, collector.docnums)
+        else:
+            self.__last_search = None
+        return collector.results()
+
     def __find_documents(self, query):
         """
         Find a list of documents based on a whoosh query
+
+        Returns:
+            [(docid, doctype)]
         """
-        docs = []
-        results = self.__searcher.search(query, limit=None)
-        docids = [result['docid'] for result in results]
-        docs = [self.__docs_by_id.get(docid) for docid in docids]
-        try:
-            while True:
-                docs.remove(None)
-        except ValueError:
-            pass
-        assert (not None in docs)
-        return docs
+        results = self.__search(query, limit=None)
+        return [(result['docid'], result['doctype']) for result in results]
 
     def __get_all_docs(self):
         """
         Return all the documents. Beware, they are unsorted.
         """
+        for docid in self.snapshot.docids:
+            self.get_doc_from_docid(docid)
         return self.__docs_by_id.values()
 
     docs = property(__get_all_docs)
@@ -532,13 +1565,13 @@ class DocSearch(object):
     def get_by_id(self, obj_id):
         """
         Get a document or a page using its ID
-        Won't instantiate them if they are not yet available
+        Will instantiate them if they are not yet available
         """
         if "/" in obj_id:
             (docid, page_nb) = obj_id.split("/")
             page_nb = int(page_nb)
-            return self.__docs_by_id[docid].pages[page_nb]
-        return self.__docs_by_id[obj_id]
+            return self.get_doc_from_docid(docid).pages[page_nb]
+        return self.get_doc_from_docid(obj_id)
 
     def find_documents(self, sentence):
         """
@@ -548,17 +1581,120 @@ class DocSearch(object):
             keywords --- keywords (single string)
 
         Returns:
-            An array of document id (strings)
+            An array of documents. If the sentence is empty, all the
+            documents, most recent first.
         """
-        sentence = sentence.strip()
+        sentence = u" ".join(strip_accents(sentence).split())
 
         if sentence == u"":
-            return self.docs
+            results = self.__get_date_order()
+        else:
+            results = self.__get_cached_results(sentence)
+        if results is None:
+            generation = self.generation
+            query = self.__parse(sentence)
+            results = self.__find_documents(query)
+            self.__cache_results(sentence, generation, results)
+
+        docs = [self.get_doc_from_docid(docid, doctype)
+                for (docid, doctype) in results]
+        return [doc for doc in docs if doc is not None]
+
+    def __get_date_order(self):
+        """
+        Returns all the documents of the index, most recent first:
+        [(docid, doctype)]. The sorting is done by the index, and only done
+        again when the index changes.
+        """
+        date_order = self.__date_order
+        if date_order is None or date_order[0] != self.generation:
+            generation = self.generation
+            results = self.__searcher.search(whoosh.query.Every(), limit=None,
+                                             sortedby=self.__DATE_FACET,
+                                             reverse=True)
+            date_order = (generation,
+                          [(result['docid'], result['doctype'])
+                           for result in results])
+            self.__date_order = date_order
+        return date_order[1]
+
+    def __find_documents_page(self, query, page_nb, page_len, sort_by):
+        """
+        Returns:
+            ([(docid, doctype)], total number of matching documents)
+        """
+        kwargs = {}
+        if sort_by == self.SORT_BY_DATE:
+            kwargs = {'sortedby': self.__DATE_FACET, 'reverse': True}
+        # only the documents up to the end of the page are kept
+        results = self.__search(query, limit=(page_nb + 1) * page_len,
+                                **kwargs)
+        page = whoosh.searching.ResultsPage(results, page_nb + 1, page_len)
+        if page_nb * page_len >= page.total:
+            # past the end: ResultsPage would give us the last page
+            return ([], page.total)
+        return ([(hit['docid'], hit['doctype']) for hit in page], page.total)
+
+    def find_documents_page(self, sentence, page_nb, page_len,
+                            sort_by=SORT_BY_RELEVANCE):
+        """
+        Returns one page of the documents matching the given keywords. Only
+        the documents of this page are looked for and instantiated, so the
+        time it takes doesn't depend much on the total number of matching
+        documents.
 
-        sentence = strip_accents(sentence)
+        Arguments:
+            sentence --- keywords (single string). If empty, all the
+                documents are returned, sorted by date.
+            page_nb --- page number (starting at 0)
+            page_len --- number of documents per page
+            sort_by --- SORT_BY_RELEVANCE or SORT_BY_DATE
 
-        query = self.__qparser.parse(sentence)
-        return self.__find_documents(query)
+        Returns:
+            (documents of the page, total number of matching documents)
+        """
+        sentence = u" ".join(strip_accents(sentence).split())
+        if sentence == u"":
+            # the "show all the documents" view: no search required
+            date_order = self.__get_date_order()
+            page = date_order[page_nb * page_len:(page_nb + 1) * page_len]
+            total = len(date_order)
+        else:
+            key = (sentence, sort_by, page_nb, page_len)
+            results = self.__get_cached_results(key)
+            if results is None:
+                generation = self.generation
+                query = self.__parse(sentence)
+                results = self.__find_documents_page(query, page_nb, page_len,
+                                                     sort_by)
+                self.__cache_results(key, generation, results)
+            (page, total) = results
+
+        docs = [self.get_doc_from_docid(docid, doctype)
+                for (docid, doctype) in page]
+        return ([doc for doc in docs if doc is not None], total)
+
+    def find_page_hits(self, doc, sentence):
+        """
+        Find the pages of a document matching the given keywords, using
+        the page index (the pages are not read).
+
+        Returns:
+            { page number: number of occurences of the keywords in the page }
+            None if the document is not in the page index.
+        """
+        sentence = u" ".join(strip_accents(sentence).split())
+        if sentence == u"":
+            return {}
+        searcher = self.__page_searcher
+        docid = unicode(doc.docid)
+        if not ("docid", docid) in searcher.reader():
+            return None
+        query = whoosh.query.And([whoosh.query.Term("docid", docid),
+                                  self.__parse(sentence)])
+        results = searcher.search(query, limit=None)
+        # the docid term is counted too
+        return dict([(hit['page_nb'], int(hit.score) - 1) for hit in results])
 
     def find_suggestions(self, sentence):
         """
@@ -575,7 +1711,7 @@ class DocSearch(object):
         keywords = sentence.split(" ")
         final_suggestions = []
 
-        corrector = self.__searcher.corrector("content")
+        corrector = self.__get_corrector()
         for keyword_idx in range(0, len(keywords)):
             keyword = strip_accents(keywords[keyword_idx])
             if (len(keyword) <= MIN_KEYWORD_LEN):
@@ -585,12 +1721,61 @@ class DocSearch(object):
                 new_suggestion = keywords[:]
                 new_suggestion[keyword_idx] = keyword_suggestion
                 new_suggestion = u" ".join(new_suggestion)
-                if len(self.find_documents(new_suggestion)) <= 0:
+                if not self.__has_results(new_suggestion, keyword_suggestion):
                     continue
                 final_suggestions.append(new_suggestion)
         final_suggestions.sort()
         return final_suggestions
 
+    def __get_corrector(self):
+        """
+        Returns the spelling corrector of the content field. It is only
+        instantiated again when the index changes.
+        """
+        corrector = self.__corrector
+        if corrector is None or corrector[0] != self.generation:
+            corrector = (self.generation,
+                         self.__searcher.corrector("content"))
+            self.__corrector = corrector
+        return corrector[1]
+
+    def __has_results(self, sentence, new_keyword):
+        """
+        Check if at least one document matches the given sentence, without
+        looking for all of them
+
+        Arguments:
+            sentence --- the whole sentence
+            new_keyword --- keyword of the sentence that has just been
+                replaced by a suggestion
+        """
+        sentence = u" ".join(strip_accents(sentence).split())
+        if sentence == new_keyword:
+            # only one keyword: the term statistics are enough
+            reader = self.__searcher.reader()
+            return reader.doc_frequency("content", new_keyword) > 0
+        results = self.__get_cached_results(sentence)
+        if results is not None:
+            return len(results) > 0
+        query = self.__parse(sentence)
+        return not self.__searcher.search(query, limit=1).is_empty()
+
+    def label_batch(self, progress_cb=dummy_progress_cb,
+                    flush_size=LabelBatch.DEFAULT_FLUSH_SIZE, step=None):
+        """
+        Return an object useful to change the labels of many documents at
+        once (see LabelBatch). Use it as a context manager.
+
+        Arguments:
+            progress_cb --- See util.dummy_progress_cb. Called when the
+                changes are written
+            flush_size --- number of modified documents after which the
+                changes are written and the index committed
+            step --- step given to progress_cb (default:
+                LABEL_STEP_UPDATING)
+        """
+        return LabelBatch(self, progress_cb, flush_size, step)
+
     def add_label(self, doc, label):
         """
         Add a label on a document.
@@ -599,23 +1784,39 @@ class DocSearch(object):
             label --- The new label (see labels.Label)
             doc --- The first document on which this label has been added
         """
-        label = copy.copy(label)
-        if not label in self.label_list:
-            self.label_list.append(label)
-            self.label_list.sort()
-        doc.add_label(label)
-        updater = self.get_index_updater(optimize=False)
-        updater.upd_doc(doc)
-        updater.commit()
+        with self.label_batch() as batch:
+            batch.add_label(doc, label)
 
     def remove_label(self, doc, label):
         """
         Remove a label from a doc. Takes care of updating the index
         """
-        doc.remove_label(label)
-        updater = self.get_index_updater(optimize=False)
-        updater.upd_doc(doc)
-        updater.commit()
+        with self.label_batch() as batch:
+            batch.remove_label(doc, label)
+
+    def __find_docs_with_label(self, label):
+        """
+        Find the documents carrying a label, using the label field of the
+        index instead of looking at every document.
+
+        Returns:
+            A list of documents
+        """
+        # the label field is a comma-separated keyword field: a label name
+        # containing commas is indexed as several keywords
+        keywords = [strip_accents(keyword).strip()
+                    for keyword in label.name.split(u",")]
+        query = whoosh.query.And([whoosh.query.Term("label", keyword)
+                                  for keyword in keywords if keyword != u""])
+        with self.index.searcher() as searcher:
+            results = searcher.search(query, limit=None)
+            docs = [self.get_doc_from_docid(result['docid'],
+                                            result['doctype'])
+                    for result in results]
+        # the index may not be up-to-date (and the label colors are not in
+        # it) --> check them
+        return [doc for doc in docs
+                if doc is not None and label in doc.labels]
 
     def update_label(self, old_label, new_label, callback=dummy_progress_cb):
         """
@@ -626,17 +1827,13 @@ class DocSearch(object):
         if new_label not in self.label_list:
             self.label_list.append(new_label)
             self.label_list.sort()
-        current = 0
-        total = len(self.docs)
-        updater = self.get_index_updater(optimize=False)
-        for doc in self.docs:
-            must_reindex = (old_label in doc.labels)
-            callback(current, total, self.LABEL_STEP_UPDATING, doc)
-            doc.update_label(old_label, new_label)
-            if must_reindex:
-                updater.upd_doc(doc)
-            current += 1
-        updater.commit()
+        docs = self.__find_docs_with_label(old_label)
+        logger.info("Label [%s] is on %d documents"
+                    % (old_label.name, len(docs)))
+        with self.label_batch(callback, max(1, len(docs)),
+                              self.LABEL_STEP_UPDATING) as batch:
+            for doc in docs:
+                batch.update_label(doc, old_label, new_label)
 
     def destroy_label(self, label, callback=dummy_progress_cb):
         """
@@ -644,18 +1841,13 @@ class DocSearch(object):
         the index.
         """
         self.label_list.remove(label)
-        current = 0
-        docs = self.docs
-        total = len(docs)
-        updater = self.get_index_updater(optimize=False)
-        for doc in docs:
-            must_reindex = (label in doc.labels)
-            callback(current, total, self.LABEL_STEP_DESTROYING, doc)
-            doc.remove_label(label)
-            if must_reindex:
-                updater.upd_doc(doc)
-            current += 1
-        updater.commit()
+        docs = self.__find_docs_with_label(label)
+        logger.info("Label [%s] is on %d documents"
+                    % (label.name, len(docs)))
+        with self.label_batch(callback, max(1, len(docs)),
+                              self.LABEL_STEP_DESTROYING) as batch:
+            for doc in docs:
+                batch.remove_label(doc, label)
 
     def reload_searcher(self):
         """
@@ -667,6 +1859,31 @@ class DocSearch(object):
         searcher = self.__searcher
         self.__searcher = self.index.searcher()
         del(searcher)
+        searcher = self.__page_searcher
+        self.__page_searcher = self.__get_page_searcher()
+        del(searcher)
+        with self.__query_cache_lock:
+            self.generation += 1
+            self.__query_cache.clear()
+
+    def writing_docs(self, docids):
+        """
+        Return an object to use with 'with' around the changes Paperwork
+        itself makes to the given documents: the watcher of the work
+        directory (if any) doesn't report them, and the journal is updated
+        once they are done (see watcher.DocWriteGuard)
+        """
+        return DocWriteGuard(self.watcher, docids, self.journal)
+
+    def get_ocr_redoer(self):
+        """
+        Return an object useful to redo the OCR of many documents, in an
+        interruptible way. It works on a queue of pages kept in the index
+        directory: it resumes what was interrupted previously. Always the
+        same object for a given index directory (see
+        ocrqueue.get_ocr_redoer())
+        """
+        return get_ocr_redoer(self)
 
     def redo_ocr(self, langs, progress_callback=dummy_progress_cb):
         """
@@ -675,34 +1892,14 @@ class DocSearch(object):
 
         Arguments:
             progress_callback --- See util.dummy_progress_cb for a
-                prototype. The only step returned is "INDEX_STEP_READING"
+                prototype. The only step returned is "SCAN_STEP_OCR"
             langs --- Languages to use with the spell checker and the OCR tool
                 ( { 'ocr' : 'fra', 'spelling' : 'fr' } )
         """
         logger.info("Redoing OCR of all documents ...")
-
-        dlist = self.docs
-        threads = []
-        remaining = dlist[:]
-
-        max_threads = multiprocessing.cpu_count()
-
-        while (len(remaining) > 0 or len(threads) > 0):
-            for thread in threads:
-                if not thread.is_alive():
-                    threads.remove(thread)
-            while (len(threads) < max_threads and len(remaining) > 0):
-                doc = remaining.pop()
-                if not doc.can_edit:
-                    continue
-                thread = threading.Thread(target=doc.redo_ocr,
-                                          args=[langs], name=doc.docid)
-                thread.start()
-                threads.append(thread)
-                progress_callback(len(dlist) - len(remaining),
-                                  len(dlist), self.INDEX_STEP_READING,
-                                  doc)
-            time.sleep(self.OCR_THREADS_POLLING_TIME)
+        ocr_redoer = self.get_ocr_redoer()
+        ocr_redoer.add_docs(self.docs, langs)
+        ocr_redoer.run(progress_callback)
         logger.info("OCR of all documents done")
 
     def destroy_index(self):
@@ -0,0 +1,139 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2012  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Snapshot of the metadata of the indexed documents, stored next to the index.
+It allows to rebuild the document list and the label list without looking at
+each document in the work directory.
+"""
+
+import cPickle
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class DocSnapshot(object):
+    """
+    docid --> (doctype, labels, nb_pages, last_mod)
+
+    labels is a list of (label name, label color string) tuples.
+    labels, nb_pages and last_mod may be None if they are unknown or if they
+    can't be trusted anymore (see invalidate()).
+
+    The snapshot is only valid for the index generation it was saved with.
+    """
+
+    VERSION = 1
+    FILENAME = "docs.snapshot"
+
+    def __init__(self, indexdir):
+        self.filepath = os.path.join(indexdir, self.FILENAME)
+        self.generation = None
+        self.__docs = {}
+
+    def load(self):
+        """
+        Load the snapshot from the disk
+
+        Returns:
+            True if a valid snapshot has been loaded
+        """
+        try:
+            with open(self.filepath, 'rb') as file_desc:
+                content = cPickle.load(file_desc)
+            if content['version'] != self.VERSION:
+                logger.info("Snapshot '%s' has an old version (%d). Ignored"
+                            % (self.filepath, content['version']))
+                return False
+            self.generation = content['generation']
+            self.__docs = content['docs']
+        except IOError, exc:
+            logger.info("No document snapshot available: %s" % str(exc))
+            return False
+        except Exception, exc:
+            logger.warning("Failed to read document snapshot '%s': %s"
+                           % (self.filepath, str(exc)))
+            return False
+        logger.info("Document snapshot loaded: %d documents (generation %d)"
+                    % (len(self.__docs), self.generation))
+        return True
+
+    def save(self, generation):
+        """
+        Write the snapshot on the disk
+
+        Arguments:
+            generation --- generation of the index matching this snapshot
+        """
+        self.generation = generation
+        content = {
+            'version': self.VERSION,
+            'generation': generation,
+            'docs': self.__docs,
+        }
+        tmp_filepath = self.filepath + ".tmp"
+        try:
+            with open(tmp_filepath, 'wb') as file_desc:
+                cPickle.dump(content, file_desc, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filepath, self.filepath)
+        except (IOError, OSError), exc:
+            logger.warning("Failed to write document snapshot '%s': %s"
+                           % (self.filepath, str(exc)))
+
+    def clear(self):
+        self.generation = None
+        self.__docs = {}
+
+    def __get_docids(self):
+        return self.__docs.keys()
+
+    docids = property(__get_docids)
+
+    def __contains__(self, docid):
+        return docid in self.__docs
+
+    def __len__(self):
+        return len(self.__docs)
+
+    def get(self, docid):
+        """
+        Returns:
+            (doctype, labels, nb_pages, last_mod), or None if the document is
+            not in the snapshot
+        """
+        return self.__docs.get(docid)
+
+    def set(self, docid, metadata):
+        """
+        Arguments:
+            metadata --- (doctype, labels, nb_pages, last_mod), or None if
+                the document has been removed from the index
+        """
+        if metadata is None:
+            self.__docs.pop(docid, None)
+        else:
+            self.__docs[docid] = metadata
+
+    def invalidate(self, docid):
+        """
+        The document has been modified: only its type can still be trusted
+        """
+        metadata = self.__docs.get(docid)
+        if metadata is None:
+            return
+        self.__docs[docid] = (metadata[0], None, None, None)
@@ -22,93 +22,24 @@ Code relative to page handling.
 import codecs
 from copy import copy
 import PIL.Image
-import multiprocessing
 import os
 import os.path
-import re
-import threading
-import time
 
 import logging
 from gi.repository import Gtk
 import pyocr.builders
-import pyocr.pyocr
 
+from paperwork.backend import ocr
+from paperwork.backend.common import boxes as boxfiles
 from paperwork.backend.common.page import BasicPage
 from paperwork.backend.common.page import PageExporter
 from paperwork.backend.config import PaperworkConfig
-from paperwork.util import check_spelling
 from paperwork.util import dummy_progress_cb
 from paperwork.util import image2surface
 
 logger = logging.getLogger(__name__)
 
 
-class ImgOCRThread(threading.Thread):
-    def __init__(self, name, ocr_tool, langs, img, compute_score=True):
-        threading.Thread.__init__(self, name="OCR")
-        self.name = name
-        self.ocr_tool = ocr_tool
-        self.langs = langs
-        self.img = img
-        self.compute_score = compute_score
-        self.score = -1
-        self.text = None
-
-    def __compute_ocr_score_with_spell_checking(self, txt):
-        return check_spelling(self.langs['spelling'], txt)
-
-    @staticmethod
-    def __compute_ocr_score_without_spell_checking(txt):
-        """
-        Try to evaluate how well the OCR worked.
-        Current implementation:
-            The score is the number of words only made of 4 or more letters
-            ([a-zA-Z])
-        """
-        # TODO(Jflesch): i18n / l10n
-        score = 0
-        prog = re.compile(r'^[a-zA-Z]{4,}$')
-        for word in txt.split(" "):
-            if prog.match(word):
-                score += 1
-        return (txt, score)
-
-    def run(self):
-        SCORE_METHODS = [
-            ("spell_checker", self.__compute_ocr_score_with_spell_checking),
-            ("lucky_guess", self.__compute_ocr_score_without_spell_checking),
-            ("no_score", lambda txt: (txt, 0))
-        ]
-
-        logger.info("Running OCR on page orientation %s" % self.name)
-        self.text = self.ocr_tool.image_to_string(
-            self.img, lang=self.langs['ocr'])
-
-        if not self.compute_score:
-            self.score = 0
-            return
-
-        for score_method in SCORE_METHODS:
-            try:
-                logger.info("Evaluating score of page orientation (%s)"
-                             " using method '%s' ..."
-                             % (self.name, score_method[0]))
-                (fixed_text, self.score) = score_method[1](self.text)
-                # TODO(Jflesch): For now, we throw away the fixed version:
-                # The original version may contain proper nouns, and spell
-                # checking could make them disappear
-                # However, it would be best if we could keep both versions
-                # without increasing too much indexation time
-                logger.info("Page orientation %s score: %d"
-                             % (self.name, self.score))
-                return
-            except Exception, exc:
-                logger.error("Scoring method '%s' on orientation %s failed !"
-                             % (score_method[0], self.name))
-                logger.error("Reason: %s" % exc)
-
-
 class ImgPage(BasicPage):
     """
     Represents a page. A page is a sub-element of ImgDoc.
@@ -116,6 +47,7 @@ class ImgPage(BasicPage):
     FILE_PREFIX = "paper."
     EXT_TXT = "txt"
     EXT_BOX = "words"
+    EXT_BOX_BIN = "boxes"
     EXT_IMG_SCAN = "bmp"
     EXT_IMG = "jpg"
     EXT_THUMB = "thumb.jpg"
@@ -125,12 +57,27 @@ class ImgPage(BasicPage):
     ORIENTATION_PORTRAIT = 0
     ORIENTATION_LANDSCAPE = 1
 
-    OCR_THREADS_POLLING_TIME = 0.1
+    # Below this confidence, the orientation detected by the OCR tool is
+    # ignored and the orientation is guessed by running the OCR on the 4
+    # orientations of the page
+    ORIENTATION_MIN_CONFIDENCE = 2.0
+    # PIL.Image.transpose() method to apply to straighten an image, based on
+    # the angle (counter-clockwise) returned by detect_orientation()
+    ORIENTATION_TRANSPOSES = {
+        90: PIL.Image.ROTATE_90,
+        180: PIL.Image.ROTATE_180,
+        270: PIL.Image.ROTATE_270,
+    }
 
     def __init__(self, doc, page_nb=None):
         if page_nb is None:
             page_nb = doc.nb_pages
         BasicPage.__init__(self, doc, page_nb)
+        self.__boxes_cache = (None, None)  # (boxes, box file mtime)
+
+    def drop_cache(self):
+        BasicPage.drop_cache(self)
+        self.__boxes_cache = (None, None)
 
     def __get_filepath(self, ext):
         """
@@ -148,6 +95,24 @@ class ImgPage(BasicPage):
 
     __box_path = property(__get_box_path)
 
+    def __get_txt_path(self):
+        """
+        Returns the file path of the text corresponding to this page. This
+        file is a cache: the text can always be rebuilt from the boxes.
+        """
+        return self.__get_filepath(self.EXT_TXT)
+
+    __txt_path = property(__get_txt_path)
+
+    def __get_box_bin_path(self):
+        """
+        Returns the file path of the binary version of the box list (see
+        common.boxes). Like the text file, it's only a cache.
+        """
+        return self.__get_filepath(self.EXT_BOX_BIN)
+
+    __box_bin_path = property(__get_box_bin_path)
+
     def __get_img_path(self):
         """
         Returns the file path of the image corresponding to this page
@@ -174,20 +139,102 @@ class ImgPage(BasicPage):
 
     def _get_text(self):
         """
-        Get the text corresponding to this page
+        Get the text corresponding to this page: one string per line.
+
+        The text file is used if it's up-to-date. Otherwise, the text is
+        extracted from the boxes and the text file is rewritten.
         """
+        txtfile = self.__txt_path
+        try:
+            if os.stat(txtfile).st_mtime >= self.last_mod:
+                with codecs.open(txtfile, 'r', encoding='utf-8') as file_desc:
+                    return file_desc.read().split(u"\n")
+        except (IOError, OSError):
+            pass
         boxes = self.boxes
-        txt = u""
-        for box in boxes:
-            txt += u" " + str(box).decode('utf-8')
-        return [txt]
+        if isinstance(boxes, boxfiles.BoxList):
+            txt = [boxes.get_line_content(line_idx)
+                   for line_idx in xrange(0, len(boxes))]
+        else:
+            txt = [line.content for line in boxes]
+        self.__write_txt(txt)
+        return txt
+
+    def __write_txt(self, txt):
+        """
+        Write the text file of this page
+
+        Arguments:
+            txt --- list of lines (see _get_text())
+        """
+        txtfile = self.__txt_path
+        try:
+            with codecs.open(txtfile, 'w', encoding='utf-8') as file_desc:
+                file_desc.write(u"\n".join(txt))
+        except IOError, exc:
+            logger.warning("Unable to write '%s': %s" % (txtfile, exc))
+
+    def __write_box_bin(self, boxes):
+        try:
+            boxfiles.write_box_file(self.__box_bin_path, boxes)
+        except (IOError, OSError), exc:
+            logger.warning("Unable to write '%s': %s"
+                           % (self.__box_bin_path, exc))
+
+    def __write_boxes(self, boxes):
+        """
+        Write the box file of this page, and the files that go with it
+        (text and binary boxes)
+        """
+        with codecs.open(self.__box_path, 'w', encoding='utf-8') as file_desc:
+            pyocr.builders.LineBoxBuilder().write_file(file_desc, boxes)
+        self.__write_box_bin(boxes)
+        self.__write_txt([line.content for line in boxes])
 
     def __get_boxes(self):
         """
         Get all the word boxes of this page.
+
+        They are kept in cache as long as the box file doesn't change.
         """
         boxfile = self.__box_path
 
+        try:
+            mtime = os.stat(boxfile).st_mtime
+        except OSError, exc:
+            logger.error("Unable to get boxes for '%s': %s"
+                    % (self.doc.docid, exc))
+            return []
+        (boxes, cache_mtime) = self.__boxes_cache
+        if boxes is not None and cache_mtime == mtime:
+            return boxes
+        boxes = self.__read_box_bin(mtime)
+        if boxes is None:
+            boxes = self.__read_boxes(boxfile)
+            if len(boxes) > 0 and isinstance(boxes[0], pyocr.builders.LineBox):
+                self.__write_box_bin(boxes)
+        self.__boxes_cache = (boxes, mtime)
+        return boxes
+
+    def __read_box_bin(self, box_mtime):
+        """
+        Load the binary version of the boxes, if it's up-to-date
+
+        Returns:
+            A common.boxes.BoxList, or None
+        """
+        binfile = self.__box_bin_path
+        try:
+            if os.stat(binfile).st_mtime < box_mtime:
+                return None
+            return boxfiles.read_box_file(binfile)
+        except OSError:
+            return None
+        except (IOError, boxfiles.BoxFileError), exc:
+            logger.warning("Unable to read '%s': %s" % (binfile, exc))
+            return None
+
+    def __read_boxes(self, boxfile):
         try:
             box_builder = pyocr.builders.LineBoxBuilder()
             with codecs.open(boxfile, 'r', encoding='utf-8') as file_desc:
@@ -208,9 +255,7 @@ class ImgPage(BasicPage):
             return []
 
     def __set_boxes(self, boxes):
-        boxfile = self.__box_path
-        with codecs.open(boxfile, 'w', encoding='utf-8') as file_desc:
-            pyocr.builders.LineBoxBuilder().write_file(file_desc, boxes)
+        self.__write_boxes(boxes)
         self.drop_cache()
         self.doc.drop_cache()
 
@@ -260,11 +305,11 @@ class ImgPage(BasicPage):
         except:
             return self.__make_thumbnail(width)
 
-    def __save_imgs(self, img, scan_res=0, scanner_calibration=None,
-                    callback=dummy_progress_cb):
+    def __prepare_img(self, img, scan_res=0, scanner_calibration=None,
+                      callback=dummy_progress_cb):
         """
-        Make a page, and generate 4 output images, one for each orientation.
-        OCR will have to decide which is the best
+        Crop the scanned image according to the calibration and convert it to
+        RGB. Its orientation is fixed later, by the OCR (see __ocr())
         """
         logger.info("Scanner resolution: %d" % (scan_res))
         logger.info("Scanner calibration: %s" % str(scanner_calibration))
@@ -294,96 +339,92 @@ class ImgPage(BasicPage):
             img = PIL.Image.merge("RGB", color_channels[:3])
         else:
             img = img.convert('RGB')
+        return img
 
-        outfiles = []
+    @staticmethod
+    def __get_orientations(img):
+        """
+        Generate 4 images, one for each orientation. OCR will have to decide
+        which is the best
+        """
+        imgs = []
         # rotate the image 0, 90, 180 and 270 degrees
         for rotation in range(0, 4):
             logger.info("Scan rotated of %d degree"
                         % (rotation * -90))
-            outfiles.append(img)
+            imgs.append(img)
             img = img.rotate(-90)
-        return outfiles
+        return imgs
 
-    @staticmethod
-    def __compare_score(score_x, score_y):
+    def __detect_orientation(self, img, langs):
         """
-        Compare scores
+        Rotate the page according to the orientation detected by the OCR
+        tool
 
         Returns:
-            -1 : if X is lower than Y
-            1 : if X is higher than Y
-            0 : if both are equal
-        """
-        if score_x < score_y:
-            return -1
-        elif score_x > score_y:
-            return 1
-        else:
-            return 0
+            The straightened image, or None if the OCR tool can't tell the
+            orientation of the page with enough confidence
+        """
+        orientation = ocr.detect_orientation(img, langs).result()
+        if orientation is None:
+            return None
+        logger.info("Detected page orientation: %d degree(s)"
+                    " (confidence: %f)"
+                    % (orientation['angle'], orientation['confidence']))
+        if orientation['confidence'] < self.ORIENTATION_MIN_CONFIDENCE:
+            return None
+        angle = orientation['angle'] % 360
+        if angle == 0:
+            return img
+        if angle not in self.ORIENTATION_TRANSPOSES:
+            logger.warning("Unexpected page orientation: %d" % angle)
+            return None
+        return img.transpose(self.ORIENTATION_TRANSPOSES[angle])
+
+    def __ocr(self, img, langs, callback=dummy_progress_cb):
+        """
+        Do the OCR on a new page, whose orientation is unknown
 
-    def __ocr(self, imgs, langs, callback=dummy_progress_cb):
-        """
-        Do the OCR on the page
-        """
-
-        imgs = imgs[:]
-        need_scores = len(imgs) > 1
+        Arguments:
+            img --- image of the page
+            langs --- languages to use with the OCR tool and the spell checker
 
+        Returns:
+            (straightened image, text, line boxes)
+        """
         callback(0, 100, self.SCAN_STEP_OCR)
 
-        ocr_tools = pyocr.pyocr.get_available_tools()
-        if len(ocr_tools) <= 0:
-            # shouldn't happen: scan buttons should be disabled
-            # in that case
-            callback(0, 100, self.SCAN_STEP_OCR)
-            raise Exception("No OCR tool available")
-        logger.info("Using %s for OCR" % ocr_tools[0].get_name())
-
-        max_threads = multiprocessing.cpu_count()
-        threads = []
-
-        if len(imgs) > 1:
-            logger.debug("Will use %d process(es) for OCR" % (max_threads))
-
-        scores = []
-
-        # Run the OCR tools in as many threads as there are processors/core
-        # on the computer
-        nb = 0
-        while (len(imgs) > 0 or len(threads) > 0):
-            # look for finished threads
-            for thread in threads:
-                if not thread.is_alive():
-                    threads.remove(thread)
-                    scores.append((thread.score, thread.img, thread.text))
-                    callback(len(scores),
-                             len(scores) + len(imgs) + len(threads) + 1,
-                             self.SCAN_STEP_OCR)
-            # start new threads if required
-            while (len(threads) < max_threads and len(imgs) > 0):
-                img = imgs.pop()
-                thread = ImgOCRThread(str(nb), ocr_tools[0], langs, img,
-                                      need_scores)
-                thread.start()
-                threads.append(thread)
-                nb += 1
-            time.sleep(self.OCR_THREADS_POLLING_TIME)
-
-        # We want the higher score first
-        scores.sort(cmp=lambda x, y: self.__compare_score(y[0], x[0]))
-
-        logger.info("Best: %f" % (scores[0][0]))
-
-        logger.info("Extracting boxes ...")
-        callback(len(scores), len(scores) + 1, self.SCAN_STEP_OCR)
-        builder = pyocr.builders.LineBoxBuilder()
-        boxes = ocr_tools[0].image_to_string(scores[0][1],
-                                             lang=langs['ocr'],
-                                             builder=builder)
-        logger.info("Done")
+        straight_img = self.__detect_orientation(img, langs)
+        if straight_img is None:
+            logger.info("Orientation unknown. Will run the OCR on each"
+                        " orientation and keep the best one")
+            imgs = self.__get_orientations(img)
+        else:
+            imgs = [straight_img]
+
+        # the OCR engine runs them in parallel
+        need_scores = len(imgs) > 1
+        tasks = [ocr.ocr_img(img, langs, need_scores) for img in imgs]
+        results = []
+        try:
+            for (img, task) in zip(imgs, tasks):
+                callback(len(results), len(tasks) + 1, self.SCAN_STEP_OCR)
+                (score, txt, boxes) = task.result()
+                if need_scores:
+                    logger.info("Page orientation %d score: %d"
+                                % (len(results), score))
+                results.append((score, img, txt, boxes))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        # We want the highest score. On equal scores, the first orientation
+        # wins
+        best = max(results, key=lambda result: result[0])
+        logger.info("Best: %f" % (best[0]))
 
         callback(100, 100, self.SCAN_STEP_OCR)
-        return (scores[0][1], scores[0][2], boxes)
+        return best[1:]
 
     def make(self, img, langs=None, scan_res=0, scanner_calibration=None,
              callback=dummy_progress_cb):
@@ -391,21 +432,19 @@ class ImgPage(BasicPage):
         Scan the page & do OCR
         """
         imgfile = self.__img_path
-        boxfile = self.__box_path
 
-        out_imgs = self.__save_imgs(img, scan_res, scanner_calibration,
-                                    callback)
+        img = self.__prepare_img(img, scan_res, scanner_calibration,
+                                 callback)
         if langs is None:
-            (img, txt, boxes) = (out_imgs[0], "", [])
+            (txt, boxes) = ("", [])
         else:
-            (img, txt, boxes) = self.__ocr(out_imgs, langs, callback)
+            (img, txt, boxes) = self.__ocr(img, langs, callback)
 
         # Convert the image and save it in its final place
         img.save(imgfile)
 
         # Save the boxes
-        with codecs.open(boxfile, 'w', encoding='utf-8') as file_desc:
-            pyocr.builders.LineBoxBuilder().write_file(file_desc, boxes)
+        self.__write_boxes(boxes)
 
         logger.info("Scan done")
         self.drop_cache()
@@ -451,23 +490,20 @@ class ImgPage(BasicPage):
         cairo_context.set_source_surface(surface, 0, 0)
         cairo_context.paint()
 
-    def redo_ocr(self, langs):
+    def submit_ocr(self, langs):
         """
-        Rerun the OCR on the document
+        Rerun the OCR on the page. Its orientation is already known.
 
         Arguments:
             langs --- languages to use with the OCR tool and the spell checker
         """
         logger.info("Redoing OCR of '%s'" % self)
+        return ocr.ocr_img(self.img, langs)
 
-        img = self.img
-        boxfile = self.__box_path
-
-        (img, txt, boxes) = self.__ocr([img], langs,
-                                       dummy_progress_cb)
+    def set_ocr_result(self, ocr_result):
+        (score, txt, boxes) = ocr_result
         # save the boxes
-        with codecs.open(boxfile, 'w', encoding='utf-8') as file_desc:
-            pyocr.builders.LineBoxBuilder.write_file(file_desc, boxes)
+        self.__write_boxes(boxes)
         self.drop_cache()
         self.doc.drop_cache()
 
@@ -480,6 +516,8 @@ class ImgPage(BasicPage):
         """
         src = {}
         src["box"] = self.__get_box_path()
+        src["txt"] = self.__get_txt_path()
+        src["box_bin"] = self.__get_box_bin_path()
         src["img"] = self.__get_img_path()
         src["thumb"] = self.__get_thumb_path()
 
@@ -495,6 +533,8 @@ class ImgPage(BasicPage):
 
         dst = {}
         dst["box"] = self.__get_box_path()
+        dst["txt"] = self.__get_txt_path()
+        dst["box_bin"] = self.__get_box_bin_path()
         dst["img"] = self.__get_img_path()
         dst["thumb"] = self.__get_thumb_path()
 
@@ -554,6 +594,8 @@ class ImgPage(BasicPage):
         current_doc_nb_pages = self.doc.nb_pages
         paths = [
             self.__get_box_path(),
+            self.__get_txt_path(),
+            self.__get_box_bin_path(),
             self.__get_img_path(),
             self.__get_thumb_path(),
         ]
@@ -577,6 +619,8 @@ class ImgPage(BasicPage):
 
         to_move = [
             (other_page.__get_box_path(), self.__get_box_path()),
+            (other_page.__get_txt_path(), self.__get_txt_path()),
+            (other_page.__get_box_bin_path(), self.__get_box_bin_path()),
             (other_page.__get_img_path(), self.__get_img_path()),
             (other_page.__get_thumb_path(), self.__get_thumb_path())
         ]
@@ -586,6 +630,10 @@ class ImgPage(BasicPage):
                 logger.error("Error, file already exists: %s" % dst)
                 assert(0)
         for (src, dst) in to_move:
+            if (dst in (self.__get_txt_path(), self.__get_box_bin_path())
+                    and not os.access(src, os.F_OK)):
+                # the text file and the binary box file are optional
+                continue
             logger.info("%s --> %s" % (src, dst))
             os.rename(src, dst)
 
@@ -0,0 +1,685 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2012  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+OCR engine: all the OCR tasks (orientation detection, OCR, scoring of the
+result) run in a bounded pool of worker processes, shared by the whole
+application.
+
+Submitting a task returns an OcrTask (a future): the caller can wait for its
+result, be called back when it's done, or cancel it if it hasn't started
+yet.
+"""
+
+import collections
+import cPickle
+import errno
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.queues
+import os
+import Queue
+import re
+import StringIO
+import threading
+import traceback
+
+import PIL.Image
+import pyocr.builders
+import pyocr.pyocr
+
+from paperwork.util import check_spelling
+
+logger = logging.getLogger(__name__)
+
+
+class OcrError(Exception):
+    """
+    A task failed in a worker process
+    """
+    pass
+
+
+class OcrTaskCancelled(Exception):
+    """
+    The task was cancelled before it could run
+    """
+    pass
+
+
+# Worker side
+
+# OCR tool of the worker process (see _get_ocr_tool())
+_OCR_TOOL = None
+# queue on which the worker process tells the engine that it starts, and
+# which task it starts (see OcrEngine.__monitor_tasks())
+_EVENT_QUEUE = None
+
+
+def _get_ocr_tool():
+    global _OCR_TOOL
+    if _OCR_TOOL is None:
+        ocr_tools = pyocr.pyocr.get_available_tools()
+        if len(ocr_tools) <= 0:
+            # shouldn't happen: scan buttons should be disabled
+            # in that case
+            raise Exception("No OCR tool available")
+        _OCR_TOOL = ocr_tools[0]
+        logger.info("Using %s for OCR" % _OCR_TOOL.get_name())
+    return _OCR_TOOL
+
+
+def _init_worker(event_queue):
+    """
+    The parallelism comes from the worker processes: Tesseract must not
+    start its own threads (OpenMP, Tesseract >= 4) in each of them, or the
+    CPUs are oversubscribed.
+    """
+    global _EVENT_QUEUE
+    _EVENT_QUEUE = event_queue
+    if "OMP_THREAD_LIMIT" not in os.environ:
+        os.environ["OMP_THREAD_LIMIT"] = "1"
+    _EVENT_QUEUE.put(("worker", os.getpid()))
+
+
+def _run_task(task_id, task_data):
+    """
+    Run a task in a worker process.
+
+    Arguments:
+        task_data --- pickled (func, args)
+
+    Returns:
+        (True, pickled result) or (False, error message). The result is
+        pickled here so a result that can't be sent back is reported as an
+        error too
+    """
+    _EVENT_QUEUE.put(("started", task_id, os.getpid()))
+    try:
+        (func, args) = cPickle.loads(task_data)
+        return (True, cPickle.dumps(func(*args), cPickle.HIGHEST_PROTOCOL))
+    except Exception, exc:
+        logger.error("OCR task failed: %s" % exc)
+        return (False, traceback.format_exc())
+
+
+def _load_img(img_data):
+    return PIL.Image.open(StringIO.StringIO(img_data))
+
+
+def _dump_img(img):
+    """
+    Images are sent to the worker processes as BMP files (lossless and
+    fast to write)
+    """
+    file_desc = StringIO.StringIO()
+    img.save(file_desc, "BMP")
+    return file_desc.getvalue()
+
+
+def _compute_score_with_spell_checking(txt, langs):
+    return check_spelling(langs['spelling'], txt)
+
+
+def _compute_score_without_spell_checking(txt, langs):
+    """
+    Try to evaluate how well the OCR worked.
+    Current implementation:
+        The score is the number of words only made of 4 or more letters
+        ([a-zA-Z])
+    """
+    # TODO(Jflesch): i18n / l10n
+    score = 0
+    prog = re.compile(r'^[a-zA-Z]{4,}$')
+    for word in txt.split(" "):
+        if prog.match(word):
+            score += 1
+    return (txt, score)
+
+
+_SCORE_METHODS = [
+    ("spell_checker", _compute_score_with_spell_checking),
+    ("lucky_guess", _compute_score_without_spell_checking),
+    ("no_score", lambda txt, langs: (txt, 0))
+]
+
+
+def _compute_score(txt, langs):
+    for (name, method) in _SCORE_METHODS:
+        try:
+            logger.info("Evaluating OCR score using method '%s' ..." % name)
+            (fixed_text, score) = method(txt, langs)
+            # TODO(Jflesch): For now, we throw away the fixed version:
+            # The original version may contain proper nouns, and spell
+            # checking could make them disappear
+            # However, it would be best if we could keep both versions
+            # without increasing too much indexation time
+            return score
+        except Exception, exc:
+            logger.error("Scoring method '%s' failed !" % name)
+            logger.error("Reason: %s" % exc)
+    return -1
+
+
+def _detect_orientation(img_data, langs):
+    ocr_tool = _get_ocr_tool()
+    if (not hasattr(ocr_tool, 'detect_orientation')
+            or not ocr_tool.can_detect_orientation()):
+        logger.info("%s can't detect the orientation of the pages"
+                    % ocr_tool.get_name())
+        return None
+    try:
+        return ocr_tool.detect_orientation(_load_img(img_data),
+                                           lang=langs['ocr'])
+    except Exception, exc:
+        logger.warning("Failed to detect the page orientation: %s" % exc)
+        return None
+
+
+def _ocr_img(img_data, langs, compute_score):
+    boxes = _get_ocr_tool().image_to_string(
+        _load_img(img_data), lang=langs['ocr'],
+        builder=pyocr.builders.LineBoxBuilder())
+    txt = u"\n".join([line.content for line in boxes])
+    score = 0
+    if compute_score:
+        score = _compute_score(txt, langs)
+    return (score, txt, boxes)
+
+
+# Caller side
+
+class OcrTask(object):
+    """
+    A task submitted to the OCR engine
+    """
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    CANCELLED = "cancelled"
+
+    def __init__(self, engine, data):
+        """
+        Arguments:
+            data --- pickled (func, args) (see _run_task())
+        """
+        self.__engine = engine
+        self.data = data
+        self.state = self.PENDING
+        self.__result = None
+        self.__error = None
+        self.__done_event = threading.Event()
+        self.__callbacks = []
+        self.__callbacks_lock = threading.Lock()
+
+    def done(self):
+        """
+        Returns:
+            True if the task is finished or cancelled
+        """
+        return self.__done_event.is_set()
+
+    def cancelled(self):
+        return self.state == self.CANCELLED
+
+    def cancel(self):
+        """
+        Cancel the task if it hasn't been started yet
+
+        Returns:
+            True if the task won't run
+        """
+        return self.__engine._cancel(self)
+
+    def result(self, timeout=None):
+        """
+        Wait for the task to finish.
+
+        Raises:
+            OcrTaskCancelled --- the task has been cancelled
+            OcrError --- the task failed
+        """
+        if not self.__done_event.wait(timeout):
+            raise OcrError("Timeout")
+        if self.state == self.CANCELLED:
+            raise OcrTaskCancelled()
+        if self.__error is not None:
+            raise OcrError(self.__error)
+        return self.__result
+
+    def add_done_callback(self, callback):
+        """
+        Arguments:
+            callback --- called with the task as argument, as soon as the
+                task is done or cancelled (right away if it already is).
+                Beware that it is usually called from the thread that
+                collects the results of the worker processes: it must
+                return quickly
+        """
+        with self.__callbacks_lock:
+            if not self.done():
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    def _set_done(self, state, result=None, error=None):
+        self.state = state
+        self.__result = result
+        self.__error = error
+        with self.__callbacks_lock:
+            self.__done_event.set()
+            callbacks = self.__callbacks
+            self.__callbacks = []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception("OCR task callback failed")
+
+
+class _WorkerPool(object):
+    """
+    A pool of worker processes, and the number of tasks running in it
+    """
+    def __init__(self, nb_workers, event_queue):
+        self.pool = multiprocessing.Pool(processes=nb_workers,
+                                         initializer=_init_worker,
+                                         initargs=(event_queue,))
+        self.nb_running = 0
+
+    def terminate(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class _RunningTask(object):
+    def __init__(self, task, worker_pool):
+        self.task = task
+        self.worker_pool = worker_pool
+        self.async_result = None
+        self.pid = None  # worker process running it, once known
+
+
+class OcrEngine(object):
+    """
+    Runs the OCR tasks in a pool of worker processes. At most max_workers
+    tasks run at the same time. The other ones wait in a queue, in the order
+    in which they have been submitted (so they can still be cancelled).
+
+    multiprocessing only calls us back on success. So nothing can fail in
+    the pool itself: the tasks are pickled by submit() and their results by
+    the workers. The only task that can't end by itself is the one whose
+    worker process died (crash of the OCR tool). A monitor thread takes
+    care of it. It doesn't poll: it sleeps on a queue on which the workers
+    tell when they start and which task they run. Python 2.7 pools have no
+    notification of the death of a worker, but they replace it (their
+    worker handler thread checks them every 0.1s): the replacement worker
+    announcing itself is what wakes up the monitor. The monitor also
+    terminates the pools replaced by set_max_workers() once their last task
+    is done.
+    """
+
+    # a dead worker may have sent its result just before dying
+    DEAD_WORKER_GRACE_DELAY = 2.0  # secs
+
+    def __init__(self, max_workers=0):
+        """
+        Arguments:
+            max_workers --- maximum number of tasks running at the same
+                time. 0 = number of CPUs
+        """
+        self.max_workers = self.__get_max_workers(max_workers)
+        self.__pool = None  # _WorkerPool, created on the first task
+        # pools replaced by set_max_workers(): they must be kept until their
+        # tasks are done (a pool is terminated when it's garbage collected)
+        self.__old_pools = []
+        self.__lock = threading.Lock()
+        self.__pending = collections.deque()
+        self.__running = {}  # task id --> _RunningTask
+        self.__task_ids = itertools.count()
+        # a SimpleQueue writes right away in the pipe: the messages of a
+        # worker can't be lost if it dies just after
+        self.__events = None  # created with the monitor, on the first task
+        self.__monitor = None
+
+    @staticmethod
+    def __get_max_workers(max_workers):
+        if max_workers <= 0:
+            return multiprocessing.cpu_count()
+        return max_workers
+
+    def set_max_workers(self, max_workers):
+        """
+        Change the maximum number of tasks running at the same time. The
+        tasks already running are not interrupted.
+
+        Arguments:
+            max_workers --- 0 = number of CPUs
+        """
+        max_workers = self.__get_max_workers(max_workers)
+        with self.__lock:
+            if max_workers == self.max_workers:
+                return
+            logger.info("OCR engine: %d worker processes (instead of %d)"
+                        % (max_workers, self.max_workers))
+            self.max_workers = max_workers
+            old_pool = self.__pool
+            if old_pool is not None:
+                old_pool.pool.close()
+                self.__old_pools.append(old_pool)
+                self.__pool = None
+            self.__dispatch()
+        if old_pool is not None and old_pool.nb_running <= 0:
+            self.__events.put(("idle",))
+
+    def submit(self, func, *args):
+        """
+        Arguments:
+            func --- function to run in a worker process. Must be defined at
+                the top level of a module, and its arguments and result must
+                be picklable
+
+        Returns:
+            an OcrTask
+        """
+        try:
+            data = cPickle.dumps((func, args), cPickle.HIGHEST_PROTOCOL)
+        except Exception, exc:  # not always a PicklingError
+            logger.error("Can't pickle OCR task: %s" % exc)
+            task = OcrTask(self, None)
+            task._set_done(OcrTask.DONE, error=str(exc))
+            return task
+        task = OcrTask(self, data)
+        with self.__lock:
+            self.__pending.append(task)
+            self.__dispatch()
+        return task
+
+    def __dispatch(self):
+        """
+        Start as many pending tasks as possible. Must be called with the
+        lock held.
+        """
+        if self.__pool is None and len(self.__pending) > 0:
+            logger.info("Starting OCR engine (%d worker processes)"
+                        % self.max_workers)
+            if self.__monitor is None:
+                self.__events = multiprocessing.queues.SimpleQueue()
+                self.__monitor = threading.Thread(
+                    target=self.__monitor_tasks, name="OcrEngineMonitor")
+                self.__monitor.daemon = True
+                self.__monitor.start()
+            self.__pool = _WorkerPool(self.max_workers, self.__events)
+        while (len(self.__running) < self.max_workers
+               and len(self.__pending) > 0):
+            task = self.__pending.popleft()
+            task.state = OcrTask.RUNNING
+            task_id = next(self.__task_ids)
+            running = _RunningTask(task, self.__pool)
+            self.__running[task_id] = running
+            self.__pool.nb_running += 1
+            running.async_result = self.__pool.pool.apply_async(
+                _run_task, (task_id, task.data),
+                callback=lambda out, task_id=task_id:
+                self.__on_task_done(task_id, out))
+            task.data = None
+
+    def __end_task(self, task_id):
+        """
+        Returns:
+            The task, or None if it has already ended
+        """
+        with self.__lock:
+            running = self.__running.pop(task_id, None)
+            if running is None:
+                return None
+            pool = running.worker_pool
+            pool.nb_running -= 1
+            self.__dispatch()
+            old_pool_idle = (pool.nb_running <= 0
+                             and pool in self.__old_pools)
+        if old_pool_idle:
+            # may be called from the result handler thread of this pool: the
+            # monitor terminates it
+            self.__events.put(("idle",))
+        return running.task
+
+    def __on_task_done(self, task_id, out):
+        """
+        Called by the pool, from its result handler thread
+        """
+        task = self.__end_task(task_id)
+        if task is None:
+            return
+        (success, data) = out
+        if success:
+            task._set_done(OcrTask.DONE, result=cPickle.loads(data))
+        else:
+            task._set_done(OcrTask.DONE, error=data)
+
+    def __fail_task(self, task_id, error):
+        task = self.__end_task(task_id)
+        if task is None:
+            return
+        logger.error("OCR task failed: %s" % error)
+        task._set_done(OcrTask.DONE, error=error)
+
+    @staticmethod
+    def __is_process_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, exc:
+            return exc.errno != errno.ESRCH
+        return True
+
+    def __get_orphan_tasks(self):
+        """
+        Returns:
+            The ids of the tasks whose worker process died without sending
+            their result
+        """
+        with self.__lock:
+            orphans = [(task_id, running.async_result)
+                       for (task_id, running) in self.__running.iteritems()
+                       if running.pid is not None
+                       and not self.__is_process_alive(running.pid)]
+        failed = []
+        for (task_id, async_result) in orphans:
+            async_result.wait(self.DEAD_WORKER_GRACE_DELAY)
+            if not async_result.ready():
+                failed.append(task_id)
+        return failed
+
+    def __get_idle_old_pools(self):
+        with self.__lock:
+            idle = [pool for pool in self.__old_pools if pool.nb_running <= 0]
+            for pool in idle:
+                self.__old_pools.remove(pool)
+        return idle
+
+    def __monitor_tasks(self):
+        """
+        Events:
+            ("worker", pid) --- a worker process started. Once the pool is
+                started, it means it replaced a dead one
+            ("started", task id, pid) --- a worker process starts a task
+            ("idle",) --- a pool replaced by set_max_workers() may be idle
+        """
+        while True:
+            event = self.__events.get()
+            if event[0] == "started":
+                (_, task_id, pid) = event
+                with self.__lock:
+                    if task_id in self.__running:
+                        self.__running[task_id].pid = pid
+            elif event[0] == "worker":
+                for task_id in self.__get_orphan_tasks():
+                    self.__fail_task(task_id, "OCR worker process died")
+            # the workers of these pools may be stuck (that's why their
+            # tasks have been failed): no point in waiting for them
+            for pool in self.__get_idle_old_pools():
+                pool.terminate()
+
+    def _cancel(self, task):
+        with self.__lock:
+            if task.state != OcrTask.PENDING:
+                return task.state == OcrTask.CANCELLED
+            self.__pending.remove(task)
+            task.state = OcrTask.CANCELLED
+        task._set_done(OcrTask.CANCELLED)
+        return True
+
+
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+
+
+def get_ocr_engine():
+    """
+    Returns:
+        the OcrEngine shared by the whole process. All the OCR tasks go
+        through it, so its number of workers is the only limit on the number
+        of OCR processes running at the same time (see
+        PaperworkConfig.ocr_max_processes)
+    """
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            _ENGINE = OcrEngine()
+        return _ENGINE
+
+
+def detect_orientation(img, langs):
+    """
+    Ask the OCR tool for the orientation of the page (Tesseract OSD
+    mode). Much faster than running the whole OCR on each orientation.
+
+    Returns:
+        An OcrTask. Its result is the orientation found by the OCR tool
+        ({'angle': <counter-clockwise angle to straighten the image>,
+          'confidence': <float>}) or None if it can't tell
+    """
+    return get_ocr_engine().submit(_detect_orientation, _dump_img(img),
+                                   langs)
+
+
+def ocr_img(img, langs, compute_score=False):
+    """
+    Run the OCR on an image.
+
+    Arguments:
+        compute_score --- if True, evaluate how well the OCR worked (with
+            the spell checker if possible), so the results obtained on the
+            different orientations of a page can be compared
+
+    Returns:
+        An OcrTask. Its result is (score, text, line boxes). The text is
+        built from the boxes.
+    """
+    return get_ocr_engine().submit(_ocr_img, _dump_img(img), langs,
+                                   compute_score)
+
+
+class OcrBatch(object):
+    """
+    Rerun the OCR on a sequence of pages. They are processed in parallel by
+    the OCR engine, but only a few of them are submitted in advance: the
+    images of all the pages are never in memory at the same time. The
+    results are given to the pages as soon as they are available.
+
+    If the OCR of a page fails, the page keeps its current text and boxes,
+    and the other pages are processed anyway.
+    """
+
+    def __init__(self, pages, langs):
+        """
+        Arguments:
+            pages --- iterable of pages (see BasicPage.submit_ocr())
+            langs --- languages to use with the OCR tool and the spell
+                checker
+        """
+        self.__pages = iter(pages)
+        self.langs = langs
+        self.nb_done = 0
+        self.__tasks = {}  # task --> page
+        # finished tasks, and None to wake up run() when stop() is called
+        self.__done_queue = Queue.Queue()
+        self.__lock = threading.Lock()
+        self.__running = False
+        self.__stop_requested = False
+
+    def run(self, callback=None):
+        """
+        Arguments:
+            callback --- if not None, called with each page once its OCR is
+                done
+
+        Returns:
+            False if stop() has been called before the end
+        """
+        with self.__lock:
+            self.__running = True
+            self.__stop_requested = False
+        max_tasks = 2 * get_ocr_engine().max_workers
+        try:
+            while True:
+                for page in self.__pages:
+                    task = page.submit_ocr(self.langs)
+                    self.__tasks[task] = page
+                    task.add_done_callback(self.__done_queue.put)
+                    if len(self.__tasks) >= max_tasks:
+                        break
+                if len(self.__tasks) <= 0:
+                    return True
+                task = self.__done_queue.get()
+                if task is None:
+                    with self.__lock:
+                        if self.__stop_requested:
+                            return False
+                    # left by a stop() at the end of a previous run()
+                    continue
+                page = self.__tasks.pop(task, None)
+                if page is None:
+                    # cancelled by a previous call to run()
+                    continue
+                self.nb_done += 1
+                try:
+                    page.set_ocr_result(task.result())
+                except OcrError, exc:
+                    logger.error("OCR of page '%s' failed: %s" % (page, exc))
+                    continue
+                if callback is not None:
+                    callback(page)
+        finally:
+            for task in self.__tasks.keys():
+                task.cancel()
+            self.__tasks = {}
+            with self.__lock:
+                self.__running = False
+                self.__stop_requested = False
+
+    def stop(self):
+        """
+        Make run() return as soon as possible. The OCR of the pages not done
+        yet is abandoned (the pages are left untouched). Can be called from
+        any thread. Has no effect if run() is not running.
+        """
+        with self.__lock:
+            if not self.__running:
+                return
+            self.__stop_requested = True
+            self.__done_queue.put(None)
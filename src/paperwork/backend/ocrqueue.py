@@ -0,0 +1,330 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2012  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Redo the OCR of many documents (possibly the whole work directory) as a
+work queue of pages, kept on the disk so it can be interrupted and resumed
+later, even after a restart of Paperwork.
+"""
+
+import collections
+import cPickle
+import logging
+import os
+import threading
+
+from paperwork.backend import ocr
+from paperwork.backend.common.page import BasicPage
+from paperwork.util import dummy_progress_cb
+
+logger = logging.getLogger(__name__)
+
+
+class OcrRedoQueue(object):
+    """
+    Pages whose OCR must be redone: [(docid, page_nb)], in the order in
+    which they must be done, and the languages to use. Written in the index
+    directory.
+    """
+
+    VERSION = 1
+    FILENAME = "ocr.queue"
+
+    def __init__(self, indexdir):
+        self.filepath = os.path.join(indexdir, self.FILENAME)
+        self.langs = None
+        # number of pages added since the queue was last empty
+        self.total = 0
+        self.__pageids = collections.OrderedDict()  # (docid, page_nb) --> None
+
+    def __len__(self):
+        return len(self.__pageids)
+
+    def __get_pageids(self):
+        return self.__pageids.keys()
+
+    pageids = property(__get_pageids)
+
+    def load(self):
+        """
+        Load the queue from the disk
+
+        Returns:
+            True if a valid queue has been loaded
+        """
+        try:
+            with open(self.filepath, 'rb') as file_desc:
+                content = cPickle.load(file_desc)
+            if content['version'] != self.VERSION:
+                logger.info("OCR queue '%s' has an old version (%d). Ignored"
+                            % (self.filepath, content['version']))
+                return False
+            self.langs = content['langs']
+            self.total = content['total']
+            self.__pageids = collections.OrderedDict(
+                [(pageid, None) for pageid in content['pageids']])
+        except IOError:
+            # no OCR redo in progress
+            return False
+        except Exception, exc:
+            logger.warning("Failed to read OCR queue '%s': %s"
+                           % (self.filepath, str(exc)))
+            return False
+        return True
+
+    def save(self):
+        """
+        Write the queue. If it's empty, the file is removed.
+        """
+        if len(self.__pageids) <= 0:
+            try:
+                os.unlink(self.filepath)
+            except OSError:
+                pass
+            return
+        content = {
+            'version': self.VERSION,
+            'langs': self.langs,
+            'total': self.total,
+            'pageids': self.__pageids.keys(),
+        }
+        tmp_filepath = self.filepath + ".tmp"
+        try:
+            with open(tmp_filepath, 'wb') as file_desc:
+                cPickle.dump(content, file_desc, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filepath, self.filepath)
+        except (IOError, OSError), exc:
+            logger.warning("Failed to write OCR queue '%s': %s"
+                           % (self.filepath, str(exc)))
+
+    def add_docs(self, docs, langs):
+        """
+        Add all the pages of the given documents at the end of the queue.
+        The documents that can't be edited are ignored.
+
+        Arguments:
+            langs --- languages to use with the OCR tool and the spell
+                checker. Replace the ones of the pages already in the queue.
+        """
+        if len(self.__pageids) <= 0:
+            self.total = 0
+        self.langs = langs
+        for doc in docs:
+            if not doc.can_edit:
+                continue
+            for page_nb in xrange(0, doc.nb_pages):
+                pageid = (doc.docid, page_nb)
+                if pageid not in self.__pageids:
+                    self.__pageids[pageid] = None
+                    self.total += 1
+
+    def remove(self, pageid):
+        self.__pageids.pop(pageid, None)
+
+
+class OcrRedoer(object):
+    """
+    Redo the OCR of the pages in the OcrRedoQueue of a DocSearch. There must
+    be only one per index directory (see get_ocr_redoer()): it's the only
+    one reading and writing the queue.
+
+    The new text of the pages is indexed every INDEX_UPDATE_NB_DOCS
+    documents, and the queue is written at the same time: if Paperwork is
+    stopped or crashes, the work done is not lost (at worst, the pages done
+    since the last checkpoint are done again).
+
+    The watcher of the work directory ignores the documents from the moment
+    their first page is submitted to the OCR until they are indexed.
+    """
+
+    INDEX_UPDATE_NB_DOCS = 10
+
+    def __init__(self, docsearch):
+        self.docsearch = docsearch
+        self.queue = OcrRedoQueue(docsearch.indexdir)
+        self.queue.load()
+        self.__batch = None
+        self.__can_run = True
+        self.__lock = threading.Lock()
+        # documents can be added to the queue while run() goes through it
+        self.__queue_lock = threading.Lock()
+        self.__nb_pages = collections.Counter()
+        self.__modified_docs = set()
+        self.__nb_done_docs = 0
+        self.__write_guards = {}  # docid --> DocWriteGuard
+
+    def __len__(self):
+        """
+        Returns:
+            the number of pages still to do
+        """
+        return len(self.queue)
+
+    def add_docs(self, docs, langs):
+        """
+        Add documents to redo. The queue is written right away. Can be called
+        from any thread, even while run() is running (the documents are then
+        done by the next call to run()).
+        """
+        with self.__queue_lock:
+            self.queue.add_docs(docs, langs)
+            self.queue.save()
+
+    def __get_pages(self, pageids):
+        for pageid in pageids:
+            if not self.__can_run:
+                # stopped before the batch was running
+                return
+            (docid, page_nb) = pageid
+            doc = self.docsearch.get_doc_from_docid(docid)
+            if doc is None or page_nb >= doc.nb_pages:
+                # removed in the meantime
+                with self.__queue_lock:
+                    self.queue.remove(pageid)
+                continue
+            if docid not in self.__write_guards:
+                guard = self.docsearch.writing_docs([docid])
+                guard.__enter__()
+                self.__write_guards[docid] = guard
+            yield doc.pages[page_nb]
+
+    def __release_docs(self, release_all=False):
+        """
+        Let the watcher report the changes made to the documents again, once
+        all their pages have been done and indexed
+        """
+        for (docid, guard) in self.__write_guards.items():
+            if release_all or self.__nb_pages[docid] <= 0:
+                guard.__exit__(None, None, None)
+                self.__write_guards.pop(docid)
+
+    def __checkpoint(self):
+        """
+        Index the documents modified since the last checkpoint, and write the
+        queue
+        """
+        docs = self.__modified_docs
+        self.__modified_docs = set()
+        self.__nb_done_docs = 0
+        if len(docs) > 0:
+            logger.info("Redo OCR: updating %d documents in the index"
+                        % len(docs))
+            index_updater = self.docsearch.get_index_updater(optimize=False)
+            for doc in docs:
+                index_updater.upd_doc(doc)
+            index_updater.commit()
+        with self.__queue_lock:
+            self.queue.save()
+        self.__release_docs()
+
+    def __on_page_done(self, page, progress_callback):
+        doc = page.doc
+        with self.__queue_lock:
+            self.queue.remove((doc.docid, page.page_nb))
+            total = self.queue.total
+            nb_done = total - len(self.queue)
+        self.__modified_docs.add(doc)
+        self.__nb_pages[doc.docid] -= 1
+        if self.__nb_pages[doc.docid] <= 0:
+            self.__nb_done_docs += 1
+        progress_callback(nb_done, total, BasicPage.SCAN_STEP_OCR, doc)
+        if self.__nb_done_docs >= self.INDEX_UPDATE_NB_DOCS:
+            self.__checkpoint()
+
+    def run(self, progress_callback=dummy_progress_cb):
+        """
+        Redo the OCR of the pages in the queue, until the queue is empty or
+        stop() is called. When stopped, the pages already done are indexed
+        right away, and the other ones stay in the queue.
+
+        Arguments:
+            progress_callback --- See util.dummy_progress_cb for a
+                prototype. The step is BasicPage.SCAN_STEP_OCR, and the
+                document is the one of the last page done
+
+        Returns:
+            True if all the pages have been done
+        """
+        with self.__lock:
+            if not self.__can_run:
+                return False
+            with self.__queue_lock:
+                pageids = self.queue.pageids
+                langs = self.queue.langs
+            self.__batch = ocr.OcrBatch(self.__get_pages(pageids), langs)
+        # number of pages still to do for each document
+        self.__nb_pages = collections.Counter(
+            [docid for (docid, page_nb) in pageids])
+        # documents with new OCR results not indexed yet
+        self.__modified_docs = set()
+        self.__nb_done_docs = 0
+        try:
+            done = self.__batch.run(
+                lambda page: self.__on_page_done(page, progress_callback))
+            # stop() may have been called before the batch was running
+            done = done and self.__can_run
+            if done:
+                # the pages whose OCR failed are not retried
+                with self.__queue_lock:
+                    for pageid in pageids:
+                        self.queue.remove(pageid)
+                logger.info("Redo OCR: all the pages have been done")
+        finally:
+            self.__batch = None
+            try:
+                self.__checkpoint()
+            finally:
+                self.__release_docs(release_all=True)
+        return done
+
+    def stop(self):
+        """
+        Make run() return as soon as possible. The pages not done yet stay
+        in the queue. Can be called from any thread.
+        """
+        with self.__lock:
+            self.__can_run = False
+            if self.__batch is not None:
+                self.__batch.stop()
+
+    def resume(self):
+        """
+        Allow run() to be called again after stop()
+        """
+        with self.__lock:
+            self.__can_run = True
+
+
+_REDOERS = {}  # index directory --> OcrRedoer
+_REDOERS_LOCK = threading.Lock()
+
+
+def get_ocr_redoer(docsearch):
+    """
+    Returns:
+        the OcrRedoer of the index of the DocSearch. The same one is
+        returned for all the DocSearch on the same index directory (the
+        index is reloaded while the OCR is being redone): there is only one
+        copy of the queue in memory. The redoer then works with the last
+        DocSearch given.
+    """
+    with _REDOERS_LOCK:
+        redoer = _REDOERS.get(docsearch.indexdir)
+        if redoer is None:
+            redoer = OcrRedoer(docsearch)
+            _REDOERS[docsearch.indexdir] = redoer
+        redoer.docsearch = docsearch
+        return redoer
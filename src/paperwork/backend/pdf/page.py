@@ -19,8 +19,8 @@ import codecs
 import os
 import logging
 import pyocr.builders
-import pyocr.pyocr
 
+from paperwork.backend import ocr
 from paperwork.backend.common.page import BasicPage
 from paperwork.util import split_words
 from paperwork.util import surface2image
@@ -144,11 +144,8 @@ class PdfPage(BasicPage):
 
         txt = self.pdf_page.get_text()
         pdf_size = self.pdf_page.get_size()
-        words = set()
+        words = set(split_words(unicode(txt, encoding='utf-8')))
         self.__boxes = []
-        for line in txt.split("\n"):
-            for word in split_words(unicode(line, encoding='utf-8')):
-                words.add(word)
         for word in words:
             for rect in self.pdf_page.find_text(word):
                 word_box = PdfWordBox(word, rect, pdf_size)
@@ -158,6 +155,20 @@ class PdfPage(BasicPage):
 
     boxes = property(__get_boxes)
 
+    def __contains__(self, sentence):
+        # Without OCR, getting the boxes of a PDF page requires looking for
+        # each of its words in it, which is much slower than looking at its
+        # text
+        words = split_words(sentence)
+        words = [word.lower() for word in words]
+        txt = self.text
+        for line in txt:
+            line = line.lower()
+            for word in words:
+                if word in line:
+                    return True
+        return False
+
     def __render_img(self, factor):
         # TODO(Jflesch): In a perfect world, we shouldn't use ImageSurface.
         # we should draw directly on the GtkImage.window.cairo_create()
@@ -199,25 +210,18 @@ class PdfPage(BasicPage):
         self.pdf_page.render_for_printing(ctx)
         return None
 
-    def redo_ocr(self, langs):
-        img = self.img
+    def submit_ocr(self, langs):
+        return ocr.ocr_img(self.img, langs)
+
+    def set_ocr_result(self, ocr_result):
+        # a single OCR pass: the text is rebuilt from the boxes
+        (score, txt, boxes) = ocr_result
         txtfile = self.__get_txt_path()
         boxfile = self.__get_box_path()
 
-        ocr_tools = pyocr.pyocr.get_available_tools()
-        if len(ocr_tools) <= 0:
-            # shouldn't happen: scan buttons should be disabled
-            # in that case
-            raise Exception("No OCR tool available")
-
-        txt = ocr_tools[0].image_to_string(img, lang=langs['ocr'])
-        builder = pyocr.builders.LineBoxBuilder()
-        boxes = ocr_tools[0].image_to_string(img, lang=langs['ocr'],
-                                             builder=builder)
-
         # save the text
         with codecs.open(txtfile, 'w', encoding='utf-8') as file_desc:
             file_desc.write(txt)
         # save the boxes
         with codecs.open(boxfile, 'w', encoding='utf-8') as file_desc:
-            pyocr.builders.LineBoxBuilder.write_file(file_desc, boxes)
+            pyocr.builders.LineBoxBuilder().write_file(file_desc, boxes)
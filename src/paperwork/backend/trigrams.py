@@ -0,0 +1,326 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2012  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Character trigram index of the terms of the index. Used by the fuzzy search
+to find quickly the terms that are close to a searched word (OCR errors:
+"lnvoice", "inv0ice", ...), without comparing the word with all the terms
+of the index.
+"""
+
+import array
+import cPickle
+import logging
+import os
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+def _get_trigrams(term):
+    """
+    Returns the set of the trigrams of a term. The term is padded so its
+    beginning and its end give trigrams too, and so each edit (insertion,
+    deletion, substitution) changes at most 3 trigrams.
+    """
+    term = u"$$" + term + u"$$"
+    return set([term[idx:idx + 3] for idx in xrange(0, len(term) - 2)])
+
+
+def get_edit_distance(term_a, term_b, max_dist):
+    """
+    Levenshtein distance between two terms
+
+    Returns:
+        The distance, or max_dist + 1 if it is higher than max_dist
+    """
+    if abs(len(term_a) - len(term_b)) > max_dist:
+        return max_dist + 1
+    previous_row = range(0, len(term_b) + 1)
+    for (idx_a, char_a) in enumerate(term_a):
+        row = [idx_a + 1]
+        for (idx_b, char_b) in enumerate(term_b):
+            row.append(min(previous_row[idx_b + 1] + 1,
+                           row[idx_b] + 1,
+                           previous_row[idx_b] + (char_a != char_b)))
+        if min(row) > max_dist:
+            return max_dist + 1
+        previous_row = row
+    return min(previous_row[-1], max_dist + 1)
+
+
+class TermTrigramIndex(object):
+    """
+    Trigram --> terms containing this trigram.
+
+    A term within an edit distance d of a searched word shares at least
+    (number of trigrams of the word - 3 * d) trigrams with it. So it
+    necessarily contains at least one of any (3 * d + 1) trigrams of the
+    word: only the terms listed for the rarest trigrams of the word have to
+    be compared with it. The time it takes depends on the length of these
+    lists, not on the number of terms in the index.
+
+    Terms are only added, never removed: the terms of removed documents
+    just don't match anything anymore. The whole index is rebuilt when the
+    document index is rebuilt.
+
+    The texts whose terms have all been added are remembered (as digests,
+    see get_text_digest()), so the texts that didn't change don't have to be
+    split into terms again when their document is indexed again.
+
+    On the disk, the trigram index is written in full only from time to
+    time. In between, the terms added are appended to a log file.
+    """
+
+    VERSION = 2
+    FILENAME = "terms.trigrams"
+    LOG_FILENAME = "terms.trigrams.log"
+    # the log is merged in the main file once it has that many entries
+    MAX_LOG_ENTRIES = 256
+    # terms shorter than that are never looked for approximately
+    MIN_TERM_LEN = 4
+    # distance 2 for the terms at least that long, 1 for the shorter ones
+    MIN_TERM_LEN_DIST_2 = 8
+    # maximum number of similar terms returned
+    MAX_TERMS = 32
+
+    def __init__(self, indexdir):
+        self.filepath = os.path.join(indexdir, self.FILENAME)
+        self.log_filepath = os.path.join(indexdir, self.LOG_FILENAME)
+        self.generation = None
+        self.__terms = []
+        self.__trigrams = {}  # trigram --> array of term indexes
+        self.__text_digests = set()
+        # changes not written yet: (terms, text digests)
+        self.__pending = ([], [])
+        self.__nb_log_entries = 0
+        # if True, the next call to save() writes the whole index
+        self.__full_save = True
+
+    def __len__(self):
+        return len(self.__terms)
+
+    def load(self):
+        """
+        Load the trigram index from the disk
+
+        Returns:
+            True if a valid trigram index has been loaded
+        """
+        try:
+            with open(self.filepath, 'rb') as file_desc:
+                content = cPickle.load(file_desc)
+            if content['version'] != self.VERSION:
+                logger.info("Trigram index '%s' has an old version (%d)."
+                            " Ignored" % (self.filepath, content['version']))
+                return False
+            self.generation = content['generation']
+            self.__terms = content['terms']
+            self.__trigrams = content['trigrams']
+            self.__text_digests = content['text_digests']
+        except IOError, exc:
+            logger.info("No trigram index available: %s" % str(exc))
+            return False
+        except Exception, exc:
+            logger.warning("Failed to read trigram index '%s': %s"
+                           % (self.filepath, str(exc)))
+            return False
+        self.__pending = ([], [])
+        self.__nb_log_entries = 0
+        self.__full_save = False
+        self.__load_log()
+        return True
+
+    def __load_log(self):
+        """
+        Apply the changes appended to the log since the last full save
+        """
+        try:
+            file_desc = open(self.log_filepath, 'rb')
+        except IOError:
+            return
+        with file_desc:
+            while True:
+                try:
+                    (generation, start_generation, terms, text_digests) = \
+                        cPickle.load(file_desc)
+                except EOFError:
+                    break
+                except Exception, exc:
+                    # interrupted while writing: the generation tells what
+                    # is missing
+                    logger.warning("Trigram index log '%s' is truncated: %s"
+                                   % (self.log_filepath, str(exc)))
+                    self.__full_save = True
+                    break
+                if start_generation != self.generation:
+                    # left by an older version of the main file
+                    continue
+                self.__add_terms(terms)
+                self.__text_digests.update(text_digests)
+                self.generation = generation
+                self.__nb_log_entries += 1
+
+    def save(self, generation):
+        """
+        Write the changes made since the last call
+
+        Arguments:
+            generation --- generation of the document index that contains
+                the same terms
+        """
+        if (self.__full_save
+                or self.__nb_log_entries >= self.MAX_LOG_ENTRIES):
+            self.__save_all(generation)
+        else:
+            self.__append_log(generation)
+        self.generation = generation
+        self.__pending = ([], [])
+
+    def __save_all(self, generation):
+        content = {
+            'version': self.VERSION,
+            'generation': generation,
+            'terms': self.__terms,
+            'trigrams': self.__trigrams,
+            'text_digests': self.__text_digests,
+        }
+        tmp_filepath = self.filepath + ".tmp"
+        try:
+            with open(tmp_filepath, 'wb') as file_desc:
+                cPickle.dump(content, file_desc, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_filepath, self.filepath)
+        except (IOError, OSError), exc:
+            logger.warning("Failed to write trigram index '%s': %s"
+                           % (self.filepath, str(exc)))
+            return
+        try:
+            os.unlink(self.log_filepath)
+        except OSError:
+            pass
+        self.__nb_log_entries = 0
+        self.__full_save = False
+
+    def __append_log(self, generation):
+        (terms, text_digests) = self.__pending
+        entry = (generation, self.generation, terms, text_digests)
+        try:
+            with open(self.log_filepath, 'ab') as file_desc:
+                cPickle.dump(entry, file_desc, cPickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError), exc:
+            logger.warning("Failed to write trigram index log '%s': %s"
+                           % (self.log_filepath, str(exc)))
+            self.__full_save = True
+            return
+        self.__nb_log_entries += 1
+
+    def rebuild(self, terms):
+        """
+        Forget all the terms, and index the given ones instead. The next call
+        to save() writes the whole index.
+        """
+        self.__terms = []
+        self.__trigrams = {}
+        self.__text_digests = set()
+        self.__pending = ([], [])
+        self.__full_save = True
+        self.__add_terms(terms)
+
+    @staticmethod
+    def get_text_digest(text):
+        """
+        Returns:
+            A digest of a text (see is_known_text())
+        """
+        return zlib.crc32(text.encode('utf-8'))
+
+    def is_known_text(self, text_digest):
+        """
+        Returns:
+            True if all the terms of the text have already been added
+        """
+        return text_digest in self.__text_digests
+
+    def __get_text_digests(self):
+        return self.__text_digests
+
+    text_digests = property(__get_text_digests)
+
+    def add_terms(self, terms, text_digests=()):
+        """
+        Index new terms. The caller must make sure they are not already in
+        the trigram index.
+
+        Arguments:
+            text_digests --- digests of the texts whose terms are now all in
+                the trigram index
+        """
+        self.__add_terms(terms)
+        self.__text_digests.update(text_digests)
+        self.__pending[0].extend(terms)
+        self.__pending[1].extend(text_digests)
+
+    def __add_terms(self, terms):
+        for term in terms:
+            if len(term) < self.MIN_TERM_LEN - 2:
+                # too short to ever be at a distance <= 2 of a term we look
+                # for
+                continue
+            term_idx = len(self.__terms)
+            self.__terms.append(term)
+            for trigram in _get_trigrams(term):
+                term_idxs = self.__trigrams.get(trigram)
+                if term_idxs is None:
+                    term_idxs = array.array('i')
+                    self.__trigrams[trigram] = term_idxs
+                term_idxs.append(term_idx)
+
+    def get_max_distance(self, word):
+        if len(word) < self.MIN_TERM_LEN:
+            return 0
+        if len(word) < self.MIN_TERM_LEN_DIST_2:
+            return 1
+        return 2
+
+    def get_similar_terms(self, word):
+        """
+        Returns:
+            The terms of the index that are close to the given word (the
+            word itself excluded), closest first.
+        """
+        max_dist = self.get_max_distance(word)
+        if max_dist <= 0:
+            return []
+        trigrams = _get_trigrams(word)
+        nb_lists = (3 * max_dist) + 1
+        if len(trigrams) < nb_lists:
+            return []
+        term_lists = sorted([self.__trigrams.get(trigram, [])
+                             for trigram in trigrams], key=len)
+        candidates = set()
+        for term_idxs in term_lists[:nb_lists]:
+            candidates.update(term_idxs)
+
+        terms = []
+        for term_idx in candidates:
+            term = self.__terms[term_idx]
+            if term == word:
+                continue
+            dist = get_edit_distance(word, term, max_dist)
+            if dist <= max_dist:
+                terms.append((dist, term))
+        terms.sort()
+        return [term for (dist, term) in terms[:self.MAX_TERMS]]
@@ -0,0 +1,370 @@
+#    Paperwork - Using OCR to grep dead trees the easy way
+#    Copyright (C) 2012  Jerome Flesch
+#
+#    Paperwork is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Paperwork is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Paperwork.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Watch the work directory for changes made by other programs (rsync, scripts,
+...), using Linux inotify (through ctypes). Only available on Linux.
+"""
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+from paperwork.backend.common.doc import BasicDoc
+from paperwork.backend.pdf.doc import PDF_FILENAME
+
+logger = logging.getLogger(__name__)
+
+# see inotify(7)
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_CLOEXEC = 0x00080000
+_IN_NONBLOCK = 0x00000800
+
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+    except OSError, exc:
+        logger.warning("Failed to load the libc: %s" % str(exc))
+        return None
+    for func in ("inotify_init1", "inotify_add_watch"):
+        if not hasattr(libc, func):
+            return None
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    return libc
+
+
+_LIBC = _load_libc()
+
+
+def is_watcher_available():
+    """
+    Returns True if the work directory can be watched on this system
+    """
+    return _LIBC is not None
+
+
+class DocDirWatcher(threading.Thread):
+    """
+    Watch the work directory and all the document directories it contains.
+
+    Events are coalesced: on_changes(docids) is called (from the watcher
+    thread) once nothing happened for DEBOUNCE_DELAY seconds, or at most
+    MAX_DELAY seconds after the first event. docids is the set of the ids of
+    the documents that may have been added, modified or removed. It is None
+    if some events have been lost: then anything may have changed.
+
+    The changes Paperwork itself makes to documents must be done in a
+    DocWriteGuard (see writing_docs()): they are not reported.
+    """
+
+    DEBOUNCE_DELAY = 2.0
+    MAX_DELAY = 10.0
+    READ_SIZE = 64 * 1024
+
+    ROOTDIR_EVENTS = (_IN_CREATE | _IN_DELETE | _IN_MOVED_FROM | _IN_MOVED_TO
+                      | _IN_ONLYDIR)
+    DOCDIR_EVENTS = (_IN_CLOSE_WRITE | _IN_CREATE | _IN_DELETE
+                     | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_ATTRIB
+                     | _IN_ONLYDIR)
+    # files that can be modified without modifying the document itself
+    IGNORED_FILE_SUFFIXES = (
+        ".thumb.jpg",
+        ".boxes",
+        ".tmp",
+    )
+    # text caches of the pages of the image documents (rebuilt from their
+    # boxes). The text files of the pages of the PDF documents are their
+    # actual text: they are watched
+    IMG_DOC_IGNORED_FILE_SUFFIXES = (
+        ".txt",
+    )
+    # exceptions to IGNORED_FILE_SUFFIXES and IMG_DOC_IGNORED_FILE_SUFFIXES
+    WATCHED_FILES = (
+        BasicDoc.EXTRA_TEXT_FILE,
+    )
+
+    def __init__(self, rootdir, on_changes):
+        threading.Thread.__init__(self, name="DocDirWatcher")
+        self.daemon = True
+        self.rootdir = rootdir
+        self.__on_changes = on_changes
+        self.__inotify_fd = -1
+        self.__wds = {}  # watch descriptor --> docid (None for the rootdir)
+        self.__can_run = True
+        (self.__wakeup_fd_r, self.__wakeup_fd_w) = os.pipe()
+        self.__changes = set()
+        self.__overflow = False
+        self.__first_event = None
+        self.__last_event = None
+        self.__lock = threading.Lock()
+        # docid --> number of DocWriteGuard active on it
+        self.__suppressed = collections.Counter()
+        # docids whose suppression ends once the pending events are read
+        self.__released = []
+
+    def __add_watch(self, path, mask, docid):
+        wd = _LIBC.inotify_add_watch(self.__inotify_fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                logger.warning("Watcher: inotify watch limit reached. Changes"
+                               " in '%s' won't be noticed (see"
+                               " /proc/sys/fs/inotify/max_user_watches)"
+                               % path)
+            elif err != errno.ENOENT and err != errno.ENOTDIR:
+                logger.warning("Watcher: Failed to watch '%s': %s"
+                               % (path, os.strerror(err)))
+            return
+        self.__wds[wd] = docid
+
+    def __parse_events(self, buf):
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            (wd, mask, cookie, length) = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip("\0")
+            offset += length
+            yield (wd, mask, name)
+
+    def __is_ignored(self, docid, name):
+        """
+        Returns:
+            True if the file 'name' of the document can change without
+            changing the document itself
+        """
+        if name in self.WATCHED_FILES:
+            return False
+        if name.endswith(self.IGNORED_FILE_SUFFIXES):
+            return True
+        if not name.endswith(self.IMG_DOC_IGNORED_FILE_SUFFIXES):
+            return False
+        pdfpath = os.path.join(self.rootdir, docid, PDF_FILENAME)
+        return not os.path.exists(pdfpath)
+
+    def __is_suppressed(self, docid):
+        with self.__lock:
+            return docid in self.__suppressed
+
+    def __handle_event(self, wd, mask, name):
+        if mask & _IN_Q_OVERFLOW:
+            logger.warning("Watcher: inotify queue overflow")
+            self.__overflow = True
+        elif mask & _IN_IGNORED:
+            self.__wds.pop(wd, None)
+            return
+        elif not wd in self.__wds:
+            return
+        elif self.__wds[wd] is None:
+            # event in the rootdir: a document has been added or removed
+            if not mask & _IN_ISDIR:
+                return
+            if mask & (_IN_CREATE | _IN_MOVED_TO):
+                # if the directory has just been renamed, it is already
+                # watched: inotify gives us back the same watch descriptor
+                self.__add_watch(os.path.join(self.rootdir, name),
+                                 self.DOCDIR_EVENTS, name)
+            if self.__is_suppressed(name):
+                return
+            self.__changes.add(name)
+        elif self.__is_ignored(self.__wds[wd], name):
+            return
+        elif self.__is_suppressed(self.__wds[wd]):
+            return
+        else:
+            self.__changes.add(self.__wds[wd])
+        now = time.time()
+        if self.__first_event is None:
+            self.__first_event = now
+        self.__last_event = now
+
+    def __flush(self):
+        if self.__overflow:
+            changes = None
+        else:
+            changes = self.__changes
+        self.__changes = set()
+        self.__overflow = False
+        self.__first_event = None
+        self.__last_event = None
+        logger.info("Watcher: %s document(s) changed"
+                    % ("?" if changes is None else len(changes)))
+        self.__on_changes(changes)
+
+    def __get_timeout(self):
+        if self.__last_event is None:
+            return None
+        now = time.time()
+        return max(0.0, min(self.__last_event + self.DEBOUNCE_DELAY - now,
+                            self.__first_event + self.MAX_DELAY - now))
+
+    def __read_events(self):
+        """
+        Handle all the events currently queued by inotify
+        """
+        while True:
+            try:
+                buf = os.read(self.__inotify_fd, self.READ_SIZE)
+            except OSError, exc:
+                if exc.errno == errno.EAGAIN:
+                    return
+                raise
+            for (wd, mask, name) in self.__parse_events(buf):
+                self.__handle_event(wd, mask, name)
+
+    def __apply_releases(self):
+        with self.__lock:
+            released = self.__released
+            self.__released = []
+            for docid in released:
+                self.__suppressed[docid] -= 1
+                if self.__suppressed[docid] <= 0:
+                    del self.__suppressed[docid]
+
+    def run(self):
+        self.__inotify_fd = _LIBC.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.__inotify_fd < 0:
+            logger.error("Watcher: inotify_init1() failed: %s"
+                         % os.strerror(ctypes.get_errno()))
+            return
+        try:
+            logger.info("Watcher: Watching '%s'" % self.rootdir)
+            self.__add_watch(self.rootdir, self.ROOTDIR_EVENTS, None)
+            for docid in os.listdir(self.rootdir):
+                self.__add_watch(os.path.join(self.rootdir, docid),
+                                 self.DOCDIR_EVENTS, docid)
+            logger.info("Watcher: %d directories watched" % len(self.__wds))
+
+            while self.__can_run:
+                timeout = self.__get_timeout()
+                if timeout is not None and timeout <= 0.0:
+                    self.__flush()
+                    continue
+                (readable, _, _) = select.select(
+                    [self.__inotify_fd, self.__wakeup_fd_r], [], [], timeout)
+                if self.__wakeup_fd_r in readable:
+                    os.read(self.__wakeup_fd_r, self.READ_SIZE)
+                    # inotify queues the events when the changes are made:
+                    # the ones caused by the writes of the released
+                    # documents are already there
+                    self.__read_events()
+                    self.__apply_releases()
+                elif self.__inotify_fd in readable:
+                    self.__read_events()
+        finally:
+            os.close(self.__inotify_fd)
+            logger.info("Watcher: Stopped")
+
+    def suppress(self, docid):
+        """
+        Stop reporting the changes made to a document, until release() is
+        called for it. Calls can be nested. Can be called from any thread.
+        """
+        with self.__lock:
+            self.__suppressed[docid] += 1
+
+    def release(self, docid):
+        """
+        Report the changes made to a document again, after a call to
+        suppress(). The changes made before this call are not reported. Can be
+        called from any thread.
+        """
+        with self.__lock:
+            if not self.__can_run:
+                return
+            self.__released.append(docid)
+            os.write(self.__wakeup_fd_w, "\0")
+
+    def writing_docs(self, docids):
+        """
+        Returns:
+            A DocWriteGuard on the given documents
+        """
+        return DocWriteGuard(self, docids)
+
+    def stop(self):
+        """
+        Stop watching. Pending changes are not reported.
+        """
+        with self.__lock:
+            self.__can_run = False
+            os.write(self.__wakeup_fd_w, "\0")
+        if self.is_alive():
+            self.join()
+        os.close(self.__wakeup_fd_r)
+        os.close(self.__wakeup_fd_w)
+
+
+class DocWriteGuard(object):
+    """
+    To use with 'with' around the changes Paperwork itself makes to some
+    documents: the watcher doesn't report them, even if they take longer than
+    DocDirWatcher.DEBOUNCE_DELAY. Once they are done, the journal of the work
+    directory is updated: the changes made in place to the files of the
+    pages are not noticed otherwise. The documents must be up-to-date in the
+    index by then.
+
+    Arguments:
+        watcher --- DocDirWatcher. If None, the changes are not hidden
+        journal --- docjournal.DocDirJournal. If None, it's not updated
+    """
+
+    def __init__(self, watcher, docids, journal=None):
+        self.watcher = watcher
+        self.docids = list(docids)
+        self.journal = journal
+
+    def __enter__(self):
+        if self.watcher is not None:
+            for docid in self.docids:
+                self.watcher.suppress(docid)
+        if self.journal is not None:
+            # until we are done, the documents must be examined again if
+            # Paperwork is restarted
+            for docid in self.docids:
+                self.journal.remove(docid)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.journal is not None:
+            if exc_type is None:
+                for docid in self.docids:
+                    self.journal.update(docid)
+            self.journal.save()
+        if self.watcher is not None:
+            for docid in self.docids:
+                self.watcher.release(docid)
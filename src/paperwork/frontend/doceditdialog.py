@@ -151,6 +151,10 @@ class DocEditDialog(object):
 
     def apply_changes(self):
         docsearch = self.__main_win.docsearch
+        with docsearch.writing_docs([self.doc.docid]):
+            return self.__apply_changes(docsearch)
+
+    def __apply_changes(self, docsearch):
         doc_index_updater = docsearch.get_index_updater(optimize=False)
         doc_index_updater.del_doc(self.doc.docid)
 
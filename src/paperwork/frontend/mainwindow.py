@@ -41,11 +41,14 @@ from paperwork.frontend.multiscan import MultiscanDialog
 from paperwork.frontend.page_edit import PageEditingDialog
 from paperwork.frontend.settingswindow import SettingsWindow
 from paperwork.backend import docimport
+from paperwork.backend.common.boxes import BoxIndex
 from paperwork.backend.common.page import DummyPage
 from paperwork.backend.docsearch import DocSearch
 from paperwork.backend.docsearch import DummyDocSearch
 from paperwork.backend.img.doc import ImgDoc
 from paperwork.backend.img.page import ImgPage
+from paperwork.backend.watcher import DocDirWatcher
+from paperwork.backend.watcher import is_watcher_available
 from paperwork.util import add_img_border
 from paperwork.util import ask_confirmation
 from paperwork.util import image2pixbuf
@@ -66,11 +69,6 @@ def check_scanner(main_win, config):
     return False
 
 
-def sort_documents_by_date(documents):
-    documents.sort()
-    documents.reverse()
-
-
 class JobIndexLoader(Job):
     """
     Reload the doc index
@@ -122,7 +120,9 @@ class JobIndexLoader(Job):
             self.emit('index-loading-start')
             self.started = True
         try:
-            docsearch = DocSearch(self.__config.workdir, self.__progress_cb)
+            docsearch = DocSearch(self.__config.workdir, self.__progress_cb,
+                                  prefix_search=self.__config.prefix_search,
+                                  fuzzy_search=self.__config.fuzzy_search)
             if not self.can_run:
                 return
             self.emit('index-loading-end', docsearch)
@@ -164,7 +164,7 @@ class JobFactoryIndexLoader(JobFactory):
 
 class JobDocExaminer(Job):
     """
-    Look for modified documents
+    Look for modified documents (all of them, or only the specified ones)
     """
 
     __gsignals__ = {
@@ -178,10 +178,11 @@ class JobDocExaminer(Job):
     can_stop = False
     priority = 50
 
-    def __init__(self, factory, id, config, docsearch):
+    def __init__(self, factory, id, config, docsearch, docids=None):
         Job.__init__(self, factory, id)
         self.__config = config
         self.docsearch = docsearch
+        self.docids = docids
         self.done = False
         self.started = False
 
@@ -218,11 +219,19 @@ class JobDocExaminer(Job):
         self.docs_missing = set()  # document ids
         try:
             doc_examiner = self.docsearch.get_doc_examiner()
-            doc_examiner.examine_rootdir(
-                self.__on_new_doc,
-                self.__on_doc_changed,
-                self.__on_doc_missing,
-                self.__progress_cb)
+            if self.docids is None:
+                doc_examiner.examine_rootdir(
+                    self.__on_new_doc,
+                    self.__on_doc_changed,
+                    self.__on_doc_missing,
+                    self.__progress_cb)
+            else:
+                doc_examiner.examine_docs(
+                    self.docids,
+                    self.__on_new_doc,
+                    self.__on_doc_changed,
+                    self.__on_doc_missing,
+                    self.__progress_cb)
             self.emit('doc-examination-end')
             self.done = True
         except StopIteration:
@@ -252,9 +261,9 @@ class JobFactoryDocExaminer(JobFactory):
         self.__main_win = main_win
         self.__config = config
 
-    def make(self, docsearch):
+    def make(self, docsearch, docids=None):
         job = JobDocExaminer(self, next(self.id_generator),
-                             self.__config, docsearch)
+                             self.__config, docsearch, docids)
         job.connect(
             'doc-examination-start',
             lambda job: GObject.idle_add(
@@ -288,6 +297,10 @@ class JobIndexUpdater(Job):
     can_stop = True
     priority = 15
 
+    # above this number of documents to index, the text extraction is done
+    # by a pool of processes (see DocIndexUpdater)
+    PARALLEL_INDEXING_MIN_DOCS = 50
+
     def __init__(self, factory, id, config, docsearch,
                 new_docs=[], upd_docs=[], del_docs=[],
                 optimize=True):
@@ -332,8 +345,10 @@ class JobIndexUpdater(Job):
 
         if self.index_updater is None:
             self.emit('index-update-start')
+            parallel = (len(self.new_docs) + len(self.upd_docs)
+                        >= self.PARALLEL_INDEXING_MIN_DOCS)
             self.index_updater = self.__docsearch.get_index_updater(
-                optimize=self.optimize)
+                optimize=self.optimize, parallel=parallel)
 
         if not self.can_run:
             self.emit('index-update-interrupted')
@@ -419,6 +434,40 @@ class JobFactoryIndexUpdater(JobFactory):
         return job
 
 
+class SearchResultPager(object):
+    """
+    Fetch the results of a search, one page after the other
+    (see DocSearch.find_documents_page())
+    """
+
+    def __init__(self, docsearch, search, sort_by, page_len):
+        self.__docsearch = docsearch
+        self.search = search
+        self.sort_by = sort_by
+        self.page_len = page_len
+        self.__next_page_nb = 0
+        self.total = None
+
+    def __get_has_more(self):
+        return (self.total is None
+                or self.__next_page_nb * self.page_len < self.total)
+
+    has_more = property(__get_has_more)
+
+    def next_page(self):
+        """
+        Returns:
+            The documents of the next page. An empty list once all of them
+            have been returned.
+        """
+        if not self.has_more:
+            return []
+        (docs, self.total) = self.__docsearch.find_documents_page(
+            self.search, self.__next_page_nb, self.page_len, self.sort_by)
+        self.__next_page_nb += 1
+        return docs
+
+
 class JobDocSearcher(Job):
     """
     Search the documents
@@ -426,43 +475,47 @@ class JobDocSearcher(Job):
 
     __gsignals__ = {
         'search-start': (GObject.SignalFlags.RUN_LAST, None, ()),
-        # first obj: array of documents
+        # first obj: array of documents (first page of the results only)
         # second obj: array of suggestions
+        # third obj: SearchResultPager to get the next pages
         'search-result': (GObject.SignalFlags.RUN_LAST, None,
-                          (GObject.TYPE_PYOBJECT, GObject.TYPE_PYOBJECT)),
+                          (GObject.TYPE_PYOBJECT, GObject.TYPE_PYOBJECT,
+                           GObject.TYPE_PYOBJECT)),
     }
 
     can_stop = True
     priority = 500
 
-    def __init__(self, factory, id, config, docsearch, sort_func, search):
+    # number of documents fetched at once from the index
+    PAGE_LEN = 100
+
+    def __init__(self, factory, id, config, docsearch, sort_by, search):
         Job.__init__(self, factory, id)
         self.search = search
         self.__docsearch = docsearch
-        self.__sort_func = sort_func
+        self.__sort_by = sort_by
         self.__config = config
 
     def do(self):
         self.can_run = True
 
-        self._wait(0.5)
+        # searching while the user types is cheap: the searches narrowing the
+        # previous one only look at the documents that matched it
+        self._wait(0.05)
         if not self.can_run:
             return
 
         self.emit('search-start')
 
-        documents = self.__docsearch.find_documents(self.search)
+        pager = SearchResultPager(self.__docsearch, self.search,
+                                  self.__sort_by, self.PAGE_LEN)
+        documents = pager.next_page()
         if not self.can_run:
             return
 
         if self.search == u"":
-            # when no specific search has been done, the sorting is always
-            # the same
-            sort_documents_by_date(documents)
             # append a new document to the list
             documents.insert(0, ImgDoc(self.__config.workdir))
-        else:
-            self.__sort_func(documents)
         if not self.can_run:
             return
 
@@ -470,7 +523,7 @@ class JobDocSearcher(Job):
         if not self.can_run:
             return
 
-        self.emit('search-result', documents, suggestions)
+        self.emit('search-result', documents, suggestions, pager)
 
     def stop(self, will_resume=False):
         self.can_run = False
@@ -486,13 +539,13 @@ class JobFactoryDocSearcher(JobFactory):
         self.__main_win = main_win
         self.__config = config
 
-    def make(self, docsearch, sort_func, search_sentence):
+    def make(self, docsearch, sort_by, search_sentence):
         job = JobDocSearcher(self, next(self.id_generator), self.__config,
-                             docsearch, sort_func, search_sentence)
+                             docsearch, sort_by, search_sentence)
         job.connect('search-result',
-            lambda searcher, documents, suggestions:
+            lambda searcher, documents, suggestions, pager:
             GObject.idle_add(self.__main_win.on_search_result_cb,
-                             documents, suggestions))
+                             documents, suggestions, pager))
         return job
 
 
@@ -512,14 +565,25 @@ class JobPageThumbnailer(Job):
     can_stop = True
     priority = 400
 
-    def __init__(self, factory, id, doc, search):
+    def __init__(self, factory, id, docsearch, doc, search):
         Job.__init__(self, factory, id)
+        self.__docsearch = docsearch
         self.__doc = doc
         self.__search = search
+        # page number --> number of hits (None = unknown)
+        self.__page_hits = None
 
         self.__current_idx = -1
         self.done = False
 
+    def __is_hit(self, page):
+        if self.__search == u"":
+            return False
+        if self.__page_hits is None:
+            # not in the page index --> we have to look at the page itself
+            return self.__search in page
+        return page.page_nb in self.__page_hits
+
     def do(self):
         if self.done:
             return
@@ -536,13 +600,15 @@ class JobPageThumbnailer(Job):
         if self.__current_idx < 0:
             self.emit('page-thumbnailing-start')
             self.__current_idx = 0
+            self.__page_hits = self.__docsearch.find_page_hits(self.__doc,
+                                                               self.__search)
 
         for page_idx in range(self.__current_idx, nb_pages):
             page = pages[page_idx]
             img = page.get_thumbnail(JobDocThumbnailer.THUMB_WIDTH)
             img = img.copy()
 
-            if self.__search != u"" and self.__search in page:
+            if self.__is_hit(page):
                 img = add_img_border(img, color="#009e00", width=3)
             else:
                 img = add_img_border(img)
@@ -575,8 +641,9 @@ class JobFactoryPageThumbnailer(JobFactory):
         JobFactory.__init__(self, "PageThumbnailer")
         self.__main_win = main_win
 
-    def make(self, doc, search):
-        job = JobPageThumbnailer(self, next(self.id_generator), doc, search)
+    def make(self, docsearch, doc, search):
+        job = JobPageThumbnailer(self, next(self.id_generator), docsearch,
+                                 doc, search)
         job.connect('page-thumbnailing-start',
                     lambda thumbnailer:
                     GObject.idle_add(self.__main_win.on_page_thumbnailing_start_cb,
@@ -728,6 +795,8 @@ class JobImgBuilder(Job):
                                         GObject.TYPE_PYOBJECT,  # pixbuf
                                         # array of boxes
                                         GObject.TYPE_PYOBJECT,
+                                        # spatial index of the boxes
+                                        GObject.TYPE_PYOBJECT,
                                        )),
         'img-building-result-clear': (GObject.SignalFlags.RUN_LAST, None,
                                       (GObject.TYPE_BOOLEAN,  # True == warned the user
@@ -787,10 +856,14 @@ class JobImgBuilder(Job):
             wanted_height = int(factor * pixbuf.get_height())
             pixbuf = pixbuf.scale_simple(wanted_width, wanted_height,
                                          GdkPixbuf.InterpType.BILINEAR)
+            if not self.can_run:
+                return
+            boxes = self.__page.boxes
+            box_index = BoxIndex(boxes)
             if not self.can_run:
                 return
             self.emit('img-building-result-pixbuf', self.warn_user, factor,
-                      original_width, pixbuf, self.__page.boxes)
+                      original_width, pixbuf, boxes, box_index)
             self.done = True
         except Exception:
             self.emit('img-building-result-stock', self.warn_user,
@@ -827,10 +900,12 @@ class JobFactoryImgBuilder(JobFactory):
                     GObject.idle_add(self.__main_win.on_img_building_canceled,
                                      warned_user))
         job.connect('img-building-result-pixbuf',
-                    lambda builder, warned_user, factor, original_width, img, boxes:
+                    lambda builder, warned_user, factor, original_width, img, boxes,
+                    box_index:
                     GObject.idle_add(self.__main_win.on_img_building_result_pixbuf,
                                      builder, warn_user,
-                                     factor, original_width, img, boxes))
+                                     factor, original_width, img, boxes,
+                                     box_index))
         job.connect('img-building-result-stock',
                     lambda builder, warned_user, img:
                     GObject.idle_add(self.__main_win.on_img_building_result_stock,
@@ -854,8 +929,9 @@ class JobBoxesRefresher(Job):
     can_stop = True
     priority = 30
 
-    def __init__(self, factory, id, page, search):
+    def __init__(self, factory, id, docsearch, page, search):
         Job.__init__(self, factory, id)
+        self.__docsearch = docsearch
         self.__page = page
         self.__search = search
 
@@ -864,7 +940,15 @@ class JobBoxesRefresher(Job):
         if not self.can_run:
             return
 
-        highlighted = self.__page.get_boxes(self.__search)
+        page_hits = None
+        if self.__page.doc is not None:
+            page_hits = self.__docsearch.find_page_hits(self.__page.doc,
+                                                        self.__search)
+        if page_hits is not None and not self.__page.page_nb in page_hits:
+            # nothing to highlight: no need to load the boxes
+            highlighted = []
+        else:
+            highlighted = self.__page.get_boxes(self.__search)
         if not self.can_run:
             return
 
@@ -883,8 +967,9 @@ class JobFactoryBoxesRefresher(JobFactory):
         JobFactory.__init__(self, "BoxesRefresher")
         self.__main_win = main_win
 
-    def make(self, page, search):
-        job = JobBoxesRefresher(self, next(self.id_generator), page, search)
+    def make(self, docsearch, page, search):
+        job = JobBoxesRefresher(self, next(self.id_generator), docsearch,
+                                page, search)
         job.connect('highlighted-boxes',
                     lambda job, boxes:
                     GObject.idle_add(self.__main_win.on_highlighted_boxes,
@@ -904,41 +989,27 @@ class JobBoxesSelecter(Job):
     can_stop = True
     priority = 30
 
-    def __init__(self, factory, id, boxes, mouse_position, get_box_pos_func):
+    def __init__(self, factory, id, box_index, page_position):
+        """
+        Arguments:
+            box_index --- see backend.common.boxes.BoxIndex
+            page_position --- position of the mouse on the page (page
+                coordinates, not widget ones)
+        """
         Job.__init__(self, factory, id)
-        self.__boxes = boxes
-        self.__mouse_pos = mouse_position
-        self.__get_box_pos_func = get_box_pos_func
+        self.__box_index = box_index
+        self.__page_pos = page_position
 
     def do(self):
         self.can_run = True
-        self._wait(0.5)
+        # looking for the boxes is cheap, but there is no point in doing it
+        # for each position of the mouse while it's moving
+        self._wait(0.05)
         if not self.can_run:
             return
 
-        mouse_x, mouse_y = self.__mouse_pos
-        selected = set()
-
-        for line in self.__boxes:
-            if not self.can_run:
-                return
-
-            pos = self.__get_box_pos_func(line)
-            ((a, b), (c, d)) = pos
-            if (mouse_x < a or mouse_y < b
-                    or mouse_x > c or mouse_y > d):
-                continue
-
-            for box in line.word_boxes:
-                if not self.can_run:
-                    return
-
-                pos = self.__get_box_pos_func(box)
-                ((a, b), (c, d)) = pos
-                if (mouse_x < a or mouse_y < b
-                        or mouse_x > c or mouse_y > d):
-                    continue
-                selected.add(box)
+        (page_x, page_y) = self.__page_pos
+        selected = set(self.__box_index.get_words_at(page_x, page_y))
 
         self.emit('selected-boxes', selected)
 
@@ -955,9 +1026,9 @@ class JobFactoryBoxesSelecter(JobFactory):
         JobFactory.__init__(self, "BoxesSelecter")
         self.__main_win = main_win
 
-    def make(self, boxes, mouse_position, get_box_pos_func):
+    def make(self, box_index, page_position):
         job = JobBoxesSelecter(self, next(self.id_generator),
-                               boxes, mouse_position, get_box_pos_func)
+                               box_index, page_position)
         job.connect('selected-boxes',
                     lambda job, boxes:
                     GObject.idle_add(self.__main_win.on_selected_boxes,
@@ -970,8 +1041,9 @@ class JobFactoryBoxesRefresher(JobFactory):
         JobFactory.__init__(self, "BoxesRefresher")
         self.__main_win = main_win
 
-    def make(self, page, search):
-        job = JobBoxesRefresher(self, next(self.id_generator), page, search)
+    def make(self, docsearch, page, search):
+        job = JobBoxesRefresher(self, next(self.id_generator), docsearch,
+                                page, search)
         job.connect('highlighted-boxes',
                     lambda job, boxes:
                     GObject.idle_add(self.__main_win.on_highlighted_boxes,
@@ -1099,20 +1171,29 @@ class JobOCRRedoer(Job):
         'redo-ocr-start': (GObject.SignalFlags.RUN_LAST, None, ()),
         'redo-ocr-doc-updated': (GObject.SignalFlags.RUN_LAST, None,
                                  (GObject.TYPE_FLOAT, GObject.TYPE_STRING)),
+        'redo-ocr-interrupted': (GObject.SignalFlags.RUN_LAST, None, ()),
         'redo-ocr-end': (GObject.SignalFlags.RUN_LAST, None, ()),
     }
 
-    # we make it non-interruptible because there is no way for us to start
-    # back from where we stopped, and redoing all the docs may take far too
-    # much time
-    # TODO(Jflesch): Make it interruptible (use iter(target))
-    can_stop = False
+    # the pages still to do are kept in a queue in the index directory (see
+    # ocrqueue.OcrRedoer), so we can start back from where we stopped, even
+    # after a restart
+    can_stop = True
     priority = 5
 
-    def __init__(self, factory, id, langs, target):
+    def __init__(self, factory, id, docsearch, langs, docs):
+        """
+        Arguments:
+            docs --- documents to add to the OCR queue. If empty, the job
+                only resumes what was interrupted previously (if anything)
+        """
         Job.__init__(self, factory, id)
-        self.__target = target
-        self.__langs = langs
+        # the redoer and its queue are shared by all the jobs: if one is
+        # already running, it will do these documents too
+        self.__ocr_redoer = docsearch.get_ocr_redoer()
+        if len(docs) > 0:
+            self.__ocr_redoer.add_docs(docs, langs)
+        self.__will_resume = False
 
     def __progress_cb(self, progression, total, step, doc):
         logger.info("OCR progression: %s : %d / %d : %s"
@@ -1121,11 +1202,37 @@ class JobOCRRedoer(Job):
                   doc.name)
 
     def do(self):
+        # keep in mind that we may have been interrupted and then called back
+        # later
+        self.can_run = True
+        self.__will_resume = False
+        if len(self.__ocr_redoer) <= 0:
+            return
+        self.__ocr_redoer.resume()
+        if not self.can_run:
+            return
+
         self.emit('redo-ocr-start')
-        try:
-            self.__target.redo_ocr(self.__langs, self.__progress_cb)
-        finally:
+        # documents may be added to the queue while we are running
+        while self.can_run and len(self.__ocr_redoer) > 0:
+            if not self.__ocr_redoer.run(self.__progress_cb):
+                break
+        if len(self.__ocr_redoer) <= 0:
             self.emit('redo-ocr-end')
+        elif not self.__will_resume:
+            # when we will be resumed, the search stays disabled meanwhile
+            self.emit('redo-ocr-interrupted')
+
+    def stop(self, will_resume=False):
+        # the pages not done yet stay in the queue of the redoer: do() will
+        # start back from there
+        was_waiting = self.__will_resume
+        self.can_run = False
+        self.__will_resume = will_resume
+        self.__ocr_redoer.stop()
+        if was_waiting and not will_resume:
+            # cancelled while waiting to be resumed
+            self.emit('redo-ocr-interrupted')
 
 
 GObject.type_register(JobOCRRedoer)
@@ -1137,9 +1244,9 @@ class JobFactoryOCRRedoer(JobFactory):
         self.__main_win = main_win
         self.__config = config
 
-    def make(self, target):
-        job = JobOCRRedoer(self, next(self.id_generator), self.__config.langs,
-                           target)
+    def make(self, docsearch, docs=[]):
+        job = JobOCRRedoer(self, next(self.id_generator), docsearch,
+                           self.__config.langs, docs)
         job.connect('redo-ocr-start',
                     lambda ocr_redoer:
                     GObject.idle_add(self.__main_win.on_redo_ocr_start_cb,
@@ -1149,6 +1256,11 @@ class JobFactoryOCRRedoer(JobFactory):
                     GObject.idle_add(
                         self.__main_win.on_redo_ocr_doc_updated_cb,
                         ocr_redoer, progression, doc_name))
+        job.connect('redo-ocr-interrupted',
+                    lambda ocr_redoer:
+                    GObject.idle_add(
+                        self.__main_win.on_redo_ocr_interrupted_cb,
+                        ocr_redoer))
         job.connect('redo-ocr-end',
                     lambda ocr_redoer:
                     GObject.idle_add(self.__main_win.on_redo_ocr_end_cb,
@@ -1213,12 +1325,13 @@ class JobSingleScan(Job):
                 logger.warning("Failed to read the resolution set on"
                                " the scanner: %s. Assuming %d"
                                % (str(exc), resolution))
-            self.doc.scan_single_page(scan_src, resolution,
-                                      self.__config.scanner_calibration,
-                                      self.__config.langs,
-                                      self.__scan_progress_cb)
-            page = self.doc.pages[self.doc.nb_pages - 1]
-            self.__docsearch.index_page(page)
+            with self.__docsearch.writing_docs([self.doc.docid]):
+                self.doc.scan_single_page(scan_src, resolution,
+                                          self.__config.scanner_calibration,
+                                          self.__config.langs,
+                                          self.__scan_progress_cb)
+                page = self.doc.pages[self.doc.nb_pages - 1]
+                self.__docsearch.index_page(page)
             self.emit('single-scan-done', page)
         except Exception, exc:
             self.emit('single-scan-error', str(exc))
@@ -1396,22 +1509,26 @@ class JobPageEditor(Job):
     def do(self):
         self.emit('page-editing-img-edit', self.__page)
         try:
-            img = self.__page.img
-            for change in self.__changes:
-                img = change.do(img, 1.0)
-            self.__page.img = img
-
-            if self.__langs is not None:
-                self.emit('page-editing-ocr', self.__page)
-                self.__page.redo_ocr(self.__langs)
-
-                self.emit('page-editing-index-upd', self.__page)
-                index_upd = self.__docsearch.get_index_updater(optimize=False)
-                index_upd.upd_doc(self.__page.doc)
-                index_upd.commit()
+            with self.__docsearch.writing_docs([self.__page.doc.docid]):
+                self.__edit_page()
         finally:
             self.emit('page-editing-done', self.__page)
 
+    def __edit_page(self):
+        img = self.__page.img
+        for change in self.__changes:
+            img = change.do(img, 1.0)
+        self.__page.img = img
+
+        if self.__langs is not None:
+            self.emit('page-editing-ocr', self.__page)
+            self.__page.redo_ocr(self.__langs)
+
+            self.emit('page-editing-index-upd', self.__page)
+            index_upd = self.__docsearch.get_index_updater(optimize=False)
+            index_upd.upd_doc(self.__page.doc)
+            index_upd.commit()
+
 
 GObject.type_register(JobPageEditor)
 
@@ -1542,7 +1659,7 @@ class ActionUpdateSearchResults(SimpleAction):
                 self.__main_win.job_factories['page_thumbnailer'])
             search = unicode(self.__main_win.search_field.get_text(), encoding='utf-8')
             job = self.__main_win.job_factories['page_thumbnailer'].make(
-                self.__main_win.doc, search)
+                self.__main_win.docsearch, self.__main_win.doc, search)
             self.__main_win.schedulers['main'].schedule(job)
 
             self.__main_win.refresh_boxes()
@@ -1931,11 +2048,12 @@ class ActionDeleteDoc(SimpleAction):
         docid = doc.docid
 
         logger.info("Deleting ...")
-        doc.destroy()
-        index_upd = self.__main_win.docsearch.get_index_updater(
-            optimize=False)
-        index_upd.del_doc(docid)
-        index_upd.commit()
+        with self.__main_win.docsearch.writing_docs([docid]):
+            doc.destroy()
+            index_upd = self.__main_win.docsearch.get_index_updater(
+                optimize=False)
+            index_upd.del_doc(docid)
+            index_upd.commit()
         logger.info("Deleted")
 
         self.__main_win.actions['new_doc'][1].do()
@@ -1976,7 +2094,8 @@ class ActionRedoDocOCR(SimpleAction):
         SimpleAction.do(self)
 
         doc = self.__main_win.doc
-        job = self.__main_win.job_factories['ocr_redoer'].make(doc)
+        job = self.__main_win.job_factories['ocr_redoer'].make(
+            self.__main_win.docsearch, [doc])
         self.__main_win.schedulers['main'].schedule(job)
 
 
@@ -1992,8 +2111,9 @@ class ActionRedoAllOCR(SimpleAction):
 
         self.__main_win.schedulers['main'].cancel_all(
             self.__main_win.job_factories['ocr_redoer'])
+        docsearch = self.__main_win.docsearch
         job = self.__main_win.job_factories['ocr_redoer'].make(
-            self.__main_win.docsearch)
+            docsearch, docsearch.docs)
         self.__main_win.schedulers['main'].schedule(job)
 
 
@@ -2342,6 +2462,7 @@ class ActionRealQuit(SimpleAction):
 
         for scheduler in self.__main_win.schedulers.values():
             scheduler.stop()
+        self.__main_win.stop_watcher()
 
         self.__config.write()
         Gtk.main_quit()
@@ -2440,7 +2561,11 @@ class JobProgressiveList(Job):
         self._wait(0.5)
         if not self.can_run:
             return
-        GObject.idle_add(self.__progressive_list.display_extra)
+        # may have to get more elements to display (may be slow)
+        extra = self.__progressive_list.fetch_extra()
+        if not self.can_run:
+            return
+        GObject.idle_add(self.__progressive_list.display_extra, extra)
 
     def stop(self, will_resume=True):
         self.can_run = False
@@ -2469,6 +2594,10 @@ class ProgressiveList(GObject.GObject):
 
     So instead, we display only X elements. When the user scroll down,
     we add Y elements to the list, etc.
+
+    The elements themselves may also be obtained progressively: when all
+    the elements known have been displayed, fetch_more() is called (from
+    a job) to get more of them (see set_model()).
     """
 
     NB_EL_DISPLAYED_INITIALLY = 100
@@ -2479,6 +2608,8 @@ class ProgressiveList(GObject.GObject):
     __gsignals__ = {
         'lines-shown': (GObject.SignalFlags.RUN_LAST, None,
                       (GObject.TYPE_PYOBJECT,) ),  # [(line_idx, obj), ... ]
+        'lines-fetched': (GObject.SignalFlags.RUN_LAST, None,
+                      (GObject.TYPE_PYOBJECT,) ),  # [model line, ... ]
     }
 
     def __init__(self, name,
@@ -2494,6 +2625,9 @@ class ProgressiveList(GObject.GObject):
 
         self.model = model
         self.model_content = []
+        self.fetch_more = None
+        # incremented each time the model is replaced
+        self.__model_id = 0
 
         self.nb_displayed = 0
 
@@ -2503,8 +2637,18 @@ class ProgressiveList(GObject.GObject):
 
         self.job_factory = JobFactoryProgressiveList(self)
 
-    def set_model(self, model_content):
+    def set_model(self, model_content, fetch_more=None):
+        """
+        Arguments:
+            model_content --- model lines
+            fetch_more --- function returning the next model lines, if
+                model_content doesn't contain all the elements to display.
+                Must return an empty list once all of them have been
+                returned. Called from a job, not from Gtk main loop.
+        """
         self.model_content = model_content
+        self.fetch_more = fetch_more
+        self.__model_id += 1
 
         self.widget_gui.freeze_child_notify()
         self.widget_gui.set_model(None)
@@ -2516,7 +2660,37 @@ class ProgressiveList(GObject.GObject):
             self.widget_gui.freeze_child_notify()
             self.widget_gui.set_model(self.model)
 
-    def display_extra(self):
+    def fetch_extra(self):
+        """
+        Get the model lines to display next if they are not known yet.
+        Called from a job.
+
+        Returns:
+            Something to give to display_extra()
+        """
+        model_id = self.__model_id
+        fetch_more = self.fetch_more
+        nb_wanted = self.nb_displayed + self.NB_EL_DISPLAYED_ADDITIONNAL
+        if fetch_more is None or nb_wanted <= len(self.model_content):
+            return (model_id, [])
+        return (model_id, fetch_more())
+
+    def display_extra(self, extra=None):
+        """
+        Arguments:
+            extra --- value returned by fetch_extra()
+        """
+        if extra is not None:
+            (model_id, lines) = extra
+            if model_id != self.__model_id:
+                # the model has been replaced in the meantime
+                return
+            if len(lines) <= 0:
+                self.fetch_more = None
+            else:
+                self.model_content += lines
+                self.emit('lines-fetched', lines)
+
         self.__main_win.actions['open_doc'][1].enabled = False
         try:
             selected = self.widget_gui.get_selected_items()
@@ -2565,7 +2739,8 @@ class ProgressiveList(GObject.GObject):
 
         self.emit('lines-shown', newly_displayed)
 
-        if nb_elements < len(self.model_content):
+        if (nb_elements < len(self.model_content)
+                or self.fetch_more is not None):
             self.model.append([_("Loading ..."),
                                self.__main_win.default_thumbnail, None])
 
@@ -2573,7 +2748,8 @@ class ProgressiveList(GObject.GObject):
                     % (self.name, self.nb_displayed, len(newly_displayed)))
 
     def __on_scrollbar_moved(self):
-        if self.nb_displayed >= len(self.model_content):
+        if (self.nb_displayed >= len(self.model_content)
+                and self.fetch_more is None):
             return
 
         lower = self._vadjustment.get_lower()
@@ -2678,6 +2854,12 @@ class MainWindow(object):
         self.__scan_progress_job = None
 
         self.docsearch = DummyDocSearch()
+        self.watcher = None
+        # documents changed while the index was being reloaded
+        self.__watcher_changes = set()
+        # True once the OCR redo interrupted by the last exit (if any) has
+        # been resumed
+        self.__ocr_redo_resumed = False
         self.doc = ImgDoc(self.__config.workdir)
         self.page = DummyPage(self.doc)
 
@@ -2717,6 +2899,10 @@ class MainWindow(object):
         self.lists['matches'].connect(
             'lines-shown',
             lambda x, docs: GObject.idle_add(self.__on_doc_lines_shown, docs))
+        self.lists['matches'].connect(
+            'lines-fetched',
+            lambda x, lines: self.lists['doclist'].extend(
+                [line[2] for line in lines]))
 
         search_completion.set_model(self.lists['suggestions']['model'])
         search_completion.set_text_column(0)
@@ -2752,6 +2938,7 @@ class MainWindow(object):
             "original_width": 1,
             "boxes": {
                 'all': [],
+                'index': None,
                 'visible': [],
                 'highlighted': [],
                 'selected': [],
@@ -2826,9 +3013,9 @@ class MainWindow(object):
 
         self.sortings = [
             (widget_tree.get_object("radiomenuitemSortByRelevance"),
-             lambda docs: None),
+             DocSearch.SORT_BY_RELEVANCE),
             (widget_tree.get_object("radiomenuitemSortByScanDate"),
-             sort_documents_by_date),
+             DocSearch.SORT_BY_DATE),
         ]
 
         self.job_factories = {
@@ -3291,6 +3478,79 @@ class MainWindow(object):
         self.refresh_doc_list()
         self.refresh_label_list()
 
+        self.start_watcher()
+        if len(self.__watcher_changes) > 0:
+            docids = self.__watcher_changes
+            self.__watcher_changes = set()
+            self.on_workdir_changes_cb(docids)
+
+        if not self.__ocr_redo_resumed:
+            self.__ocr_redo_resumed = True
+            job = self.job_factories['ocr_redoer'].make(docsearch)
+            self.schedulers['main'].schedule(job)
+
+    def start_watcher(self):
+        """
+        Start watching the work directory, if not already done (and if
+        enabled)
+        """
+        if not self.__config.watch_workdir or not is_watcher_available():
+            return
+        if (self.watcher is None
+                or self.watcher.rootdir != self.docsearch.rootdir):
+            self.stop_watcher()
+            self.watcher = DocDirWatcher(
+                self.docsearch.rootdir,
+                lambda docids: GObject.idle_add(self.on_workdir_changes_cb,
+                                                docids))
+            self.watcher.start()
+        # so the changes we make to the documents are not reported
+        self.docsearch.watcher = self.watcher
+
+    def stop_watcher(self):
+        if self.watcher is None:
+            return
+        self.docsearch.watcher = None
+        self.watcher.stop()
+        self.watcher = None
+
+    def on_workdir_changes_cb(self, docids):
+        """
+        Called when other programs have modified the work directory: update
+        the index with only the documents that have changed
+        """
+        if docids is None:
+            # we don't know what has changed
+            self.actions['reindex'][1].do()
+            return
+        if isinstance(self.docsearch, DummyDocSearch):
+            # the index is being reloaded --> wait for it
+            self.__watcher_changes.update(docids)
+            return
+        job = self.job_factories['doc_examiner'].make(self.docsearch, docids)
+        job.connect('doc-examination-end', lambda job: GObject.idle_add(
+            self.__on_workdir_changes_examined, job))
+        self.schedulers['main'].schedule(job)
+
+    def __on_workdir_changes_examined(self, examiner):
+        if (len(examiner.new_docs) == 0
+                and len(examiner.docs_changed) == 0
+                and len(examiner.docs_missing) == 0):
+            return
+        logger.info("Work directory changes: %d new, %d modified,"
+                    " %d deleted"
+                    % (len(examiner.new_docs), len(examiner.docs_changed),
+                       len(examiner.docs_missing)))
+        # the index update will start a doc list refresh when finished
+        job = self.job_factories['index_updater'].make(
+            docsearch=examiner.docsearch,
+            new_docs=examiner.new_docs,
+            upd_docs=examiner.docs_changed,
+            del_docs=examiner.docs_missing,
+            optimize=False
+        )
+        self.schedulers['main'].schedule(job)
+
 
     def on_doc_examination_start_cb(self, src):
         self.set_progression(src, 0.0, None)
@@ -3316,7 +3576,7 @@ class MainWindow(object):
     def on_index_update_write_cb(self, src):
         self.set_search_availability(False)
 
-    def on_search_result_cb(self, documents, suggestions):
+    def on_search_result_cb(self, documents, suggestions, pager):
         self.schedulers['main'].cancel_all(self.job_factories['doc_thumbnailer'])
 
 
@@ -3342,9 +3602,14 @@ class MainWindow(object):
         if len(documents) > 0 and documents[0].is_new and self.doc.is_new:
             active_idx = 0
 
+        fetch_more = None
+        if pager.has_more:
+            fetch_more = lambda: [self.__get_doc_model_line(doc)
+                                  for doc in pager.next_page()]
+
         self.lists['doclist'] = documents
         self.lists['matches'].set_model([self.__get_doc_model_line(doc)
-                                         for doc in documents])
+                                         for doc in documents], fetch_more)
         self.lists['matches'].select_idx(active_idx)
 
     def on_page_thumbnailing_start_cb(self, src):
@@ -3374,6 +3639,7 @@ class MainWindow(object):
 
     def drop_boxes(self):
         self.img['boxes']['all'] = []
+        self.img['boxes']['index'] = None
         self.img['boxes']['highlighted'] = []
         self.img['boxes']['visible'] = []
 
@@ -3400,8 +3666,10 @@ class MainWindow(object):
             self.set_mouse_cursor("Normal")
 
     def on_img_building_result_pixbuf(self, builder, warned_user, factor,
-                                      original_width, pixbuf, boxes):
+                                      original_width, pixbuf, boxes,
+                                      box_index):
         self.img['boxes']['all'] = boxes
+        self.img['boxes']['index'] = box_index
 
         self.img['factor'] = factor
         self.img['pixbuf'] = pixbuf
@@ -3442,14 +3710,22 @@ class MainWindow(object):
         self.set_progression(src, progression,
                              _("Redoing OCR (%s) ...") % (doc_name))
 
-    def on_redo_ocr_end_cb(self, src):
+    def on_redo_ocr_interrupted_cb(self, src):
         self.set_progression(src, 0.0, None)
         self.set_search_availability(True)
         self.set_mouse_cursor("Normal")
+
+    def on_redo_ocr_end_cb(self, src):
+        self.on_redo_ocr_interrupted_cb(src)
         self.refresh_label_list()
         # in case the keywords were highlighted
         self.show_page(self.page, force_refresh=True)
-        self.actions['reindex'][1].do()
+        # the index has been updated as the OCR went on: we just have to
+        # reload it
+        self.schedulers['main'].cancel_all(
+            self.job_factories['index_reloader'])
+        job = self.job_factories['index_reloader'].make()
+        self.schedulers['main'].schedule(job)
 
     def on_single_scan_start(self, job):
         self.set_progression(job, 0.0, _("Scanning ..."))
@@ -3560,10 +3836,12 @@ class MainWindow(object):
     def __on_img_mouse_motion(self, event_box, event):
         self.schedulers['main'].cancel_all(
             self.job_factories['boxes_selecter'])
+        if self.img['boxes']['index'] is None:
+            return
         job = self.job_factories['boxes_selecter'].make(
-            self.img['boxes']['all'], event.get_coords(),
-            lambda box: self.__get_box_position(box, window=self.img['image'],
-                                                width=0))
+            self.img['boxes']['index'],
+            self.__get_page_position(event.get_coords(),
+                                     window=self.img['image']))
         self.schedulers['main'].schedule(job)
 
     def __queue_box_draw(self, boxes):
@@ -3624,6 +3902,21 @@ class MainWindow(object):
         d += width
         return ((int(a), int(b)), (int(c), int(d)))
 
+    def __get_page_position(self, position, window):
+        """
+        Convert a position in the image widget into a position on the page
+        (reverse of __get_box_position())
+        """
+        (x, y) = position
+        (win_w, win_h) = (window.get_allocation().width,
+                          window.get_allocation().height)
+        (pic_w, pic_h) = (self.img['pixbuf'].get_width(),
+                          self.img['pixbuf'].get_height())
+        (margin_x, margin_y) = ((win_w-pic_w)/2, (win_h-pic_h)/2)
+        x = (x - margin_x) / self.img['factor']
+        y = (y - margin_y) / self.img['factor']
+        return (x, y)
+
     def __on_img_draw(self, imgwidget, cairo_context):
         visible = []
         for line in self.img['boxes']['visible']:
@@ -3794,7 +4087,7 @@ class MainWindow(object):
         self.schedulers['main'].cancel_all(self.job_factories['searcher'])
         search = unicode(self.search_field.get_text(), encoding='utf-8')
         job = self.job_factories['searcher'].make(
-            self.docsearch, self.get_doc_sort_func(), search)
+            self.docsearch, self.get_doc_sorting(), search)
         self.schedulers['main'].schedule(job)
 
     def refresh_page_list(self):
@@ -3821,7 +4114,8 @@ class MainWindow(object):
             widget.set_sensitive(False)
 
         search = unicode(self.search_field.get_text(), encoding='utf-8')
-        job = self.job_factories['page_thumbnailer'].make(self.doc, search)
+        job = self.job_factories['page_thumbnailer'].make(self.docsearch,
+                                                          self.doc, search)
         self.schedulers['main'].schedule(job)
 
     def refresh_label_list(self):
@@ -3856,7 +4150,8 @@ class MainWindow(object):
     def refresh_boxes(self):
         self.schedulers['main'].cancel_all(self.job_factories['boxes_refresher'])
         search = unicode(self.search_field.get_text(), encoding='utf-8')
-        job = self.job_factories['boxes_refresher'].make(self.page, search)
+        job = self.job_factories['boxes_refresher'].make(self.docsearch,
+                                                         self.page, search)
         self.schedulers['main'].schedule(job)
 
     def show_page(self, page, force_refresh=False):
@@ -4103,8 +4398,12 @@ class MainWindow(object):
         job = self.job_factories['doc_thumbnailer'].make(docs)
         self.schedulers['main'].schedule(job)
 
-    def get_doc_sort_func(self):
-        for (widget, sort_func) in self.sortings:
+    def get_doc_sorting(self):
+        """
+        Returns:
+            DocSearch.SORT_BY_RELEVANCE or DocSearch.SORT_BY_DATE
+        """
+        for (widget, sort_by) in self.sortings:
             if widget.get_active():
-                return sort_func
+                return sort_by
         return self.sortings[0][1]
@@ -77,13 +77,13 @@ class JobDocScan(Job):
         for self.current_page in range(0, self.nb_pages):
             self.emit('scan-start', self.current_page, self.nb_pages)
             try:
-                self.doc.scan_single_page(self.__scan_src,
-                                          self.__config.scanner_resolution,
-                                          self.__config.scanner_calibration,
-                                          self.__config.langs,
-                                          self.__progress_cb)
-                page = self.doc.pages[self.doc.nb_pages - 1]
-                self.docsearch.index_page(page)
+                with self.docsearch.writing_docs([self.doc.docid]):
+                    self.doc.scan_single_page(
+                        self.__scan_src, self.__config.scanner_resolution,
+                        self.__config.scanner_calibration,
+                        self.__config.langs, self.__progress_cb)
+                    page = self.doc.pages[self.doc.nb_pages - 1]
+                    self.docsearch.index_page(page)
                 self.emit('scan-done', page, self.nb_pages)
             except StopIteration, exc:
                 logger.warning("Feeder appears to be empty and we "
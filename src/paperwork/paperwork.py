@@ -30,6 +30,7 @@ import pyocr.pyocr
 import pyinsane.abstract_th  # Just to start the Sane thread
 
 from frontend import mainwindow
+from backend import ocr
 from backend.config import PaperworkConfig
 
 
@@ -92,6 +93,7 @@ def main():
     try:
         config = PaperworkConfig()
         config.read()
+        ocr.get_ocr_engine().set_max_workers(config.ocr_max_processes)
 
         main_win = mainwindow.MainWindow(config)
         mainwindow.ActionRefreshIndex(main_win, config).do()
@@ -55,68 +55,104 @@ UI_FILES_DIRS = [
 ]
 
 
+class _AccentTranslationTable(dict):
+    """
+    Translation table for unicode.translate(): codepoint --> same character
+    without its accents. Filled as characters are met, so each character
+    is only decomposed once.
+    """
+
+    def __missing__(self, codepoint):
+        try:
+            character = unichr(codepoint)
+        except ValueError:
+            # not a valid character --> left untouched
+            raise LookupError(codepoint)
+        stripped = u"".join(
+            (char for char in unicodedata.normalize('NFD', character)
+             if unicodedata.category(char) != 'Mn'))
+        self[codepoint] = stripped
+        return stripped
+
+
+_ACCENT_TRANSLATION_TABLE = _AccentTranslationTable()
+_NON_ASCII = re.compile(u"[^\x00-\x7f]")
+
+
 def strip_accents(string):
     """
     Strip all the accents from the string
     """
-    return ''.join(
-        (character for character in unicodedata.normalize('NFD', string)
-         if unicodedata.category(character) != 'Mn'))
+    if _NON_ASCII.search(string) is None:
+        # nothing to strip
+        return string
+    return string.translate(_ACCENT_TRANSLATION_TABLE)
+
 
+# single-pass tokenizer (see split_words()):
+# - words separated by FORCED_SPLIT_KEYWORDS_REGEX (or new lines), long
+#   enough to be used
+_FORCED_SPLIT_WORD_REGEX = re.compile(u"[^ '()\n]{%d,}" % MIN_KEYWORD_LEN,
+                                      re.UNICODE)
+# - parts of these words separated by WISHED_SPLIT_KEYWORDS_REGEX
+_WISHED_SPLIT_WORD_REGEX = re.compile(u"[\\w!]+", re.UNICODE)
 
-def __cleanup_word_array(keywords):
+
+def __split_words(sentence):
     """
-    Yield all the keywords long enough to be used
+    See split_words()
     """
-    for word in keywords:
-        if len(word) >= MIN_KEYWORD_LEN:
-            yield word
+    # TODO: i18n
+    sentence = strip_accents(sentence.lower())
+
+    keywords = []
+    for word in _FORCED_SPLIT_WORD_REGEX.findall(sentence):
+        if word.isalnum():
+            # most common case: nothing more to split (unicode.isalnum()
+            # uses the same definition than \w, minus '_')
+            keywords.append(word)
+            continue
+        subwords = _WISHED_SPLIT_WORD_REGEX.findall(word)
+        if len(subwords) <= 0:
+            continue
+        if min([len(subword) for subword in subwords]) >= MIN_KEYWORD_LEN:
+            keywords += subwords
+            continue
+        # can't split it without getting keywords too short
+        if word[0] == '"':
+            word = word[1:]
+        if word[-1] == '"':
+            word = word[:-1]
+        keywords.append(word)
+    return keywords
 
 
 def split_words(sentence):
     """
-    Extract and yield the keywords from the sentence:
+    Extract the keywords from the sentence:
     - Drop keywords that are too short
     - Drop the accents
     - Make everything lower case
     - Try to separate the words as much as possible (using 2 list of
       separators, one being more complete than the others)
-    """
-    if (sentence == "*"):
-        yield sentence
-        return
 
-    # TODO: i18n
-    sentence = sentence.lower()
-    sentence = strip_accents(sentence)
-
-    words = FORCED_SPLIT_KEYWORDS_REGEX.split(sentence)
-    for word in __cleanup_word_array(words):
-        can_split = True
-        can_yield = False
-        subwords = WISHED_SPLIT_KEYWORDS_REGEX.split(word)
-        for subword in subwords:
-            if subword == "":
-                continue
-            can_yield = True
-            if len(subword) < MIN_KEYWORD_LEN:
-                can_split = False
-                break
-        if can_split:
-            for subword in subwords:
-                if subword == "":
-                    continue
-                if subword[0] == '"':
-                    subword = subword[1:]
-                if subword[-1] == '"':
-                    subword = subword[:-1]
-                yield subword
-        elif can_yield:
-            if word[0] == '"':
-                word = word[1:]
-            if word[-1] == '"':
-                word = word[:-1]
-            yield word
+    The sentence may also be a whole text (the text of a page for instance):
+    each line is then handled as a separate sentence. The text is processed
+    in a single pass.
+
+    Returns:
+        A list of keywords
+    """
+    if not u"*" in sentence:
+        return __split_words(sentence)
+    # a sentence made only of '*' is a keyword
+    keywords = []
+    for line in sentence.split(u"\n"):
+        if line == u"*":
+            keywords.append(line)
+        else:
+            keywords += __split_words(line)
+    return keywords
 
 
 def load_uifile(filename):